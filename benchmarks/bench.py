@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+################################################################################
+# Copyright (c) 2017 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+"""Time and memory-profile each stage of parsing synthetic XAD files.
+
+Each stage is run on the output of the previous one, so that it is measured
+on its own: the best of several timed runs is reported along with the peak
+of memory allocated by Python during one more run (traced separately, as
+tracemalloc slows everything down).
+
+    python benchmarks/bench.py --save benchmarks/baseline.json
+    python benchmarks/bench.py --baseline benchmarks/baseline.json
+
+exits with status 1 if any stage has become slower or uses more memory than
+its baseline by more than the tolerance.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import xadder
+from mkxad import write_xad
+
+BASELINE_VERSION = 1
+
+# name: (chips, samples per chip, values per signal, vartype)
+CASES = {
+    "small": (1, 3, 1000, "LE_R4"),
+    "medium": (4, 12, 20000, "LE_R4"),
+    "large": (8, 12, 40000, "LE_R4"),
+    "medium-i2": (4, 12, 20000, "LE_I2"),
+}
+
+def stage_outer(xad_file):
+    """Split the document and handle its comments; returns the compressed_data text."""
+    document = xadder.XadDocument()
+    with xadder.map_xad_file(xad_file) as view:
+        for name, data in xadder.split_xad(view):
+            if name == "#comment":
+                xadder.xad_handle_comment(document, data)
+            else:
+                encoded = bytes(data)
+    return encoded
+
+def stage_base64(encoded):
+    return b''.join(xadder.b64decode_chunks(encoded))
+
+def stage_inflate(decoded):
+    return xadder.inflate(decoded[xadder.COMPRESSED_DATA_HEADER_SIZE:-xadder.COMPRESSED_DATA_FOOTER_SIZE])
+
+def stage_utf16(inflated):
+    # DataXmlParser lets expat decode the UTF-16 itself; this is the cost of
+    # doing so separately, for comparison
+    inflated.decode('utf-16-le')
+    return inflated
+
+def stage_data_xml(inflated):
+    document = xadder.XadDocument()
+    parser = xadder.DataXmlParser(document)
+    parser.feed(inflated)
+    parser.close()
+    return document
+
+def packed_values(document):
+    for chip in document.chips:
+        if chip.packet is not None:
+            yield chip.packet
+        for _, _, _, signal in xadder.iter_signals(chip):
+            for packed in (signal.raw_signal, signal.script_step):
+                if packed is not None:
+                    yield packed
+
+def stage_packed_values(document):
+    for packed in packed_values(document):
+        # bypass the cache, which would otherwise make every run after the first free
+        xadder.decode_packed_values_uncached(packed)
+    return document
+
+def stage_output(document):
+    # the packed values are decoded (and cached) beforehand so only formatting is measured
+    for packed in packed_values(document):
+        packed.values
+    with redirect_stdout(io.StringIO()):
+        xadder.print_document_start(document, None)
+        for chip in document.chips:
+            xadder.print_chip(chip)
+        xadder.print_document_end(document)
+
+def stage_output_jsonl(document):
+    for packed in packed_values(document):
+        packed.values
+    writer = xadder.JsonLinesWriter(io.BytesIO())
+    writer.start_document(document)
+    for chip in document.chips:
+        writer.add_chip(chip)
+    writer.end_document(document)
+    writer.flush()
+
+def stage_load_xad(xad_file):
+    xadder.load_xad(xad_file)
+
+# name, function, name of the stage whose result is its argument (None for the XAD file)
+STAGES = (
+    ("outer", stage_outer, None),
+    ("base64", stage_base64, "outer"),
+    ("inflate", stage_inflate, "base64"),
+    ("utf16", stage_utf16, "inflate"),
+    ("data_xml", stage_data_xml, "inflate"),
+    ("packed_values", stage_packed_values, "data_xml"),
+    ("output", stage_output, "data_xml"),
+    ("output_jsonl", stage_output_jsonl, "data_xml"),
+    ("load_xad", stage_load_xad, None),
+)
+
+def measure(function, argument, repeat):
+    """Return (result, best time in seconds, peak traced memory in bytes) of function(argument)."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        function(argument)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, best, peak
+
+def run_case(xad_file, repeat):
+    results = {}
+    stages = {}
+    for name, function, source in STAGES:
+        argument = xad_file if source is None else results[source]
+        results[name], seconds, peak = measure(function, argument, repeat)
+        xadder.decode_packed_values.cache_clear()
+        stages[name] = {"seconds": seconds, "peak_bytes": peak}
+    return stages
+
+def run(cases, repeat, directory):
+    report = {
+        "version": BASELINE_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": xadder.numpy is not None,
+        "cases": {},
+    }
+    for case in cases:
+        chips, samples, length, var_type = CASES[case]
+        xad_file = os.path.join(directory, case + '.xad')
+        write_xad(xad_file, chips, samples, length, var_type)
+        report["cases"][case] = {"file_size": os.path.getsize(xad_file), "stages": run_case(xad_file, repeat)}
+        print_case(case, report["cases"][case])
+    return report
+
+def print_case(case, result):
+    print("%s (%.1f MB)" % (case, result["file_size"] / 1e6), file=sys.stderr)
+    for stage, values in result["stages"].items():
+        print("  %-14s %9.2f ms %10.1f KB" % (stage, values["seconds"] * 1e3, values["peak_bytes"] / 1e3), file=sys.stderr)
+
+# Differences from the baseline too small to be told apart from noise
+MIN_DIFFERENCE = {"seconds": 0.005, "peak_bytes": 1 << 16}
+
+def compare(report, baseline, tolerance):
+    """Return the descriptions of the stages which regressed against baseline by more than tolerance (a fraction)."""
+    regressions = []
+    for case, result in report["cases"].items():
+        baseline_stages = baseline["cases"].get(case, {}).get("stages", {})
+        for stage, values in result["stages"].items():
+            for measurement in ("seconds", "peak_bytes"):
+                before = baseline_stages.get(stage, {}).get(measurement)
+                if before and values[measurement] > max(before * (1 + tolerance), before + MIN_DIFFERENCE[measurement]):
+                    regressions.append("%s %s %s: %.4g -> %.4g (+%.0f%%)" % (
+                        case, stage, measurement, before, values[measurement], (values[measurement] / before - 1) * 100))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark each stage of parsing synthetic XAD files')
+    parser.add_argument('--case', action='append', choices=sorted(CASES), help='benchmark this case (may be repeated; default: all)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs of each stage (default: %(default)s)')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with this JSON file written by --save')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='fraction by which a stage may exceed its baseline (default: %(default)s)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        report = run(args.case or list(CASES), args.repeat, directory)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("version") != BASELINE_VERSION:
+            parser.error("%s is not a version %d baseline" % (args.baseline, BASELINE_VERSION))
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print("regression: %s" % (regression), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
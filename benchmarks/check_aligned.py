@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+################################################################################
+# Copyright (c) 2017 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+"""Check that aligned_signal_matrix loses no values of signals sharing an x-axis.
+
+All the signals and channels of the synthetic files share one aligned
+x-axis, so their matrix must have no NaN, and each row must equal the
+RawSignal it came from. Files of several lengths are checked, since
+whether the last position rounds above the last sample depends on it.
+
+    python benchmarks/check_aligned.py
+
+exits with status 1 if any matrix has a NaN or differs from its signals.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import xadder
+from mkxad import write_xad
+
+def check_file(xad_file):
+    """Compare the aligned matrix of each chip of xad_file with its signals and return the number of mismatches."""
+    mismatches = 0
+    for chip in xadder.load_xad(xad_file).chips:
+        matrix = xadder.aligned_signal_matrix(chip)
+        missing = int(xadder.numpy.isnan(matrix.values).sum())
+        if missing:
+            print("%s: chip %s has %d NaN values" % (xad_file, chip.id, missing), file=sys.stderr)
+            mismatches += 1
+        signals = [signal for _, trace, _, signal in xadder.iter_signals(chip) if trace in ("signal", "channel")]
+        for row, actual, signal in zip(matrix.rows, matrix.values, signals):
+            expected = signal.raw_signal.values
+            if len(actual) != len(expected) or not xadder.numpy.allclose(actual, expected):
+                print("%s: chip %s %s differs from its signal" % (xad_file, chip.id, " ".join(map(str, row))), file=sys.stderr)
+                mismatches += 1
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that aligned_signal_matrix loses no values of signals sharing an x-axis')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[50, 100, 1000, 4097],
+                        help='numbers of values per signal of the synthetic files (default: %(default)s)')
+    args = parser.parse_args()
+
+    if xadder.numpy is None:
+        sys.exit("numpy is required for aligned signal matrices")
+    mismatches = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for length in args.lengths:
+            xad_file = os.path.join(directory, "synthetic-%d.xad" % (length))
+            write_xad(xad_file, chips=1, samples=3, length=length)
+            failed = check_file(xad_file)
+            print("%s: %d values per signal, %d mismatches" % (os.path.basename(xad_file), length, failed))
+            mismatches += failed
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+################################################################################
+# Copyright (c) 2017 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+"""Check that signals read through a sidecar index equal those of a full parse.
+
+The index of each file is built with a small span, so that there are many
+checkpoints and most of them resume in the middle of a byte, written and read
+back, and then every signal in it is read with read_indexed_values and
+through a PackedSource and compared with the full parse.
+
+    python benchmarks/check_index.py
+    python benchmarks/check_index.py --span 8 chip.xad
+
+checks a synthetic file if no XAD files are given, and exits with status 1
+if any signal differs.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import xadder
+from mkxad import write_xad
+
+def parse_texts(xad_file, packed_text=True):
+    """Return the base64 text of each packed value of xad_file, keyed as in XadIndex.entries.
+
+    With packed_text false, the text is read back through a PackedSource.
+    """
+    texts = {}
+    for position, chip in enumerate(xadder.load_xad(xad_file, packed_text=packed_text).chips):
+        for raw_signal_set, trace, channel, signal in xadder.iter_signals(chip):
+            for field in ("raw_signal", "script_step"):
+                packed = getattr(signal, field)
+                if packed is not None:
+                    texts[(position, raw_signal_set.name, trace, channel, field)] = packed.text()
+    return texts
+
+def check_file(xad_file, span, require_bits=False):
+    """Index xad_file, compare its signals with the full parse and return the number of mismatches.
+
+    The index is written next to a link to xad_file in a temporary directory,
+    so that an existing index of it is neither used nor overwritten.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        link = os.path.join(directory, os.path.basename(xad_file))
+        os.symlink(os.path.abspath(xad_file), link)
+        xadder.write_index(xadder.build_index(link, span), xadder.index_path(link))
+        index = xadder.read_index(xadder.index_path(link))
+        expected = parse_texts(link)
+        mismatches = 0
+        if set(index.entries) != set(expected):
+            print("%s: index has %d signals, full parse %d" % (xad_file, len(index.entries), len(expected)), file=sys.stderr)
+            mismatches += 1
+        for key, text in sorted(expected.items(), key=repr):
+            if key not in index.entries:
+                continue
+            packed = xadder.read_indexed_values(link, index, *key)
+            if packed.text() != text or packed.num_values != len(packed.values):
+                print("%s: %s differs from the full parse" % (xad_file, " ".join(map(str, key))), file=sys.stderr)
+                mismatches += 1
+        lazy = parse_texts(link, packed_text=False)
+        for key, text in sorted(expected.items(), key=repr):
+            if lazy.get(key) != text:
+                print("%s: %s read back lazily differs from the full parse" % (xad_file, " ".join(map(str, key))), file=sys.stderr)
+                mismatches += 1
+    unaligned = sum(1 for checkpoint in index.checkpoints if checkpoint.bits)
+    print("%s: %d signals, %d checkpoints (%d not on a byte boundary), %d mismatches" % (
+        xad_file, len(expected), len(index.checkpoints), unaligned, mismatches))
+    if require_bits and not unaligned:
+        print("%s: no checkpoint is in the middle of a byte; use a smaller --span" % (xad_file), file=sys.stderr)
+        mismatches += 1
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that signals read through a sidecar index equal those of a full parse')
+    parser.add_argument('xad', nargs='*', help='XAD files to check (default: a synthetic one)')
+    parser.add_argument('--span', type=int, default=4, metavar='KB', help='amount of inflated data between checkpoints (default: %(default)s)')
+    parser.add_argument('--chips', type=int, default=2, help='number of chips of the synthetic file (default: %(default)s)')
+    parser.add_argument('--samples', type=int, default=4, help='number of samples per chip of the synthetic file (default: %(default)s)')
+    parser.add_argument('--length', type=int, default=20000, help='number of values per signal of the synthetic file (default: %(default)s)')
+    args = parser.parse_args()
+
+    if xadder.load_libz() is None:
+        sys.exit("libz is not available, so indexes have no checkpoints to check")
+    mismatches = 0
+    if args.xad:
+        for xad_file in args.xad:
+            mismatches += check_file(xad_file, args.span << 10)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            xad_file = os.path.join(directory, "synthetic.xad")
+            write_xad(xad_file, args.chips, args.samples, args.length)
+            mismatches += check_file(xad_file, args.span << 10, require_bits=True)
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+################################################################################
+# Copyright (c) 2017 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+"""Write synthetic XAD files with the structure of those from Bioanalyzer 2100.
+
+The files have the header, preview and comment tag comments followed by
+<compressed_data>: base64 of a 76 byte header, the raw deflate stream of the
+UTF-16 data XML and a 9 byte footer. The signal values are random.
+"""
+import argparse
+import random
+import struct
+import zlib
+from base64 import b64encode
+
+# struct format and range of random values for each supported vartype
+VAR_TYPES = {
+    "LE_R4": ('f', -5.0, 50.0),
+    "LE_I2": ('h', -32768, 32767),
+    "LE_UI1": ('B', 0, 255),
+}
+
+HEADER_UUID = "f85b47ac-6be2-4de6-9164-a077e5a0b247"
+PREVIEW_UUID = "368699c4-0f05-457b-afce-daa16d5dd037"
+TAG_UUID = "788956de-4f1b-46aa-8271-1048a2120d9f"
+
+def packed(name, var_type, values):
+    fmt = VAR_TYPES[var_type][0]
+    data = struct.pack('<%d%s' % (len(values), fmt), *values)
+    return '<%s numvalues="%d" vartype="%s">%s</%s>' % (name, len(values), var_type, b64encode(data).decode('ascii'), name)
+
+def random_values(rng, var_type, length):
+    fmt, low, high = VAR_TYPES[var_type]
+    if fmt == 'f':
+        return [rng.uniform(low, high) for _ in range(length)]
+    return [rng.randint(low, high) for _ in range(length)]
+
+def signal_data(rng, index, length, var_type):
+    return ('<SignalData><AlignmentBias>0.5</AlignmentBias><AlignmentScale>1.01</AlignmentScale>'
+            '<ChannelID>%d</ChannelID><Index>%d</Index><MaxValue>50</MaxValue><MinValue>-5</MinValue>'
+            '<Name>Sample %d</Name><NumberOfSamples>%d</NumberOfSamples>%s%s<UnitX>s</UnitX><UnitY>FU</UnitY>'
+            '<XMaxVisibleRange>70</XMaxVisibleRange><XMinVisibleRange>15</XMinVisibleRange>'
+            '<XStart>0.05</XStart><XStartAligned>0.1</XStartAligned><XStep>0.05</XStep><XStepAligned>0.0505</XStepAligned>'
+            '<YMaxVisibleRange>60</YMaxVisibleRange><YMinVisibleRange>-1</YMinVisibleRange></SignalData>') % (
+                index, index, index, length,
+                packed("RawSignal", var_type, random_values(rng, var_type, length)),
+                packed("ScriptStep", "LE_I2", [1, 2, -3]))
+
+def assay_body(samples):
+    return ('<AssayBody><DAAssaySetpoints><DAMAssaySetpoints/><DAMAssayInfoCommon><Title>DNA 1000</Title></DAMAssayInfoCommon>'
+            '</DAAssaySetpoints><DASampleSequence>%s</DASampleSequence><DASampleSetpoints>'
+            '<DAMIntegrator>Standard</DAMIntegrator><DAMSizing><Method>Spline</Method></DAMSizing>'
+            '<DAMLowerMarkerPresent>True</DAMLowerMarkerPresent><DAMTimeShift>0</DAMTimeShift></DASampleSetpoints>'
+            '<DALadderSequence><DAMethod><Name>Ladder</Name></DAMethod><DAMethod><Name>Alignment</Name></DAMethod>'
+            '</DALadderSequence><UISetpoints><Zoom>1</Zoom></UISetpoints></AssayBody>') % (
+                ''.join('<Sample><Name>Sample %d</Name><Comment>&lt;none&gt; &amp; "quoted"</Comment></Sample>' % (i)
+                        for i in range(1, samples + 1)))
+
+def chip(rng, number, samples, length, var_type):
+    raw_signals = ''.join(
+        '<Sample%d><HasData>true</HasData><Channel><HasData>true</HasData>%s</Channel></Sample%d>' % (
+            i, signal_data(rng, i, length, var_type), i) for i in range(1, samples + 1))
+    raw_signals += ('<Ladder><HasData>true</HasData>%s<Current><HasData>true</HasData>%s</Current>'
+                    '<Voltage><HasData>false</HasData></Voltage></Ladder>') % (
+                        signal_data(rng, 0, length, var_type), signal_data(rng, 0, length // 10 or 1, var_type))
+    script = "SetCurrent 1\r\nWait 'ladder'\r\n".encode('utf-16-le')
+    return ('<Chip><ID>CHIP%d</ID><AssayHeader><Title>DNA 1000</Title><Version>1.0</Version></AssayHeader>%s'
+            '<Script><AllowEdit>false</AllowEdit>%s</Script><ChipInformation><ChipType>DNA</ChipType></ChipInformation>'
+            '<Instrument><Name>DE12345</Name><Serial>DE12345</Serial></Instrument><RawSignals>%s</RawSignals>'
+            '<Files><File name="run.log"/></Files>%s<HasData>true</HasData>'
+            '<NumberOfAcquiredSamples>%d</NumberOfAcquiredSamples></Chip>') % (
+                number, assay_body(samples), packed("ScriptText", "LE_UI1", list(script)), raw_signals,
+                packed("Packet", "LE_UI1", [1, 2, 3]), length)
+
+def data_xml(rng, chips, samples, length, var_type):
+    return ('﻿<?xml version="1.0" encoding="utf-16"?><Chipset><FileType>ChipData</FileType><Type>Assay</Type>'
+            '<Class>DNA</Class><Method><Name>DNA 1000</Name></Method><Chips>%s</Chips>'
+            '<LogBook><Entry time="0">Run started</Entry></LogBook><DataType>Signals</DataType>'
+            '<ExternalLinks></ExternalLinks><PersistSampleSignals>true</PersistSampleSignals></Chipset>') % (
+                ''.join(chip(rng, number, samples, length, var_type) for number in range(chips)))
+
+def header(uncompressed_length, compressed_length):
+    """The 76 byte header: five little-endian integers and "XceedSCO,10" in UTF-16."""
+    return struct.pack('<5I', 2, 79, uncompressed_length, compressed_length, 10) + "XceedSCO,10".encode('utf-16-le').ljust(56, b'\0')
+
+def wrap(text, width=76):
+    return '\n'.join(text[i:i + width] for i in range(0, len(text), width))
+
+def write_xad(path, chips=2, samples=3, length=1000, var_type="LE_R4", seed=1):
+    """Write a synthetic XAD file to path and return the length of its inflated data."""
+    rng = random.Random(seed)
+    data = data_xml(rng, chips, samples, length, var_type).encode('utf-16-le')
+    deflate = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = deflate.compress(data) + deflate.flush()
+    # the footer of real files is not understood; this one has the CRC-32 and
+    # length of the inflated data followed by a NUL
+    footer = struct.pack('<II', zlib.crc32(data), len(data)) + b'\0'
+    compressed_data = wrap(b64encode(header(len(data), len(body)) + body + footer).decode('ascii'))
+    preview_xml = ('<?xml version="1.0"?>\r\n<Preview><Title>Synthetic</Title><ChipInfo><Table/></ChipInfo>'
+                   '<SamplesInfo><Table/></SamplesInfo><GelImage>%s</GelImage></Preview>') % (
+                       b64encode(b'\x89PNG\r\n\x1a\n' + bytes(rng.randrange(256) for _ in range(64))).decode('ascii'))
+    preview = ('宐\x01' + preview_xml + '\0').encode('utf-16-le')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        f.write('<!--Do not edit this header information:%s:%s-->\n' % (HEADER_UUID, b64encode(header(56, 53) + b'\x01\x02').decode('ascii')))
+        f.write('<!--Do not edit this preview infomation:%s:%s-->\n' % (PREVIEW_UUID, wrap(b64encode(preview).decode('ascii'))))
+        f.write('<!--Do not edit this comment tag:%s:10:äääää㌲ää-->\n' % (TAG_UUID))
+        f.write('<compressed_data>%s</compressed_data>\n' % (compressed_data))
+    return len(data)
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic XAD file')
+    parser.add_argument('output', help='the XAD file to write')
+    parser.add_argument('--chips', type=int, default=2, help='number of chips (default: %(default)s)')
+    parser.add_argument('--samples', type=int, default=3, help='number of samples per chip, besides the ladder (default: %(default)s)')
+    parser.add_argument('--length', type=int, default=1000, help='number of values per signal (default: %(default)s)')
+    parser.add_argument('--vartype', choices=sorted(VAR_TYPES), default="LE_R4", help='vartype of the RawSignal values (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the random signal values (default: %(default)s)')
+    args = parser.parse_args()
+    write_xad(args.output, args.chips, args.samples, args.length, args.vartype, args.seed)
+
+if __name__ == "__main__":
+    main()
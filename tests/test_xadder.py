@@ -0,0 +1,262 @@
+################################################################################
+# Copyright (c) 2017 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+"""Tests of xadder on synthetic XAD files written by benchmarks/mkxad.py.
+
+    python -m pytest -q tests
+"""
+import io
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+from base64 import b64decode, b64encode
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+import xadder
+import mkxad
+
+COMPRESSED_DATA = re.compile(rb'(<compressed_data>)(.*?)(</compressed_data>)', flags=re.DOTALL)
+
+@pytest.fixture
+def xad_file(tmp_path):
+    path = tmp_path / "chip.xad"
+    mkxad.write_xad(str(path), chips=2, samples=3, length=200)
+    return str(path)
+
+def rewrite_compressed_data(xad_file, path, transform):
+    """Write xad_file to path with its decoded compressed_data replaced by transform(decoded)."""
+    with open(xad_file, 'rb') as f:
+        data = f.read()
+    match = COMPRESSED_DATA.search(data)
+    decoded = transform(b64decode(match.group(2)))
+    with open(path, 'wb') as f:
+        f.write(data[:match.start(2)] + mkxad.wrap(b64encode(decoded).decode('ascii')).encode('ascii') + data[match.end(2):])
+    return str(path)
+
+def signal_texts(document):
+    """Return the base64 text of the RawSignal of each signal of document, keyed by (chip, set, trace, channel)."""
+    return {(position, raw_signal_set.name, trace, channel): signal.raw_signal.text()
+            for position, chip in enumerate(document.chips)
+            for raw_signal_set, trace, channel, signal in xadder.iter_signals(chip)
+            if signal.raw_signal is not None}
+
+def run_xadder(*args):
+    return subprocess.run([sys.executable, str(ROOT / "xadder.py")] + [str(arg) for arg in args],
+                          capture_output=True, text=True, cwd=str(ROOT))
+
+# selection (--select)
+
+def test_compile_selection_unanchored_matches_every_signal():
+    tree = xadder.compile_selection(["SignalData/RawSignal"])
+    assert tree["Chipset"]["Chips"]["Chip"]["RawSignals"]["*"]["SignalData"]["RawSignal"] is True
+    assert tree["Chipset"]["Chips"]["Chip"]["RawSignals"]["*"]["Channel"]["SignalData"]["RawSignal"] is True
+
+def test_compile_selection_rejects_unknown_and_wildcard_first():
+    with pytest.raises(xadder.InvalidSelection):
+        xadder.compile_selection(["Chip/NoSuchElement"])
+    with pytest.raises(xadder.InvalidSelection):
+        xadder.compile_selection(["*/RawSignal"])
+
+def test_select_signals_of_every_sample(xad_file):
+    full = signal_texts(xadder.load_xad(xad_file))
+    selected = xadder.load_xad(xad_file, select=["Chip/ID", "SignalData/RawSignal"])
+    assert signal_texts(selected) == full
+    assert {name for _, name, _, _ in full} == {"Sample1", "Sample2", "Sample3", "Ladder"}
+    assert all(chip.assay_header is None for chip in selected.chips)
+
+def test_select_wildcard_matches_one_level(xad_file):
+    selected = xadder.load_xad(xad_file, select=["Chip/RawSignals/*/SignalData/RawSignal"])
+    assert {name for _, name, _, _ in signal_texts(selected)} == {"Ladder"}
+
+# cache
+
+def test_cache_round_trip_between_cli_and_library(xad_file, tmp_path):
+    cache_directory = tmp_path / "cache"
+    result = run_xadder("--cache", cache_directory, "--format", "jsonl", "--output-dir", tmp_path / "out", xad_file)
+    assert result.returncode == 0, result.stderr
+    entries = sorted(cache_directory.glob("v*/*/*.pickle"))
+    assert len(entries) == 1
+    assert b"__main__" not in entries[0].read_bytes()
+    cache = xadder.XadCache(cache_directory)
+    document = xadder.load_xad(xad_file, cache=cache)
+    assert sorted(cache_directory.glob("v*/*/*.pickle")) == entries
+    packed = document.chips[0].raw_signals[0].channels[0].raw_signal
+    # loaded from the cache as decoded bytes
+    assert packed.encoded is None and packed.decoded is not None
+    assert signal_texts(document) == signal_texts(xadder.load_xad(xad_file))
+    # and the library's entry is used by the CLI, giving the same output
+    again = run_xadder("--cache", cache_directory, "--format", "jsonl", "--output-dir", tmp_path / "again", xad_file)
+    assert again.returncode == 0, again.stderr
+    assert (tmp_path / "again" / "chip.jsonl").read_bytes() == (tmp_path / "out" / "chip.jsonl").read_bytes()
+
+def test_cache_eviction_leaves_other_directories(tmp_path):
+    (tmp_path / "videos" / "precious").mkdir(parents=True)
+    (tmp_path / "v1").mkdir()
+    (tmp_path / "v0").mkdir()
+    (tmp_path / "v0" / xadder.CACHE_MARKER).touch()
+    xadder.XadCache(tmp_path).put("uuid", "digest", {})
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(["v%d" % (xadder.CACHE_VERSION), "v1", "videos"])
+
+# sidecar index
+
+def test_index_lookup_equals_full_parse(xad_file):
+    xadder.write_index(xadder.build_index(xad_file, 4096), xadder.index_path(xad_file))
+    index = xadder.read_index(xadder.index_path(xad_file))
+    expected = signal_texts(xadder.load_xad(xad_file))
+    assert {key[:4] for key in index.entries if key[4] == "raw_signal"} == set(expected)
+    for key, text in expected.items():
+        assert xadder.read_indexed_values(xad_file, index, *key).text() == text
+
+def test_index_keys_chips_by_position(tmp_path, monkeypatch):
+    chip = mkxad.chip
+    monkeypatch.setattr(mkxad, "chip", lambda rng, number, *args: re.sub(
+        r'<ID>CHIP\d+</ID>', '<ID>SAME</ID>', chip(rng, number, *args)))
+    path = str(tmp_path / "same.xad")
+    mkxad.write_xad(path, chips=2, samples=1, length=50)
+    index = xadder.build_index(path)
+    assert {key[0] for key in index.entries} == {0, 1}
+    assert {entry.chip_id for entry in index.entries.values()} == {"SAME"}
+
+def test_stale_index_is_not_used(xad_file, tmp_path):
+    index = xadder.build_index(xad_file, 4096)
+    key = next(iter(index.entries))
+    # the same size, with another checksum in the footer
+    rewrite_compressed_data(xad_file, xad_file, lambda decoded: decoded[:-9] + bytes([decoded[-9] ^ 1]) + decoded[-8:])
+    assert os.path.getsize(xad_file) == index.size
+    with pytest.raises(xadder.Error):
+        xadder.read_indexed_values(xad_file, index, *key)
+
+# --verify
+
+def verify(*xad_files):
+    out = io.StringIO()
+    failures = xadder.verify_xad_files(list(xad_files), jobs=1, out=out)
+    return failures, dict(line.split(": ", 1) for line in out.getvalue().splitlines())
+
+def test_verify_ok(xad_file):
+    failures, results = verify(xad_file)
+    assert failures == 0
+    assert results[xad_file].startswith("ok (footer: crc32 of inflated data")
+
+def test_verify_fails_footer_with_wrong_checksum(xad_file, tmp_path):
+    corrupt = rewrite_compressed_data(xad_file, tmp_path / "corrupt.xad",
+                                      lambda decoded: decoded[:-9] + bytes([decoded[-9] ^ 1]) + decoded[-8:])
+    failures, results = verify(corrupt)
+    assert failures == 1
+    assert results[corrupt].startswith("failed: footer gives the length of the inflated data")
+
+def test_verify_warns_on_unknown_footer(xad_file, tmp_path):
+    unknown = rewrite_compressed_data(xad_file, tmp_path / "unknown.xad", lambda decoded: decoded[:-9] + b'\1' * 9)
+    failures, results = verify(unknown)
+    assert failures == 0
+    assert results[unknown].startswith("warning: footer matches no known layout")
+
+def test_verify_fails_truncated_deflate_stream(xad_file, tmp_path):
+    truncated = rewrite_compressed_data(xad_file, tmp_path / "truncated.xad",
+                                        lambda decoded: decoded[:len(decoded) // 2] + decoded[-9:])
+    failures, results = verify(truncated)
+    assert failures == 1
+    assert "deflate stream is truncated" in results[truncated]
+
+# structured output writers
+
+@pytest.fixture
+def non_finite_document(tmp_path, monkeypatch):
+    random_values = mkxad.random_values
+    def values(rng, var_type, length):
+        values = random_values(rng, var_type, length)
+        if var_type == "LE_R4":
+            values[:3] = [float('nan'), float('inf'), float('-inf')]
+        return values
+    monkeypatch.setattr(mkxad, "random_values", values)
+    path = str(tmp_path / "nan.xad")
+    mkxad.write_xad(path, chips=1, samples=1, length=10)
+    document = xadder.load_xad(path)
+    document.chips[0].raw_signals[0].channels[0].alignment_bias = float('nan')
+    return document
+
+def write_document(writer_class, document, arrays="text"):
+    out = io.BytesIO()
+    writer = writer_class(out, arrays)
+    writer.start_document(document)
+    for chip in document.chips:
+        writer.add_chip(chip)
+    writer.end_document(document)
+    writer.flush()
+    return out.getvalue().decode('utf-8')
+
+def strict_json(line):
+    def reject(constant):
+        raise ValueError("non-standard JSON constant %s" % (constant))
+    return json.loads(line, parse_constant=reject)
+
+def test_json_lines_writes_non_finite_values_as_null(non_finite_document):
+    records = [strict_json(line) for line in write_document(xadder.JsonLinesWriter, non_finite_document).splitlines()]
+    signal = next(record for record in records if record["record"] == "signal" and record["signal_set"] == "Sample1")
+    assert signal["alignment_bias"] is None
+    assert signal["raw_signal"][:3] == [None, None, None]
+    assert all(math.isfinite(value) for value in signal["raw_signal"][3:])
+
+def test_tsv_writes_a_row_per_signal(non_finite_document):
+    lines = write_document(xadder.TsvWriter, non_finite_document).splitlines()
+    columns = lines[0].split('\t')
+    rows = [dict(zip(columns, line.split('\t'))) for line in lines[1:]]
+    assert all(len(line.split('\t')) == len(columns) for line in lines)
+    sample = next(row for row in rows if row["signal_set"] == "Sample1")
+    assert sample["raw_signal"].split(',')[:3] == ["nan", "inf", "-inf"]
+    assert sample["raw_signal_var_type"] == "LE_R4"
+
+# batch conversion
+
+def test_batch_conversion_leaves_no_output_of_failed_files(xad_file, tmp_path):
+    truncated = rewrite_compressed_data(xad_file, tmp_path / "truncated.xad",
+                                        lambda decoded: decoded[:int(len(decoded) * 0.8)] + decoded[-9:])
+    output_dir = tmp_path / "out"
+    assert xadder.convert_xad_files([xad_file, truncated], str(output_dir), jobs=1) == 1
+    assert sorted(path.name for path in output_dir.iterdir()) == ["chip.png", "chip.txt"]
+
+def test_batch_conversion_of_same_named_files(tmp_path):
+    for directory in ("a", "b"):
+        (tmp_path / directory).mkdir()
+        mkxad.write_xad(str(tmp_path / directory / "chip.xad"), chips=1, samples=1, length=20)
+    output_dir = tmp_path / "out"
+    assert xadder.convert_xad_files(xadder.expand_xad_paths([str(tmp_path)]), str(output_dir), jobs=1,
+                                    output_format="jsonl") == 0
+    assert sorted(str(path.relative_to(output_dir)) for path in output_dir.rglob('*') if path.is_file()) == [
+        "a/chip.jsonl", "a/chip.png", "b/chip.jsonl", "b/chip.png"]
+
+# aligned signal matrix
+
+@pytest.mark.skipif(xadder.numpy is None, reason="numpy is not installed")
+def test_aligned_signal_matrix_of_identical_axes(xad_file):
+    chip = xadder.load_xad(xad_file).chips[0]
+    matrix = xadder.aligned_signal_matrix(chip)
+    assert matrix.mask.all()
+    assert not xadder.numpy.isnan(matrix.values).any()
+    ladder = next(raw_signal_set for raw_signal_set in chip.raw_signals if raw_signal_set.name == "Ladder")
+    ladder.has_data = False
+    matrix = xadder.aligned_signal_matrix(chip)
+    assert list(matrix.mask) == [row[0] != "Ladder" for row in matrix.rows]
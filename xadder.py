@@ -18,13 +18,48 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 ################################################################################
 import argparse
-from xml.dom.minidom import parse, parseString
+from xml.dom.minidom import parseString
+import xml.parsers.expat
 import re
+import mmap
+import os
+import glob
+import time
+import json
+import math
+import io
+import shutil
+from contextlib import contextmanager, redirect_stdout, nullcontext
+from concurrent.futures import ProcessPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from binascii import hexlify
-from base64 import b64decode
+from base64 import b64decode, b64encode
 import zlib
+import sys
+import functools
+import itertools
+import hashlib
+import pickle
+import sqlite3
 import struct
+import asyncio
+from signal import SIGINT, SIGTERM
+import threading
+import collections
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import tracemalloc
+from array import array
+from bisect import bisect_right
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Error(Exception):
     """Base class for exceptions in this module."""
@@ -62,504 +97,4326 @@ class UnsupportedPackedValueType(Error):
     def __init__(self, var_type):
         self.var_type = var_type
 
+class InvalidSelection(Error):
+    """Exception raised when a selection path does not name any element of the data XML.
+
+    Attributes:
+        path -- the selection path
+        message -- why it is invalid
+    """
+
+    def __init__(self, path, message):
+        self.path = path
+        self.message = message
+
+class Record:
+    """Base class for the parsed XAD object model; unset fields are None."""
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError("%s has no fields %s" % (type(self).__name__, ', '.join(sorted(fields))))
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self).__name__, ' '.join(
+            "%s=%r" % (name, getattr(self, name)) for name in self.__slots__
+            if isinstance(getattr(self, name), (int, float))
+            or (isinstance(getattr(self, name), str) and len(getattr(self, name)) <= 80)))
+
+class Header(Record):
+    """The 76 byte header of the header comment and of compressed_data.
+
+    Attributes:
+        ints -- the five little-endian integers at the start of the header
+        text -- the string that follows them (e.g. "XceedSCO,10")
+        uuid -- the UUID of the header comment (None for compressed_data)
+        extra -- the bytes following the header in the header comment
+    """
+    __slots__ = ('ints', 'text', 'uuid', 'extra')
+
+class Preview(Record):
+    """The preview comment.
+
+    Attributes:
+        title -- the title
+        chip_info, samples_info -- the chip and sample tables as XML
+        chip_info_rows, samples_info_rows -- the rows of those tables, each a
+                                             dict of its attributes and of the
+                                             text of its child elements
+        gel_image -- the gel image (PNG)
+        gel_image_size -- the size in bytes of the gel image, even if it was skipped
+    """
+    __slots__ = ('uuid', 'preamble', 'title', 'chip_info', 'samples_info', 'chip_info_rows',
+                 'samples_info_rows', 'gel_image', 'gel_image_size')
+
+class PackedValues(Record):
+    """A packed array (e.g. a RawSignal) which is only decoded when values is first used.
+
+    Attributes:
+        var_type -- the vartype attribute (a key of PACKED_VALUE_TYPES)
+        num_values -- the numvalues attribute
+        offset -- the byte offset of the base64 text in the inflated data stream
+        length -- the length in bytes of the base64 text in the inflated data stream
+        encoded -- the base64 text, or None if it was not kept
+        source -- if the text was not kept, the PackedSource it is read back from
+        decoded -- if the text was not kept, the decoded bytes (as loaded from an XadCache)
+    """
+    __slots__ = ('var_type', 'num_values', 'offset', 'length', 'encoded', 'source', 'decoded')
+
+    def __len__(self):
+        return self.num_values
+
+    def text(self):
+        """Return the base64 text, reading it back through source if it was not kept."""
+        if self.encoded is not None:
+            return self.encoded
+        if self.decoded is not None:
+            return b64encode(self.decoded).decode('ascii')
+        if self.source is None:
+            raise Error("the text of these packed values was not kept")
+        return self.source.read(self.offset, self.length)
+
+    @property
+    def values(self):
+        """The decoded array (see unpack_values), cached by decode_packed_values."""
+        return decode_packed_values(self)
+
+class SignalData(Record):
+    """A <SignalData> element, with RawSignal and ScriptStep as PackedValues."""
+    __slots__ = ('has_data', 'alignment_bias', 'alignment_scale', 'channel_id', 'index',
+                 'max_value', 'min_value', 'name', 'number_of_samples', 'raw_signal',
+                 'script_step', 'unit_x', 'unit_y', 'x_max_visible_range',
+                 'x_min_visible_range', 'x_start', 'x_start_aligned', 'x_step',
+                 'x_step_aligned', 'y_max_visible_range', 'y_min_visible_range')
+
+class RawSignalSet(Record):
+    """A child of <RawSignals> (one per sample and the ladder), named after its element."""
+    __slots__ = ('name', 'has_data', 'signal_data', 'channels', 'current', 'voltage')
+
+    def __init__(self, **fields):
+        super().__init__(**fields)
+        if self.channels is None:
+            self.channels = []
+
+class Chip(Record):
+    """A <Chip> element.
+
+    Opaque subtrees (AssayHeader, Instrument, ...) are kept as XML strings and
+    assay_body maps the element names under <AssayBody> to their XML or text,
+    or to a nested dict for the DA*Setpoints and DALadderSequence sections.
+    """
+    __slots__ = ('id', 'assay_header', 'assay_body', 'script_allow_edit', 'script_text',
+                 'chip_information', 'instrument', 'com_port_settings', 'data_status',
+                 'raw_signals', 'files', 'diagnostics', 'packet', 'imported', 'has_data',
+                 'number_of_acquired_samples', 'packet_file_name')
+
+    def __init__(self, **fields):
+        super().__init__(**fields)
+        if self.assay_body is None:
+            self.assay_body = {}
+        if self.raw_signals is None:
+            self.raw_signals = []
+
+class XadDocument(Record):
+    """A parsed XAD file.
+
+    Attributes:
+        header -- the Header from the header comment
+        tag_uuid, tag_num, tag_blob -- the fields of the comment tag
+        preview -- the Preview from the preview comment
+        data_header -- the Header at the start of compressed_data
+        data_footer -- the 9 bytes at the end of compressed_data
+        file_type ... log_book -- the fields of <Chipset>
+        chips -- the Chip elements of <Chipset>
+        on_chip -- if set, called with each Chip as soon as it has been parsed
+                   instead of the chip being added to chips
+    """
+    __slots__ = ('header', 'tag_uuid', 'tag_num', 'tag_blob', 'preview', 'data_header',
+                 'data_footer', 'file_type', 'type', 'chipset_class', 'data_type',
+                 'external_links', 'persist_sample_signals', 'method', 'log_book',
+                 'chips', 'on_chip')
+
+    def __init__(self, **fields):
+        super().__init__(**fields)
+        if self.chips is None:
+            self.chips = []
+
+    def add_chip(self, chip):
+        if self.on_chip is not None:
+            self.on_chip(chip)
+        else:
+            self.chips.append(chip)
+
+class StageStats(Record):
+    """What a Profiler measured for one stage, summed over its calls.
+
+    Times are in seconds; the self times exclude those of the stages called
+    from within it.
+
+    Attributes:
+        calls -- number of times the stage was entered
+        wall, self_wall -- wall clock time
+        cpu, self_cpu -- CPU time of the process
+        bytes_in, bytes_out -- size of the data given to and produced by the stage
+        peak_traced -- peak of memory traced by tracemalloc during the stage (None unless tracing)
+    """
+    __slots__ = ('calls', 'wall', 'self_wall', 'cpu', 'self_cpu', 'bytes_in', 'bytes_out', 'peak_traced')
+
+def data_size(data):
+    """Return the size in bytes of data (a str, a buffer such as bytes or an array, or else 0)."""
+    if data is None:
+        return 0
+    if isinstance(data, str):
+        return len(data)
+    try:
+        with memoryview(data) as view:
+            return view.nbytes
+    except TypeError:
+        return 0
+
+class Profiler:
+    """Measures the time, data sizes and (optionally) memory of each stage of parsing.
+
+    A profiler only sees the stages run while it is active (see profiling()).
+    If on_stage is given, it is called with (stage name, wall time, CPU time,
+    bytes in, bytes out) after each call of a stage, e.g. to feed a metrics
+    system. With trace_memory, tracemalloc is used to record the peak memory
+    of each stage, which slows everything down considerably.
+    """
+
+    def __init__(self, on_stage=None, trace_memory=False):
+        self.on_stage = on_stage
+        self.trace_memory = trace_memory
+        self.stages = {}
+        # total wall clock and CPU time while active
+        self.wall = 0.0
+        self.cpu = 0.0
+        # each frame is [stage name, wall start, CPU start, wall of children, CPU of children, peak of children]
+        self._stack = []
+        self._started = None
+        self._started_tracing = False
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._started = (time.perf_counter(), time.process_time())
+
+    def stop(self):
+        wall, cpu = self._started
+        self.wall += time.perf_counter() - wall
+        self.cpu += time.process_time() - cpu
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def begin(self, name):
+        """Start a call of stage name, which end() finishes; calls nest."""
+        if self.trace_memory:
+            if self._stack:
+                frame = self._stack[-1]
+                frame[5] = max(frame[5], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._stack.append([name, time.perf_counter(), time.process_time(), 0.0, 0.0, 0])
+
+    def end(self, bytes_in=0, bytes_out=0):
+        """Finish the innermost call started by begin(), with the given data sizes."""
+        name, wall, cpu, child_wall, child_cpu, child_peak = self._stack.pop()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats(calls=0, wall=0.0, self_wall=0.0, cpu=0.0, self_cpu=0.0, bytes_in=0, bytes_out=0)
+        stats.calls += 1
+        stats.wall += wall
+        stats.self_wall += wall - child_wall
+        stats.cpu += cpu
+        stats.self_cpu += cpu - child_cpu
+        stats.bytes_in += bytes_in
+        stats.bytes_out += bytes_out
+        if self._stack:
+            parent = self._stack[-1]
+            parent[3] += wall
+            parent[4] += cpu
+        if self.trace_memory:
+            peak = max(tracemalloc.get_traced_memory()[1], child_peak)
+            stats.peak_traced = max(stats.peak_traced or 0, peak)
+            if self._stack:
+                self._stack[-1][5] = max(self._stack[-1][5], peak)
+        if self.on_stage is not None:
+            self.on_stage(name, wall, cpu, bytes_in, bytes_out)
+
+    def suspend(self, count):
+        """Take the innermost count calls off the stack, not measuring time until they are given to resume().
+
+        This is for stages which span several calls of another stage, such as
+        the sections of the data XML which span several calls of the parser.
+        """
+        if not count:
+            return []
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        frames = self._stack[-count:]
+        del self._stack[-count:]
+        for frame in frames:
+            # the time measured so far
+            frame[1] = wall - frame[1]
+            frame[2] = cpu - frame[2]
+        return frames
+
+    def resume(self, frames):
+        """Put the calls taken off by suspend() back on the stack."""
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        for frame in frames:
+            frame[1] = wall - frame[1]
+            frame[2] = cpu - frame[2]
+        self._stack.extend(frames)
+
+    def call(self, name, function, *args, bytes_in=0):
+        """Return function(*args), measured as stage name with the data_size() of the result as bytes out."""
+        self.begin(name)
+        result = None
+        try:
+            result = function(*args)
+            return result
+        finally:
+            self.end(bytes_in, data_size(result))
+
+    def wrap(self, name, function):
+        """Return function measured as stage name, with the len() of its first argument as bytes in."""
+        def measured(data, *args):
+            return self.call(name, function, data, *args, bytes_in=len(data))
+        return measured
+
+    def iterate(self, name, chunks, size=None, consumed=None):
+        """Generate the items of chunks, measuring the production of each as stage name.
+
+        The bytes out are size(item), by default the data_size() of the item.
+        If consumed (a CountingIterator over what chunks is produced from) is
+        given, the bytes in are what was taken from it to produce the item.
+        """
+        size = data_size if size is None else size
+        chunks = iter(chunks)
+        while True:
+            self.begin(name)
+            chunk = None
+            before = consumed.total if consumed is not None else 0
+            try:
+                chunk = next(chunks, None)
+            finally:
+                self.end(consumed.total - before if consumed is not None else 0, size(chunk) if chunk is not None else 0)
+            if chunk is None:
+                return
+            yield chunk
+
+    def report(self):
+        """Return what has been measured as a dict suitable for JSON."""
+        report = {"wall": self.wall, "cpu": self.cpu,
+                  "stages": {name: {field: getattr(stats, field) for field in StageStats.__slots__}
+                             for name, stats in self.stages.items()}}
+        if resource is not None:
+            # kilobytes on Linux
+            report["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return report
+
+class CountingIterator:
+    """Iterates over items, adding up their data_size() in total as they are taken."""
+
+    def __init__(self, items):
+        self._items = iter(items)
+        self.total = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self._items)
+        self.total += data_size(item)
+        return item
+
+# The Profiler measuring the stages being run, if any
+active_profiler = None
+
+@contextmanager
+def profiling(profiler):
+    """Make profiler the active profiler within the context."""
+    global active_profiler
+    previous = active_profiler
+    active_profiler = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        active_profiler = previous
+
 def handle_header(decoded_text):
     # 020000004f00000038000000350000000a00000058006300650065006400530043004f002c003100300000000000000000000000000000000000000000000000000000000000000000000000
     # 020000004f000000102c6700ff4a16000a00000058006300650065006400530043004f002c003100300000000000000000000000000000000000000000000000000000000000000000000000
-    header_int1 = int.from_bytes(decoded_text[0:4], byteorder='little')
-    print("have header_int1 %d" % (header_int1))
-    header_int2 = int.from_bytes(decoded_text[4:8], byteorder='little')
-    print("have header_int2 %d" % (header_int2))
-    header_int3 = int.from_bytes(decoded_text[8:12], byteorder='little')
-    print("have header_int3 %d" % (header_int3))
-    header_int4 = int.from_bytes(decoded_text[12:16], byteorder='little')
-    print("have header_int4 %d" % (header_int4))
-    header_int5 = int.from_bytes(decoded_text[16:20], byteorder='little')
-    print("have header_int5 %d" % (header_int5))
-    header_str1 = decoded_text[20:].decode('utf-16-le')
-    print("have header_str1 %s" % (header_str1))
-
-def xad_handle_comment(node):
-    data = node.nodeValue
+    ints = tuple(int.from_bytes(decoded_text[i:i + 4], byteorder='little') for i in range(0, 20, 4))
+    text = decoded_text[20:].decode('utf-16-le').rstrip('\0')
+    return Header(ints=ints, text=text)
+
+# Number of bytes at the start of a comment searched for what kind it is
+COMMENT_HEAD_SIZE = 256
+COMMENT_TAG = re.compile(b'.*comment tag:([0-9a-f-]+):([0-9]+):', flags=re.DOTALL)
+COMMENT_PREVIEW = re.compile(b'.*preview infor?mation:([0-9a-f-]+):', flags=re.DOTALL)
+COMMENT_HEADER = re.compile(b'.*header information:([0-9a-f-]+):', flags=re.DOTALL)
+
+def xad_handle_comment(document, data, gel_image=True):
+    """Fill in document from a comment at the top level of an XAD file; the gel image is skipped unless gel_image."""
+    head = bytes(data[:COMMENT_HEAD_SIZE])
     # Do not edit this comment tag:788956de-4f1b-46aa-8271-1048a2120d9f:10:äääää㌲ääãㄶäãä㍆ㄱä:ãääãä〰㉂ãã〸ããäã㈴ä
-    tag = re.match(b'.*comment tag:([0-9a-f-]+):([0-9]+):(.*)$', data.encode('utf-8'), flags=(re.DOTALL))
+    tag = COMMENT_TAG.match(head)
     if tag:
-        uuid = tag.group(1)
-        num = tag.group(2)
-        blob = tag.group(3)
-        print('UUID: %s NUM: %s BLOB: %s BLOB(hex): %s' % (uuid, num, blob, hexlify(blob)))
+        document.tag_uuid = tag.group(1).decode('ascii')
+        document.tag_num = int(tag.group(2))
+        document.tag_blob = bytes(data[tag.end():])
         return
 
     # Do not edit this preview infomation:368699c4-0f05-457b-afce-daa16d5dd037:kFsBADwAPwB4AG0AbAAgAHYAZQByAHMAaQBvAG4APQAiADEALgAwACIAPwA+AA0ACgA8AFAA\n...
-    preview = re.match(b'.*preview infor?mation:([0-9a-f-]+):(.*)', data.encode('utf-8'), flags=(re.DOTALL))
+    preview = COMMENT_PREVIEW.match(head)
     if preview:
-        uuid = preview.group(1)
-        preview_data = b64decode(preview.group(2).replace(b'\n', b'')).decode('utf-16-le')
-        # FIXME not sure what how this should be extracted - seems to be two bytes then a \000 or \001, then the XML
-        preview_match = re.match('(.*)[\000\001](.*)\000', preview_data, flags=(re.DOTALL))
-        if not preview_match:
-            print("preview_data: %s\n%s\n" % (preview_data[0:80], preview.group(2).hex()))
-            raise ParseFailure("failed to parse preview")
-        preview_preamble = preview_match.group(1).encode('utf-16-le')
-        preview_xml = preview_match.group(2).replace('\r\n','\n').replace('\r','\n')
-        print('Have preview %s with preamble %s' % (uuid, hexlify(preview_preamble)))
-        parse_preview_xml(preview_xml)
+        if not gel_image:
+            document.preview = parse_preview(preview.group(1).decode('ascii'), data[preview.end():])
+            return
+        gel_image = io.BytesIO()
+        document.preview = parse_preview(preview.group(1).decode('ascii'), data[preview.end():], gel_image)
+        if document.preview.gel_image is not None:
+            document.preview.gel_image = gel_image.getvalue()
         return
 
     # Do not edit this header information:f85b47ac-6be2-4de6-9164-a077e5a0b247:AgAAAE8AAAA4AAAANQAAAAoAAABYAGMAZQBlAGQAUwBDAE8ALAAxADAAAAAAAAAAAAAAAAAA\n...
-    header = re.match(b'.*header information:([0-9a-f-]+):(.*)', data.encode('utf-8'), flags=(re.DOTALL))
+    header = COMMENT_HEADER.match(head)
     if header:
-        uuid = header.group(1)
-        decoded = b64decode(header.group(2))
-        handle_header(decoded[0:76])
-        extra = decoded[76:]
-        print("have extra header: 0x%s" % (extra.hex()))
+        decoded = b64decode(bytes(data[header.end():]))
+        document.header = handle_header(decoded[0:76])
+        document.header.uuid = header.group(1).decode('ascii')
+        document.header.extra = decoded[76:]
         return
 
-    raise UnexpectedNodeError(node, "Unexpected comment node at XAD top-level")
+    raise UnexpectedNodeError(bytes(data[:80]), "Unexpected comment node at XAD top-level")
 
-def get_text(node):
-    if node.childNodes.length == 1:
-        child = node.childNodes.item(0)
-        if child.nodeType == node.TEXT_NODE:
-            return child.data
-        else:
-            raise UnexpectedNodeError(child, "Not a text node")
-    elif node.childNodes.length < 1:
-        return ""
-    else:
-        raise UnexpectedNodeError(node, "More than one child node")
+def parse_bool(text):
+    value = text.lower()
+    if value in ("true", "1"):
+        return True
+    if value in ("false", "0"):
+        return False
+    raise ValueError(text)
 
-def get_table(node):
-    if node.childNodes.length == 1:
-        child = node.childNodes.item(0)
-        if child.nodeName == "Table":
-            print("TODO: process table %s" % child)
-        else:
-            raise UnexpectedNodeError(child, "Not a Table node")
-    elif node.childNodes.length < 1:
-        raise UnexpectedNodeError(node, "Table missing children")
-    else:
-        raise UnexpectedNodeError(node, "More than one child node for table")
+# Elements of <Preview> holding a <Table>, and the fields of Preview they are stored in
+PREVIEW_TABLES = {"ChipInfo": ("chip_info", "chip_info_rows"), "SamplesInfo": ("samples_info", "samples_info_rows")}
 
-# FIXME args
-gel_image_filename = "gel_image.png"
-compressed_data_filename = "compressed.data"
-
-def handle_preview(node):
-    # [<DOM Element: Title at 0x7f0c344ab470>, <DOM Element: ChipInfo at 0x7f0c344ab5a0>, <DOM Element: SamplesInfo at 0x7f0c34034340>, <DOM Element: GelImage at 0x7f0c3403a508>]
-    for child in node.childNodes:
-        if child.nodeName == "Title":
-            print("Preview Title: %s" % get_text(child))
-        elif child.nodeName == "ChipInfo":
-            print("Preview ChipInfo: %s" % get_table(child))
-        elif child.nodeName == "SamplesInfo":
-            print("Preview SamplesInfo: %s" % get_table(child))
-        elif child.nodeName == "GelImage":
-            gel_image = b64decode(get_text(child))
-            print("Writing Gel Image to %s" % gel_image_filename)
-            with open(gel_image_filename, 'wb') as png:
-                png.write(gel_image)
-        else:
-            raise UnexpectedNodeError(child, "Unexpected node under <Preview> element")
-
-def parse_preview_xml(preview_xml):
-    preview = parseString(preview_xml)
-    preview.normalize
-    for node in preview.childNodes:
-        if node.nodeName == "Preview":
-            handle_preview(node)
-        else:
-            raise UnexpectedNodeError(node, "Unexpected node in embedded Preview XML document")
+# Most characters of text given to PreviewParser at a time
+PREVIEW_BUFFER_SIZE = 1 << 13
 
-def handle_dam_assay_setpoints(daas):
-    assert daas.nodeName == "DAMAssaySetpoints"
-    for child in daas.childNodes:
-        if child.nodeName == "xxx":
-            pass
-        else:
-            raise UnexpectedNodeError(child, "Unexpected node under <DAMAssaySetpoints> element")
-
-def handle_da_assay_setpoints(daas):
-    assert daas.nodeName == "DAAssaySetpoints"
-    for child in daas.childNodes:
-        if child.nodeName == "DAMAssaySetpoints":
-            handle_dam_assay_setpoints(child)
-        elif child.nodeName == "DAMAssayInfoCommon":
-            print("DAMAssayInfoCommon: %s" % (child.toxml()))
-        elif child.nodeName == "DAMAssayInfoMolecular":
-            print("DAMAssayInfoMolecular: %s" % (child.toxml()))
-        elif child.nodeName == "DAMDefaultAssayInfoMolecular":
-            print("DAMDefaultAssayInfoMolecular: %s" % (child.toxml()))
-        else:
-            raise UnexpectedNodeError(child, "Unexpected node under <DAAssaySetpoints> element")
-
-def handle_da_sample_setpoints(daas):
-    assert daas.nodeName == "DASampleSetpoints"
-    for child in daas.childNodes:
-        if child.nodeName == "DAMIntegrator":
-            print("DAMIntegrator: %s" % (get_text(child)))
-        elif child.nodeName == "DAMPeakManipulation":
-            print("DAMPeakManipulation: %s" % (child.toxml()))
-        elif child.nodeName == "DAMAlignment":
-            print("DAMAlignment: %s" % (child.toxml()))
-        elif child.nodeName == "DAMConcentration":
-            print("DAMConcentration: %s" % (child.toxml()))
-        elif child.nodeName == "DAMSizing":
-            print("DAMSizing: %s" % (child.toxml()))
-        elif child.nodeName == "DAMFragment":
-            print("DAMFragment: %s" % (child.toxml()))
-        elif child.nodeName == "DAMCoMigration":
-            print("DAMCoMigration: %s" % (child.toxml()))
-        elif child.nodeName == "DAMCalibration":
-            print("DAMCalibration: %s" % (child.toxml()))
-        elif child.nodeName == "DAMSmearAnalysis":
-            print("DAMSmearAnalysis: %s" % (child.toxml()))
-        elif child.nodeName == "DAMRollingBallA":
-            print("DAMRollingBallA: %s" % (child.toxml()))
-        elif child.nodeName == "DAMRollingBallB":
-            print("DAMRollingBallB: %s" % (child.toxml()))
-        elif child.nodeName == "DAMSpikeRejectionA":
-            print("DAMSpikeRejectionA: %s" % (child.toxml()))
-        elif child.nodeName == "DAMSpikeRejectionB":
-            print("DAMSpikeRejectionB: %s" % (child.toxml()))
-        elif child.nodeName == "DAMBaseline":
-            print("DAMBaseline: %s" % (child.toxml()))
-        elif child.nodeName == "DAMCommon":
-            print("DAMCommon: %s" % (child.toxml()))
-        elif child.nodeName == "DAMStandardCurve":
-            print("DAMStandardCurve: %s" % (child.toxml()))
-        elif child.nodeName == "DAMSavitzkyGolay":
-            print("DAMSavitzkyGolay: %s" % (child.toxml()))
-        elif child.nodeName == "DAMMarkerDetection":
-            print("DAMMarkerDetection: %s" % (child.toxml()))
-        elif child.nodeName == "DAMMarkerThreshold":
-            print("DAMMarkerThreshold: %s" % (child.toxml()))
-        elif child.nodeName == "DAMLowerMarkerPresent":
-            print("DAMLowerMarkerPresent: %s" % (get_text(child)))
-        elif child.nodeName == "DAMBaselineSubstractionOld":
-            print("DAMBaselineSubstractionOld: %s" % (child.toxml()))
-        elif child.nodeName == "DAMBaselineSubstractionGolovin":
-            print("DAMBaselineSubstractionGolovin: %s" % (get_text(child)))
-        elif child.nodeName == "DAMLinearStretchY":
-            print("DAMLinearStretchY: %s" % (get_text(child)))
-        elif child.nodeName == "DAMMasterMarkerDetectionRNA":
-            print("DAMMasterMarkerDetectionRNA: %s" % (get_text(child)))
-        elif child.nodeName == "DAMSystemPeakDetection":
-            print("DAMSystemPeakDetection: %s" % (get_text(child)))
-        elif child.nodeName == "DAMTimeShift":
-            print("DAMTimeShift: %s" % (get_text(child)))
-        elif child.nodeName == "DAMPrepareRowData":
-            print("DAMPrepareRowData: %s" % (get_text(child)))
-        elif child.nodeName == "DAMIntegrator2":
-            print("DAMIntegrator2: %s" % (child.toxml()))
-        elif child.nodeName == "DAMFragment2":
-            print("DAMFragment2: %s" % (get_text(child)))
-        elif child.nodeName == "DAMDynamicMarkerDetection":
-            print("DAMDynamicMarkerDetection: %s" % (child.toxml()))
-        elif child.nodeName == "DAMNoiseCalculation":
-            print("DAMNoiseCalculation: %s" % (child.toxml()))
-        elif child.nodeName == "DAMDeconvolution":
-            print("DAMDeconvolution: %s" % (child.toxml()))
-        elif child.nodeName == "DAMNoiseFlagging":
-            print("DAMNoiseFlagging: %s" % (child.toxml()))
-        elif child.nodeName == "DAMDetailing":
-            print("DAMDetailing: %s" % (child.toxml()))
-        elif child.nodeName == "DAMPeakPercentOfTotal":
-            print("DAMPeakPercentOfTotal: %s" % (child.toxml()))
-        elif child.nodeName == "DAMIntegrationRefinement":
-            print("DAMIntegrationRefinement: %s" % (child.toxml()))
-        elif child.nodeName == "DAMLDLCalculation":
-            print("DAMLDLCalculation: %s" % (child.toxml()))
-        else:
-            raise UnexpectedNodeError(child, "Unexpected node under <DASampleSetpoints> element")
+class PreviewParser:
+    """Incremental parser for the UTF-16-LE XML of the preview comment.
 
-def handle_da_ladder_sequence(dals):
-    assert dals.nodeName == "DALadderSequence"
-    for child in dals.childNodes:
-        if child.nodeName == "DAMethod":
-            print("DAMMethod: %s" % (child.toxml()))
-        else:
-            raise UnexpectedNodeError(child, "Unexpected node under <DALadderSequence> element")
-
-def handle_assay_body(assay_body):
-    assert assay_body.nodeName == "AssayBody"
-    for child in assay_body.childNodes:
-        if child.nodeName == "DAAssaySetpoints":
-            handle_da_assay_setpoints(child)
-        elif child.nodeName == "DASampleSequence":
-            print("DASampleSequence: %s" % (child.toxml()))
-        elif child.nodeName == "DASampleSetpoints":
-            handle_da_sample_setpoints(child)
-        elif child.nodeName == "DALadderSequence":
-            handle_da_ladder_sequence(child)
-        elif child.nodeName == "DALadderSetpoints":
-            print("DALadderSetpoints: %s" % (child.toxml()))
-        elif child.nodeName == "UISetpoints":
-            print("UISetpoints: %s" % (child.toxml()))
-        elif child.nodeName == "DADefaultSampleSequence":
-            print("DADefaultSampleSequence: %s" % (child.toxml()))
-        elif child.nodeName == "DADefaultSampleSetpoints":
-            print("DADefaultSampleSetpoints: %s" % (child.toxml()))
-        elif child.nodeName == "DADefaultLadderSequence":
-            print("DADefaultLadderSequence: %s" % (child.toxml()))
-        elif child.nodeName == "DADefaultLadderSetpoints":
-            print("DADefaultLadderSetpoints: %s" % (child.toxml()))
-        elif child.nodeName == "DAChipSequence":
-            print("DAChipSequence: %s" % (child.toxml()))
-        elif child.nodeName == "DAChipSetpoints":
-            print("DAChipSetpoints: %s" % (child.toxml()))
-        elif child.nodeName == "DADefaultChipSequence":
-            print("DADefaultChipSequence: %s" % (child.toxml()))
-        elif child.nodeName == "DADefaultChipSetpoints":
-            print("DADefaultChipSetpoints: %s" % (child.toxml()))
-        elif child.nodeName == "DefaultUISetPoints":
-            print("DefaultUISetPoints: %s" % (child.toxml()))
-        else:
-            raise UnexpectedNodeError(child, "Unexpected node under <AssayBody> element")
-
-def get_packed_values(packed_values):
-    assert packed_values.nodeType == packed_values.ELEMENT_NODE
-    num_values = int(packed_values.attributes.getNamedItem("numvalues").nodeValue)
-    var_type = packed_values.attributes.getNamedItem("vartype").nodeValue
-    if var_type == "LE_R4":
-        unpack_format = 'f'
-    elif var_type == "LE_I2":
-        unpack_format = 'h'
-    elif var_type == "LE_UI1":
-        unpack_format = 'B'
-    else:
+    The base64 of <GelImage> is decoded into gel_image (a binary file) as
+    it is read, and skipped if gel_image is None; preview.gel_image is then
+    set to True if there is a gel image, rather than to its contents. Its
+    size is counted from the length of the base64 either way. The
+    tables are kept both as XML (as written by xml.dom.minidom) and as rows,
+    unless tables is false. No tree of the document is ever built.
+    """
+
+    def __init__(self, preview, gel_image=None, tables=True):
+        self._preview = preview
+        self._gel_image = gel_image
+        self._tables = tables
+        # names of the open elements
+        self._path = []
+        # text of <Title> or serialized XML of a table, None when not collected
+        self._parts = None
+        # whether the last start tag of a table is still open, so that an empty element is written as <name/>
+        self._open = False
+        # base64 of the gel image not decoded yet
+        self._carry = ''
+        # number of base64 characters and of padding characters of the gel image
+        self._base64_length = 0
+        self._padding = 0
+        # [rows, current row, text of current cell] of a table
+        self._rows = None
+        self._parser = xml.parsers.expat.ParserCreate('UTF-16LE')
+        # the gel image is decoded in large pieces
+        self._parser.buffer_text = True
+        self._parser.buffer_size = PREVIEW_BUFFER_SIZE
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+        self._parser.CharacterDataHandler = self._character_data
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+    def close(self):
+        self._parser.Parse(b'', True)
+
+    def _start_element(self, name, attributes):
+        depth = len(self._path)
+        self._path.append(name)
+        if depth == 0:
+            if name != "Preview":
+                raise UnexpectedNodeError(name, "Unexpected node in embedded Preview XML document")
+        elif depth == 1:
+            if name == "Title":
+                self._parts = []
+            elif name == "GelImage":
+                self._preview.gel_image = True
+            elif name in PREVIEW_TABLES:
+                if self._tables:
+                    self._parts = []
+                    self._rows = [[], None, None]
+            else:
+                raise UnexpectedNodeError(name, "Unexpected node under <Preview> element")
+        elif self._path[1] not in PREVIEW_TABLES:
+            raise UnexpectedNodeError(name, "Unexpected element in text of <%s> element" % (self._path[1]))
+        elif depth == 2 and name != "Table":
+            raise UnexpectedNodeError(name, "Not a Table node")
+        elif depth == 2 and self._parts:
+            raise UnexpectedNodeError(name, "More than one child node for table")
+        elif self._parts is not None:
+            if self._open:
+                self._parts.append('>')
+            self._parts.append('<' + name)
+            for key, value in attributes.items():
+                self._parts.append(' %s="%s"' % (key, escape_xml(value)))
+            self._open = True
+            # each child of <Table> is a row, whose attributes and children are its cells
+            if depth == 3:
+                self._rows[1] = dict(attributes)
+            elif depth == 4:
+                self._rows[2] = []
+
+    def _end_element(self, name):
+        depth = len(self._path) - 1
+        self._path.pop()
+        if depth == 1:
+            if name == "Title":
+                self._preview.title = ''.join(self._parts)
+                self._parts = None
+            elif name == "GelImage":
+                if self._gel_image is not None and self._carry:
+                    self._gel_image.write(b64decode(self._carry))
+                self._carry = ''
+                self._preview.gel_image_size = self._base64_length // 4 * 3 - self._padding
+            elif self._parts is not None:
+                if not self._parts:
+                    raise UnexpectedNodeError(name, "Table missing children")
+                xml_field, rows_field = PREVIEW_TABLES[name]
+                setattr(self._preview, xml_field, ''.join(self._parts))
+                setattr(self._preview, rows_field, self._rows[0])
+                self._parts = self._rows = None
+        elif depth >= 2 and self._parts is not None:
+            self._parts.append('/>' if self._open else '</%s>' % (name))
+            self._open = False
+            if depth == 3:
+                self._rows[0].append(self._rows[1])
+            elif depth == 4:
+                self._rows[1][name] = ''.join(self._rows[2]).strip()
+                self._rows[2] = None
+
+    def _character_data(self, data):
+        depth = len(self._path)
+        if depth == 2 and self._path[1] == "GelImage":
+            self._base64_length += len(data) - sum(data.count(space) for space in ' \t\r\n')
+            self._padding += data.count('=')
+            if self._gel_image is not None:
+                data = self._carry + ''.join(data.split())
+                usable = len(data) - len(data) % 4
+                self._carry = data[usable:]
+                if usable:
+                    self._gel_image.write(b64decode(data[:usable]))
+        elif depth == 2 and self._path[1] == "Title":
+            self._parts.append(data)
+        elif depth > 2 and self._parts is not None:
+            if self._open:
+                self._parts.append('>')
+                self._open = False
+            self._parts.append(escape_xml(data))
+            if depth == 5 and self._rows[2] is not None:
+                self._rows[2].append(data)
+        elif depth <= 2 and data.strip():
+            raise UnexpectedNodeError("#text", "Unexpected text under <%s> element" % (self._path[-1]))
+
+# Longest preamble seen before the preview XML, in bytes
+PREVIEW_PREAMBLE_SIZE = 16
+
+def parse_preview(uuid, encoded, gel_image=None, tables=True):
+    """Return the Preview of the base64 text of a preview comment, decoding it as a stream.
+
+    The gel image and tables are handled as by PreviewParser.
+    """
+    preview = Preview(uuid=uuid)
+    parser = PreviewParser(preview, gel_image, tables)
+    pending = b''
+    for chunk in b64decode_chunks(encoded):
+        pending += chunk
+        if preview.preamble is None:
+            # FIXME not sure what how this should be extracted - seems to be two bytes then a \000 or \001, then the XML
+            for offset in range(2, min(len(pending), PREVIEW_PREAMBLE_SIZE + 2) - 1, 2):
+                if pending[offset:offset + 2] == b'<\0' and pending[offset - 2:offset] in (b'\0\0', b'\1\0'):
+                    preview.preamble = pending[:offset - 2]
+                    pending = pending[offset:]
+                    break
+            else:
+                if len(pending) >= PREVIEW_PREAMBLE_SIZE + 2:
+                    raise ParseFailure("failed to parse preview: %r" % (pending[:80]))
+                continue
+        # the XML is followed by a NUL, which is held back until it is known to be the last character
+        usable = len(pending) - len(pending) % 2
+        while usable and pending[usable - 2:usable] == b'\0\0':
+            usable -= 2
+        parser.feed(pending[:usable])
+        pending = pending[usable:]
+    if preview.preamble is None:
+        raise ParseFailure("failed to parse preview: %r" % (pending[:80]))
+    parser.close()
+    return preview
+
+def extract_preview(xad_file, gel_image=None, tables=True):
+    """Return the Preview of xad_file, reading nothing after its preview comment.
+
+    The gel image is written to gel_image (a path or a binary file) as it is
+    decoded rather than kept, and skipped if gel_image is None.
+    """
+    with map_xad_file(xad_file) as view:
+        for name, data in split_xad(view, leading_only=True):
+            if name != "#comment":
+                break
+            preview = COMMENT_PREVIEW.match(bytes(data[:COMMENT_HEAD_SIZE]))
+            if preview:
+                uuid = preview.group(1).decode('ascii')
+                if isinstance(gel_image, (str, Path)):
+                    with atomic_write(gel_image, 'wb') as f:
+                        parsed = parse_preview(uuid, data[preview.end():], f, tables)
+                    if parsed.gel_image is None:
+                        os.unlink(gel_image)
+                    return parsed
+                return parse_preview(uuid, data[preview.end():], gel_image, tables)
+    return None
+
+# Supported vartypes of packed values: NumPy dtype, array typecode and item size
+PACKED_VALUE_TYPES = {
+    "LE_R4": ('<f4', 'f', 4),
+    "LE_I2": ('<i2', 'h', 2),
+    "LE_UI1": ('u1', 'B', 1),
+}
+
+def unpack_values(decoded, var_type, num_values):
+    """Return the num_values packed little-endian values of var_type in decoded as an array.
+
+    With NumPy this is a read-only ndarray sharing the memory of decoded,
+    otherwise an array.array.
+    """
+    try:
+        dtype, typecode, size = PACKED_VALUE_TYPES[var_type]
+    except KeyError:
         raise UnsupportedPackedValueType(var_type)
-    encoded = get_text(packed_values)
-    decoded = b64decode(encoded)
-    values = struct.unpack('<%d%s' % (num_values, unpack_format), decoded)
-    assert len(values) == num_values
+    if len(decoded) != num_values * size:
+        raise ParseFailure("%d bytes of %s data do not hold %d values" % (len(decoded), var_type, num_values))
+    if numpy is not None:
+        return numpy.frombuffer(decoded, dtype=dtype)
+    values = array(typecode, decoded)
+    if size > 1 and sys.byteorder != 'little':
+        values.byteswap()
     return values
 
-def handle_voltage(name, voltage):
-    assert voltage.nodeName == "Voltage"
-    for child in voltage.childNodes:
-        if child.nodeName == "HasData":
-            print("%s HasData: %s" % (name, get_text(child)))
-        elif child.nodeName == "SignalData":
-            handle_signal_data("%s Voltage" % name, child)
-        else:
-            raise UnexpectedNodeError(child, "Unexpected node under %s Voltage element" % (name))
-
-def handle_current(name, current):
-    assert current.nodeName == "Current"
-    for child in current.childNodes:
-        if child.nodeName == "HasData":
-            print("%s HasData: %s" % (name, get_text(child)))
-        elif child.nodeName == "SignalData":
-            handle_signal_data("%s Current" % name, child)
-        else:
-            raise UnexpectedNodeError(child, "Unexpected node under %s Current element" % (name))
-
-def handle_channel(name, channel):
-    assert channel.nodeName == "Channel"
-    for child in channel.childNodes:
-        if child.nodeName == "HasData":
-            print("%s HasData: %s" % (name, get_text(child)))
-        elif child.nodeName == "SignalData":
-            handle_signal_data("%s Channel" % name, child)
-        else:
-            raise UnexpectedNodeError(child, "Unexpected node under %s Channel element" % (name))
-
-def handle_signal_data(name, signal_data):
-    assert signal_data.nodeName == "SignalData"
-    for child in signal_data.childNodes:
-        if child.nodeName == "AlignmentBias":
-            print("%s AlignmentBias: %s" % (name, get_text(child)))
-        elif child.nodeName == "AlignmentScale":
-            print("%s AlignmentScale: %s" % (name, get_text(child)))
-        elif child.nodeName == "ChannelID":
-            print("%s ChannelID: %s" % (name, get_text(child)))
-        elif child.nodeName == "Index":
-            print("%s Index: %s" % (name, get_text(child)))
-        elif child.nodeName == "MaxValue":
-            print("%s MaxValue: %s" % (name, get_text(child)))
-        elif child.nodeName == "MinValue":
-            print("%s MinValue: %s" % (name, get_text(child)))
-        elif child.nodeName == "Name":
-            print("%s Name: %s" % (name, get_text(child)))
-        elif child.nodeName == "NumberOfSamples":
-            print("%s NumberOfSamples: %s" % (name, get_text(child)))
-        elif child.nodeName == "RawSignal":
-            print("%s RawSignal: %s" % (name, ','.join(map(str, get_packed_values(child)))))
-        elif child.nodeName == "ScriptStep":
-            print("%s ScriptStep: %s" % (name, ','.join(map(str, get_packed_values(child)))))
-        elif child.nodeName == "UnitX":
-            print("%s UnitX: %s" % (name, get_text(child)))
-        elif child.nodeName == "UnitY":
-            print("%s UnitY: %s" % (name, get_text(child)))
-        elif child.nodeName == "XMaxVisibleRange":
-            print("%s XMaxVisibleRange: %s" % (name, get_text(child)))
-        elif child.nodeName == "XMinVisibleRange":
-            print("%s XMinVisibleRange: %s" % (name, get_text(child)))
-        elif child.nodeName == "XStart":
-            print("%s XStart: %s" % (name, get_text(child)))
-        elif child.nodeName == "XStartAligned":
-            print("%s XStartAligned: %s" % (name, get_text(child)))
-        elif child.nodeName == "XStep":
-            print("%s XStep: %s" % (name, get_text(child)))
-        elif child.nodeName == "XStepAligned":
-            print("%s XStepAligned: %s" % (name, get_text(child)))
-        elif child.nodeName == "YMaxVisibleRange":
-            print("%s YMaxVisibleRange: %s" % (name, get_text(child)))
-        elif child.nodeName == "YMinVisibleRange":
-            print("%s YMinVisibleRange: %s" % (name, get_text(child)))
-        else:
-            raise UnexpectedNodeError(child, "Unexpected node under SignalData element")
-
-
-def handle_raw_signal_set(name, raw_signal_set):
-    assert raw_signal_set.nodeName == name
-    for child in raw_signal_set.childNodes:
-        if child.nodeName == "Channel":
-            handle_channel(name, child)
-        elif child.nodeName == "Current":
-            handle_current(name, child)
-        elif child.nodeName == "HasData":
-            print("%s HasData: %s" % (name, get_text(child)))
-        elif child.nodeName == "SignalData":
-            handle_signal_data(name, child)
-        elif child.nodeName == "Voltage":
-            handle_voltage(name, child)
-        else:
-            raise UnexpectedNodeError(child, "Unexpected node under %s element" % name)
-
-def handle_raw_signals(raw_signals):
-    assert raw_signals.nodeName == "RawSignals"
-    for child in raw_signals.childNodes:
-        handle_raw_signal_set(child.nodeName, child)
-
-def handle_script(name, script):
-    assert script.nodeName == "Script"
-    for child in script.childNodes:
-        if child.nodeName == "AllowEdit":
-            print("%s Script AllowEdit: %s" % (name, get_text(child)))
-        elif child.nodeName == "ScriptText":
-            print("%s ScriptText: '%s'" % (name, bytes(get_packed_values(child)).decode('utf-16-le').replace('\r','\\r').replace('\n','\\n').replace('\'', '\\\'')))
-        else:
-            raise UnexpectedNodeError(child, "Unexpected node under %s Script element" % name)
-
-
-def handle_chip(chip):
-    assert chip.nodeName == "Chip"
-    for child in chip.childNodes:
-        if child.nodeName == "ID":
-            print("Chip ID: %s" % (get_text(child)))
-        elif child.nodeName == "AssayHeader":
-            print("Chip AssayHeader: %s" % (child.toxml()))
-        elif child.nodeName == "AssayBody":
-            handle_assay_body(child)
-        elif child.nodeName == "Script":
-            handle_script("Chip", child)
-        elif child.nodeName == "ChipInformation":
-            print("ChipInformation: %s" % (child.toxml()))
-        elif child.nodeName == "Instrument":
-            print("Instrument: %s" % (child.toxml()))
-        elif child.nodeName == "ComPortSettings":
-            print("ComPortSettings: %s" % (child.toxml()))
-        elif child.nodeName == "DataStatus":
-            print("DataStatus: %s" % (child.toxml()))
-        elif child.nodeName == "RawSignals":
-            handle_raw_signals(child)
-        elif child.nodeName == "Files":
-            print("Files: %s" % (child.toxml()))
-        elif child.nodeName == "Diagnostics":
-            print("Diagnostics: %s" % (child.toxml()))
-        elif child.nodeName == "Packet":
-            print("Packet: %s" % (','.join(map(str, get_packed_values(child)))))
-        elif child.nodeName == "Imported":
-            print("Imported: %s" % (get_text(child)))
-        elif child.nodeName == "HasData":
-            print("HasData: %s" % (get_text(child)))
-        elif child.nodeName == "NumberOfAcquiredSamples":
-            print("NumberOfAcquiredSamples: %s" % (get_text(child)))
-        elif child.nodeName == "PacketFileName":
-            print("PacketFileName: %s" % (child.toxml()))
-        else:
-            raise UnexpectedNodeError(child, "Unexpected node under <Chip> element")
+# Number of decoded packed arrays kept by decode_packed_values
+PACKED_VALUES_CACHE_SIZE = 256
 
-def handle_chips(chips):
-    assert chips.nodeName == "Chips"
-    for child in chips.childNodes:
-        if child.nodeName == "Chip":
-            handle_chip(child)
+@functools.lru_cache(maxsize=PACKED_VALUES_CACHE_SIZE)
+def decode_packed_values(packed):
+    if active_profiler is not None:
+        if packed.encoded is not None:
+            size = len(packed.encoded)
+        elif packed.decoded is not None:
+            size = len(packed.decoded)
         else:
-            raise UnexpectedNodeError(child, "Unexpected node under <Chips> element")
-
-def handle_chipset(chipset):
-    assert chipset.nodeName == "Chipset"
-    for child in chipset.childNodes:
-        if child.nodeName == "Method":
-            print("Chipset Method: %s" % child.toxml())
-        elif child.nodeName == "Chips":
-            handle_chips(child)
-        elif child.nodeName == "LogBook":
-             print("Chipset LogBook: %s" % child.toxml())
-        elif child.nodeName == "FileType":
-            print("Chipset FileType: %s" % (get_text(child)))
-        elif child.nodeName == "Type":
-            print("Chipset Type: %s" % (get_text(child)))
-        elif child.nodeName == "Class":
-            print("Chipset Class: %s" % (get_text(child)))
-        elif child.nodeName == "DataType":
-            print("Chipset DataType: %s" % (get_text(child)))
-        elif child.nodeName == "ExternalLinks":
-            print("Chipset ExternalLinks: %s" % (get_text(child)))
-        elif child.nodeName == "PersistSampleSignals":
-            print("Chipset PersistSampleSignals: %s" % (get_text(child)))
+            size = packed.length // 2
+        return active_profiler.call("decode_packed_values", decode_packed_values_uncached, packed, bytes_in=size)
+    return decode_packed_values_uncached(packed)
+
+# Number of distinct blocks kept by intern_block
+BLOCK_INTERN_SIZE = 1024
+
+@functools.lru_cache(maxsize=BLOCK_INTERN_SIZE)
+def intern_block(block):
+    """Return the block equal to block which was first passed here, so that equal blocks share memory.
+
+    Used for the setpoints, methods and scripts which are the same in every
+    chip of an assay, across all the files parsed by the process.
+    """
+    return block
+
+def decode_packed_values_uncached(packed):
+    decoded = packed.decoded if packed.decoded is not None else b64decode(packed.text())
+    return unpack_values(decoded, packed.var_type, packed.num_values)
+
+def make_packed_values(attributes, encoded, offset=None, length=None, source=None):
+    """Return the PackedValues of an element with the given attributes and base64 text (None if read through source)."""
+    try:
+        num_values = int(attributes["numvalues"])
+        var_type = attributes["vartype"]
+    except (KeyError, ValueError):
+        raise ParseFailure("packed values without valid numvalues and vartype attributes: %r" % (attributes))
+    if var_type not in PACKED_VALUE_TYPES:
+        raise UnsupportedPackedValueType(var_type)
+    return PackedValues(var_type=var_type, num_values=num_values, offset=offset, length=length, encoded=encoded,
+                        source=source)
+
+def format_values(values):
+    return ','.join(map(str, values.tolist()))
+
+TEXT = "text"
+PACKED = "packed"
+OPAQUE = "opaque"
+SECTION = "section"
+# elements outside a selection, which are skipped by DataXmlParser
+SKIP = "skip"
+
+class ElementHandler(Record):
+    """How DataXmlParser handles one kind of element.
+
+    Attributes:
+        kind -- TEXT (a scalar converted from the element text), PACKED (a
+                PackedValues), OPAQUE (the subtree serialized as XML) or
+                SECTION (an element whose children are handled in turn)
+        store -- called with the object of the enclosing section and the
+                 value once the element is complete (for a SECTION, with its
+                 own object; may be None)
+        convert -- for TEXT, applied to the stripped text unless it is empty
+                   (None keeps the text as it is)
+        section -- for SECTION, the key of DATA_XML_SCHEMA for its children
+        create -- for SECTION, called with the element name to create the
+                  object its children are stored into (None shares the object
+                  of the enclosing section)
+        intern -- for OPAQUE and for TEXT without convert, whether equal
+                  values are shared through intern_block
+        decode -- for PACKED, whether store uses the values, so that their
+                  text is kept even if DataXmlParser is given a source
+    """
+    __slots__ = ('kind', 'store', 'convert', 'section', 'create', 'intern', 'decode')
+
+def set_field(name):
+    def store(obj, value):
+        setattr(obj, name, value)
+    return store
+
+def set_entry(key):
+    def store(entries, value):
+        entries[key] = value
+    return store
+
+def append_entry(key):
+    def store(entries, value):
+        entries.setdefault(key, []).append(value)
+    return store
+
+def text_field(store, convert=None, intern=False):
+    """An ElementHandler for a text element; store may be an attribute name or a function."""
+    return ElementHandler(kind=TEXT, store=set_field(store) if isinstance(store, str) else store, convert=convert,
+                          intern=intern and convert is None)
+
+def packed_field(store, decode=False):
+    """An ElementHandler for an element of packed values; store may be an attribute name or a function."""
+    return ElementHandler(kind=PACKED, store=set_field(store) if isinstance(store, str) else store, decode=decode)
+
+def opaque_field(store, intern=False):
+    """An ElementHandler keeping a subtree as XML; store may be an attribute name or a function."""
+    return ElementHandler(kind=OPAQUE, store=set_field(store) if isinstance(store, str) else store, intern=intern)
+
+def nested_section(section, create=None, store=None):
+    """An ElementHandler for an element whose children are handled by DATA_XML_SCHEMA[section]."""
+    return ElementHandler(kind=SECTION, section=section, create=create, store=store)
+
+def new_dict(name):
+    return {}
+
+def new_signal_data(name):
+    return SignalData()
+
+def add_raw_signal_set(chip, raw_signal_set):
+    chip.raw_signals.append(raw_signal_set)
+
+def add_channel(raw_signal_set, signal):
+    raw_signal_set.channels.append(signal)
+
+def set_script_text(chip, packed):
+    chip.script_text = intern_block(packed.values.tobytes().decode('utf-16-le'))
+
+# Handlers for the children of each section of the embedded Compressed Data
+# XML document; "*" matches any element without a handler of its own. The
+# setpoints, methods and settings which are the same in every chip of an
+# assay are interned.
+DATA_XML_SCHEMA = {
+    "#document": {
+        "Chipset": nested_section("Chipset"),
+    },
+    "Chipset": {
+        "Method": opaque_field("method", intern=True),
+        "Chips": nested_section("Chips"),
+        "LogBook": opaque_field("log_book"),
+        "FileType": text_field("file_type"),
+        "Type": text_field("type"),
+        "Class": text_field("chipset_class"),
+        "DataType": text_field("data_type"),
+        "ExternalLinks": text_field("external_links"),
+        "PersistSampleSignals": text_field("persist_sample_signals", parse_bool),
+    },
+    "Chips": {
+        "Chip": nested_section("Chip", create=lambda name: Chip(), store=XadDocument.add_chip),
+    },
+    "Chip": {
+        "ID": text_field("id"),
+        "AssayHeader": opaque_field("assay_header", intern=True),
+        "AssayBody": nested_section("AssayBody", create=new_dict, store=set_field("assay_body")),
+        "Script": nested_section("Script"),
+        "ChipInformation": opaque_field("chip_information", intern=True),
+        "Instrument": opaque_field("instrument", intern=True),
+        "ComPortSettings": opaque_field("com_port_settings", intern=True),
+        "DataStatus": opaque_field("data_status"),
+        "RawSignals": nested_section("RawSignals"),
+        "Files": opaque_field("files"),
+        "Diagnostics": opaque_field("diagnostics"),
+        "Packet": packed_field("packet"),
+        "Imported": text_field("imported", parse_bool),
+        "HasData": text_field("has_data", parse_bool),
+        "NumberOfAcquiredSamples": text_field("number_of_acquired_samples", int),
+        "PacketFileName": opaque_field("packet_file_name"),
+    },
+    "Script": {
+        "AllowEdit": text_field("script_allow_edit", parse_bool),
+        "ScriptText": packed_field(set_script_text, decode=True),
+    },
+    "AssayBody": dict(
+        [("DAAssaySetpoints", nested_section("DAAssaySetpoints", create=new_dict, store=set_entry("DAAssaySetpoints"))),
+         ("DASampleSetpoints", nested_section("DASampleSetpoints", create=new_dict, store=set_entry("DASampleSetpoints"))),
+         ("DALadderSequence", nested_section("DALadderSequence", create=new_dict, store=set_entry("DALadderSequence")))] +
+        [(name, opaque_field(set_entry(name), intern=name != "DASampleSequence")) for name in (
+            "DASampleSequence", "DALadderSetpoints", "UISetpoints", "DADefaultSampleSequence",
+            "DADefaultSampleSetpoints", "DADefaultLadderSequence", "DADefaultLadderSetpoints",
+            "DAChipSequence", "DAChipSetpoints", "DADefaultChipSequence", "DADefaultChipSetpoints",
+            "DefaultUISetPoints")]),
+    "DAAssaySetpoints": dict(
+        [("DAMAssaySetpoints", nested_section("DAMAssaySetpoints", create=new_dict, store=set_entry("DAMAssaySetpoints")))] +
+        [(name, opaque_field(set_entry(name), intern=True)) for name in (
+            "DAMAssayInfoCommon", "DAMAssayInfoMolecular", "DAMDefaultAssayInfoMolecular")]),
+    "DAMAssaySetpoints": {},
+    "DASampleSetpoints": dict(
+        [(name, text_field(set_entry(name), intern=True)) for name in (
+            "DAMIntegrator", "DAMLowerMarkerPresent", "DAMBaselineSubstractionGolovin",
+            "DAMLinearStretchY", "DAMMasterMarkerDetectionRNA", "DAMSystemPeakDetection",
+            "DAMTimeShift", "DAMPrepareRowData", "DAMFragment2")] +
+        [(name, opaque_field(set_entry(name), intern=True)) for name in (
+            "DAMPeakManipulation", "DAMAlignment", "DAMConcentration", "DAMSizing", "DAMFragment",
+            "DAMCoMigration", "DAMCalibration", "DAMSmearAnalysis", "DAMRollingBallA",
+            "DAMRollingBallB", "DAMSpikeRejectionA", "DAMSpikeRejectionB", "DAMBaseline",
+            "DAMCommon", "DAMStandardCurve", "DAMSavitzkyGolay", "DAMMarkerDetection",
+            "DAMMarkerThreshold", "DAMBaselineSubstractionOld", "DAMIntegrator2",
+            "DAMDynamicMarkerDetection", "DAMNoiseCalculation", "DAMDeconvolution",
+            "DAMNoiseFlagging", "DAMDetailing", "DAMPeakPercentOfTotal",
+            "DAMIntegrationRefinement", "DAMLDLCalculation")]),
+    "DALadderSequence": {
+        "DAMethod": opaque_field(append_entry("DAMethod"), intern=True),
+    },
+    "RawSignals": {
+        "*": nested_section("RawSignalSet", create=lambda name: RawSignalSet(name=name), store=add_raw_signal_set),
+    },
+    "RawSignalSet": {
+        "Channel": nested_section("SignalContainer", create=new_signal_data, store=add_channel),
+        "Current": nested_section("SignalContainer", create=new_signal_data, store=set_field("current")),
+        "HasData": text_field("has_data", parse_bool),
+        "SignalData": nested_section("SignalData", create=new_signal_data, store=set_field("signal_data")),
+        "Voltage": nested_section("SignalContainer", create=new_signal_data, store=set_field("voltage")),
+    },
+    "SignalContainer": {
+        "HasData": text_field("has_data", parse_bool),
+        "SignalData": nested_section("SignalData"),
+    },
+    "SignalData": {
+        "AlignmentBias": text_field("alignment_bias", float),
+        "AlignmentScale": text_field("alignment_scale", float),
+        "ChannelID": text_field("channel_id", int),
+        "Index": text_field("index", int),
+        "MaxValue": text_field("max_value", float),
+        "MinValue": text_field("min_value", float),
+        "Name": text_field("name"),
+        "NumberOfSamples": text_field("number_of_samples", int),
+        "RawSignal": packed_field("raw_signal"),
+        "ScriptStep": packed_field("script_step"),
+        "UnitX": text_field("unit_x"),
+        "UnitY": text_field("unit_y"),
+        "XMaxVisibleRange": text_field("x_max_visible_range", float),
+        "XMinVisibleRange": text_field("x_min_visible_range", float),
+        "XStart": text_field("x_start", float),
+        "XStartAligned": text_field("x_start_aligned", float),
+        "XStep": text_field("x_step", float),
+        "XStepAligned": text_field("x_step_aligned", float),
+        "YMaxVisibleRange": text_field("y_max_visible_range", float),
+        "YMinVisibleRange": text_field("y_min_visible_range", float),
+    },
+}
+
+def register_element(section, name, handler):
+    """Handle <name> elements in section (a key of DATA_XML_SCHEMA) with handler.
+
+    This can be used to support elements which would otherwise raise
+    UnexpectedNodeError, e.g. register_element("Chip", "NewSetting",
+    text_field(lambda chip, value: ...)); a new section is created as needed.
+    """
+    DATA_XML_SCHEMA.setdefault(section, {})[name] = handler
+
+def find_schema_paths(name, schema, sections=("#document",), prefix=()):
+    """Generate the paths of element names from the document root to each element called name in schema."""
+    for child, handler in schema.get(sections[-1], {}).items():
+        if child == name:
+            yield prefix + (child,)
+        if handler.kind is SECTION and handler.section not in sections:
+            yield from find_schema_paths(name, schema, sections + (handler.section,), prefix + (child,))
+
+def schema_matches(components, schema, section):
+    """Return whether the element names in components (which may be "*") can occur below section."""
+    if not components:
+        return True
+    children = schema.get(section, {})
+    if components[0] == "*":
+        handlers = children.values()
+    else:
+        handlers = [handler for handler in (children.get(components[0]) or children.get("*"),) if handler is not None]
+    for handler in handlers:
+        if handler.kind is SECTION:
+            if schema_matches(components[1:], schema, handler.section):
+                return True
+        elif len(components) == 1:
+            return True
+    return False
+
+def compile_selection(paths, schema=None):
+    """Return the tree of elements of the data XML selected by paths, for DataXmlParser.
+
+    Each path is a "/"-separated list of element names, in which "*" matches
+    any element, starting with an element of the schema which it is anchored
+    to wherever that element occurs (e.g. "SignalData/RawSignal" selects the
+    RawSignal of every signal, of the Ladder and of the samples alike, and "Chipset/Method"
+    only the Method of the Chipset). Everything below a selected element is
+    selected.
+
+    The tree maps element names (or "*") to the tree of their children, or to
+    True where the whole subtree is selected.
+    """
+    if schema is None:
+        schema = DATA_XML_SCHEMA
+    tree = {}
+    for path in paths:
+        components = tuple(component for component in path.split('/') if component)
+        if not components or components[0] == "*":
+            raise InvalidSelection(path, "selection %r must start with an element name" % (path))
+        anchors = [anchor for anchor in find_schema_paths(components[0], schema)
+                   if schema_matches(anchor + components[1:], schema, "#document")]
+        if not anchors:
+            raise InvalidSelection(path, "selection %r matches no element" % (path))
+        for anchor in anchors:
+            node = tree
+            for component in (anchor + components[1:])[:-1]:
+                node = node.setdefault(component, {})
+                if node is True:
+                    break
+            else:
+                node[components[-1]] = True
+    return tree
+
+def merge_selections(first, second):
+    if first is True or second is True:
+        return True
+    merged = dict(first)
+    for name, child in second.items():
+        merged[name] = merge_selections(merged[name], child) if name in merged else child
+    return merged
+
+def select_child(selection, name):
+    """Return the selection below the child called name: None if all of it, False if none of it."""
+    child = selection.get(name)
+    wildcard = selection.get("*")
+    if wildcard is not None:
+        child = wildcard if child is None else merge_selections(child, wildcard)
+    if child is None:
+        return False
+    return None if child is True else child
+
+def convert_text(name, text, convert):
+    if convert is None:
+        return text
+    text = text.strip()
+    if not text:
+        return None
+    try:
+        return convert(text)
+    except ValueError:
+        raise ParseFailure("invalid value %r for <%s>" % (text, name))
+
+def escape_xml(data):
+    # as written by xml.dom.minidom
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+class DataXmlParser:
+    """Incremental parser for the XML document inflated from <compressed_data>.
+
+    Inflated (UTF-16-LE) bytes are passed to feed() as they become available
+    and each element is dispatched through DATA_XML_SCHEMA as soon as it is
+    complete, so no tree of the document is ever built.
+
+    If select is given (see compile_selection), elements outside the selected
+    paths are skipped without being handled at all. With convert false, the
+    text of text elements is stored as it is, without being converted.
+
+    If source (a PackedSource) is given, the text of packed values is not
+    kept, only where it is, and it is read back through source when their
+    values are used.
+
+    Memory is bounded by the largest chip rather than by the file: a Chip is
+    only handed over once its end tag has been parsed, so everything kept
+    of it, including the base64 text of all its packed values, is held until
+    then. With source, only the positions of the packed values are held.
+    """
+
+    def __init__(self, document, schema=None, select=None, convert=True, source=None):
+        self._schema = DATA_XML_SCHEMA if schema is None else schema
+        self._convert = convert
+        self._source = source
+        selection = compile_selection(select, self._schema) if select else None
+        # each frame is [kind, ElementHandler, object, element name, text parts, state] where
+        # object is that of the section (SECTION) or the enclosing section (otherwise) and
+        # state is [children, selection, byte index of the start tag] for a SECTION, [attributes, text offset] for PACKED
+        # (whose text parts are None when the text is not kept),
+        # [depth, start tag open] for OPAQUE, whose text parts are the serialized XML, and
+        # the depth for SKIP
+        self._stack = [[SECTION, None, document, "#document", [], [self._schema["#document"], selection, 0]]]
+        self._profiler = active_profiler
+        # with a profiler, each section is measured as stage "handle <section>" from its
+        # start tag to its end tag; the calls of the stages of the sections open between
+        # calls of feed() are suspended (see Profiler.suspend)
+        self._open_sections = 0
+        self._suspended = []
+        self._parser = xml.parsers.expat.ParserCreate('UTF-16LE')
+        # unbuffered, so that CurrentByteIndex is that of each piece of text
+        self._parser.buffer_text = False
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+        self._parser.CharacterDataHandler = self._character_data
+
+    def feed(self, data):
+        self._parse(data, False)
+
+    def close(self):
+        self._parse(b'', True)
+
+    def _parse(self, data, final):
+        if self._profiler is None:
+            self._parser.Parse(data, final)
+            return
+        self._profiler.resume(self._suspended)
+        try:
+            self._parser.Parse(data, final)
+        finally:
+            self._suspended = self._profiler.suspend(self._open_sections)
+
+    def _check_section_text(self, frame):
+        if frame[4]:
+            if ''.join(frame[4]).strip():
+                raise UnexpectedNodeError("#text", "Unexpected text under <%s> element" % (frame[3]))
+            frame[4] = []
+
+    def _write_start_tag(self, frame, name, attributes):
+        parts = frame[4]
+        state = frame[5]
+        if state[1]:
+            parts.append('>')
+        parts.append('<' + name)
+        for key, value in attributes.items():
+            parts.append(' %s="%s"' % (key, escape_xml(value)))
+        state[0] += 1
+        state[1] = True
+
+    def _start_element(self, name, attributes):
+        frame = self._stack[-1]
+        kind = frame[0]
+        if kind is OPAQUE:
+            self._write_start_tag(frame, name, attributes)
+            return
+        if kind is SKIP:
+            frame[5] += 1
+            return
+        if kind is not SECTION:
+            raise UnexpectedNodeError(name, "Unexpected element in text of <%s> element" % (frame[3]))
+        self._check_section_text(frame)
+        children, selection, _ = frame[5]
+        if selection is not None:
+            selection = select_child(selection, name)
+            if selection is False:
+                self._stack.append([SKIP, None, None, name, None, 1])
+                return
+        handler = children.get(name) or children.get("*")
+        if handler is None:
+            raise UnexpectedNodeError(name, "Unexpected node under <%s> element" % (frame[3]))
+        kind = handler.kind
+        if kind is SECTION:
+            if self._profiler is not None:
+                self._profiler.begin("handle " + handler.section)
+                self._open_sections += 1
+            obj = frame[2] if handler.create is None else handler.create(name)
+            self._stack.append([SECTION, handler, obj, name, [], [self._schema[handler.section], selection,
+                                                                  self._parser.CurrentByteIndex]])
+        elif kind is OPAQUE:
+            opaque = [OPAQUE, handler, frame[2], name, [], [0, False]]
+            self._stack.append(opaque)
+            self._write_start_tag(opaque, name, attributes)
+        elif kind is PACKED:
+            parts = None if self._source is not None and not handler.decode else []
+            self._stack.append([PACKED, handler, frame[2], name, parts, [attributes, None]])
         else:
-            raise UnexpectedNodeError(child, "Unexpected node under <Chipset> element")
-
-def parse_data_xml(data_xml):
-    data = parseString(data_xml)
-    data.normalize
-    for node in data.childNodes:
-        if node.nodeName == "Chipset":
-            handle_chipset(node)
+            self._stack.append([kind, handler, frame[2], name, [], None])
+
+    def _end_element(self, name):
+        frame = self._stack[-1]
+        kind = frame[0]
+        if kind is SKIP:
+            frame[5] -= 1
+            if not frame[5]:
+                self._stack.pop()
+            return
+        if kind is OPAQUE:
+            state = frame[5]
+            frame[4].append('/>' if state[1] else '</%s>' % (name))
+            state[1] = False
+            state[0] -= 1
+            if state[0]:
+                return
+        self._stack.pop()
+        handler = frame[1]
+        if kind is SECTION:
+            self._check_section_text(frame)
+            if self._profiler is None:
+                if handler.store is not None:
+                    handler.store(self._stack[-1][2], frame[2])
+                return
+            try:
+                if handler.store is not None:
+                    handler.store(self._stack[-1][2], frame[2])
+            finally:
+                self._open_sections -= 1
+                self._profiler.end(self._parser.CurrentByteIndex - frame[5][2])
+        elif kind is OPAQUE:
+            value = ''.join(frame[4])
+            handler.store(frame[2], intern_block(value) if handler.intern else value)
+        elif kind is PACKED:
+            attributes, offset = frame[5]
+            if offset is None:
+                packed = make_packed_values(attributes, '')
+            elif frame[4] is None:
+                packed = make_packed_values(attributes, None, offset, self._parser.CurrentByteIndex - offset, self._source)
+            else:
+                packed = make_packed_values(attributes, ''.join(frame[4]), offset, self._parser.CurrentByteIndex - offset)
+            handler.store(frame[2], packed)
         else:
-            raise UnexpectedNodeError(node, "Unexpected node in embedded Compressed Data XML document")
+            value = convert_text(name, ''.join(frame[4]), handler.convert if self._convert else None)
+            handler.store(frame[2], intern_block(value) if handler.intern else value)
 
-def inflate(data):
+    def _character_data(self, data):
+        frame = self._stack[-1]
+        if frame[0] is SKIP:
+            return
+        if frame[0] is OPAQUE:
+            if frame[5][1]:
+                frame[4].append('>')
+                frame[5][1] = False
+            frame[4].append(escape_xml(data))
+            return
+        if frame[0] is PACKED:
+            if frame[5][1] is None:
+                frame[5][1] = self._parser.CurrentByteIndex
+            if frame[4] is None:
+                return
+        frame[4].append(data)
+
+def parse_data_xml(document, data_xml, select=None):
+    parser = DataXmlParser(document, select=select)
+    parser.feed(data_xml.encode('utf-16-le'))
+    parser.close()
+
+# Number of base64 characters of <compressed_data> decoded at a time
+BASE64_CHUNK_SIZE = 1 << 16
+# Upper bound on the number of bytes produced by each call to the inflater
+INFLATE_CHUNK_SIZE = 1 << 18
+COMPRESSED_DATA_HEADER_SIZE = 76
+COMPRESSED_DATA_FOOTER_SIZE = 9
+# Number of base64 characters at the end of compressed_data which cover its footer
+COMPRESSED_DATA_FOOTER_BASE64_SIZE = 16
+BASE64_WHITESPACE = b' \t\r\n'
+
+def base64_text_chunks(encoded, chunk_size=BASE64_CHUNK_SIZE):
+    """Generate encoded (str or bytes-like) in pieces of chunk_size characters."""
+    for start in range(0, len(encoded), chunk_size):
+        yield encoded[start:start + chunk_size]
+
+def b64decode_chunks(encoded, chunk_size=BASE64_CHUNK_SIZE):
+    """Generate the base64 decoding of encoded (str or bytes-like) chunk by chunk."""
+    return b64decode_text_chunks(base64_text_chunks(encoded, chunk_size))
+
+def b64decode_text_chunks(chunks):
+    """Generate the base64 decoding of the text given in chunks (str or bytes-like), chunk by chunk."""
+    carry = b''
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('ascii')
+        chunk = carry + bytes(chunk).translate(None, BASE64_WHITESPACE)
+        usable = len(chunk) - len(chunk) % 4
+        carry = chunk[usable:]
+        if usable:
+            yield b64decode(chunk[:usable])
+    if carry:
+        yield b64decode(carry)
+
+def split_compressed_data(chunks, on_header, on_footer):
+    """Generate the deflated body of decoded compressed_data chunks.
+
+    The leading header and trailing footer are passed to on_header and on_footer.
+    """
+    header = b''
+    tail = b''
+    for chunk in chunks:
+        if len(header) < COMPRESSED_DATA_HEADER_SIZE:
+            needed = COMPRESSED_DATA_HEADER_SIZE - len(header)
+            header += chunk[:needed]
+            chunk = chunk[needed:]
+            if len(header) == COMPRESSED_DATA_HEADER_SIZE:
+                on_header(header)
+        tail += chunk
+        if len(tail) > COMPRESSED_DATA_FOOTER_SIZE:
+            yield tail[:-COMPRESSED_DATA_FOOTER_SIZE]
+            tail = tail[-COMPRESSED_DATA_FOOTER_SIZE:]
+    if len(header) < COMPRESSED_DATA_HEADER_SIZE or len(tail) < COMPRESSED_DATA_FOOTER_SIZE:
+        raise ParseFailure("compressed_data is too short to contain its header and footer")
+    on_footer(tail)
+
+def inflate_chunks(chunks):
+    """Generate the inflated contents of a raw deflate stream given in chunks."""
     decompress = zlib.decompressobj(
             -zlib.MAX_WBITS
     )
-    inflated = decompress.decompress(data)
-    inflated += decompress.flush()
-    return inflated
-
-def parse_xad_file(xad_file):
-    xad = parse(xad_file)
-    xad.normalize
-    for child in xad.childNodes:
-        if child.nodeName == "#comment":
-            xad_handle_comment(child)
-        elif child.nodeName == "compressed_data":
-            text = get_text(child)
-            m = re.match('.*?(.Oy9.*)$', text, flags=re.DOTALL)
-            if not m:
-                print("error in re")
-                raise
-            decoded = b64decode(text)
-            decoded_header = decoded[0:76]
-            handle_header(decoded_header)
-            compressed_data = decoded[76:-9]
-            decoded_footer = decoded[-9:]
-            print("Have compressed_data decoded footer 0x%s" % (decoded_footer.hex()))
-            data_xml = inflate(compressed_data).decode('utf-16-le')
-            parse_data_xml(data_xml)
+    for chunk in chunks:
+        while chunk:
+            inflated = decompress.decompress(chunk, INFLATE_CHUNK_SIZE)
+            if inflated:
+                yield inflated
+            chunk = decompress.unconsumed_tail
+    inflated = decompress.flush()
+    if inflated:
+        yield inflated
+
+def inflate(data):
+    return b''.join(inflate_chunks([data]))
+
+def peek_compressed_data_footer(encoded):
+    """Return the footer of compressed_data, decoded from its last base64 characters only.
+
+    Returns None if they are not valid base64.
+    """
+    size = COMPRESSED_DATA_FOOTER_BASE64_SIZE * 4
+    while True:
+        tail = encoded[-size:]
+        if isinstance(tail, str):
+            tail = tail.encode('ascii')
+        tail = bytes(tail).translate(None, BASE64_WHITESPACE)
+        if len(tail) >= COMPRESSED_DATA_FOOTER_BASE64_SIZE or size >= len(encoded):
+            break
+        size *= 4
+    if len(tail) < COMPRESSED_DATA_FOOTER_BASE64_SIZE:
+        return None
+    try:
+        # the base64 text is a whole number of 4 character groups, so its end is aligned
+        return b64decode(tail[-COMPRESSED_DATA_FOOTER_BASE64_SIZE:])[-COMPRESSED_DATA_FOOTER_SIZE:]
+    except ValueError:
+        return None
+
+def parse_compressed_data(document, encoded, select=None, convert=True, source=None):
+    """Fill in document from the text of compressed_data encoded, with DataXmlParser.
+
+    compressed_data is decoded, inflated and parsed in a stream, so apart
+    from the chip being parsed (see DataXmlParser) memory does not grow with
+    its size.
+    """
+    def on_header(decoded_header):
+        document.data_header = handle_header(decoded_header)
+
+    def on_footer(decoded_footer):
+        document.data_footer = decoded_footer
+
+    # known before the chips, as the text output prints it before them
+    document.data_footer = peek_compressed_data_footer(encoded)
+    parser = DataXmlParser(document, select=select, convert=convert, source=source)
+    profiler = active_profiler
+    if profiler is None:
+        body = split_compressed_data(b64decode_chunks(encoded), on_header, on_footer)
+        for inflated in inflate_chunks(body):
+            parser.feed(inflated)
+    else:
+        text = CountingIterator(base64_text_chunks(encoded))
+        body = CountingIterator(split_compressed_data(profiler.iterate("base64", b64decode_text_chunks(text), consumed=text),
+                                                      on_header, on_footer))
+        feed = profiler.wrap("data_xml", parser.feed)
+        for inflated in profiler.iterate("inflate", inflate_chunks(body), consumed=body):
+            feed(inflated)
+    parser.close()
+
+XML_DECLARATION_ENCODING = re.compile(rb'encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+XML_WHITESPACE = b' \t\r\n'
+
+@contextmanager
+def map_xad_file(xad_file):
+    """Memory-map xad_file read-only and provide a memoryview over its contents."""
+    with open(xad_file, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ParseFailure("%s is empty" % (xad_file))
+    view = memoryview(mapped)
+    try:
+        yield view
+    finally:
+        view.release()
+        try:
+            mapped.close()
+        except BufferError:
+            # slices are still referenced (e.g. from a traceback); the
+            # mapping is closed when they are garbage collected
+            pass
+
+def split_xad(view, leading_only=False):
+    """Generate (nodeName, memoryview) for the top-level nodes of an XAD document.
+
+    Comments are given as "#comment" with the text between the delimiters and
+    the root element as "compressed_data" with its text content, without
+    parsing the rest of the document.
+
+    With leading_only, stop at the compressed_data start tag, giving the rest
+    of the document as its text content without looking for its end.
+    """
+    pos = 0
+    if view[:3] == b'\xef\xbb\xbf':
+        pos = 3
+    end = len(view)
+    while True:
+        while pos < end and view[pos] in XML_WHITESPACE:
+            pos += 1
+        if pos == end:
+            return
+        if view[pos:pos + 5] == b'<?xml':
+            close = bytes(view[pos:pos + 256]).find(b'?>')
+            if close < 0:
+                raise ParseFailure("unterminated XML declaration")
+            encoding = XML_DECLARATION_ENCODING.search(view[pos:pos + close])
+            if encoding and encoding.group(1).lower() not in (b'utf-8', b'utf8', b'us-ascii', b'ascii'):
+                raise ParseFailure("unsupported XAD document encoding %s" % (encoding.group(1).decode('ascii')))
+            pos += close + 2
+        elif view[pos:pos + 4] == b'<!--':
+            close = view.obj.find(b'-->', pos + 4)
+            if close < 0:
+                raise ParseFailure("unterminated comment in XAD document")
+            yield "#comment", view[pos + 4:close]
+            pos = close + 3
+        elif view[pos:pos + 16] == b'<compressed_data' and view[pos + 16:pos + 17] in (b'>', b'/', b' ', b'\t', b'\r', b'\n'):
+            start_tag_end = view.obj.find(b'>', pos)
+            if start_tag_end < 0:
+                raise ParseFailure("unterminated compressed_data start tag")
+            if view[start_tag_end - 1] == ord('/'):
+                yield "compressed_data", view[start_tag_end:start_tag_end]
+                pos = start_tag_end + 1
+                continue
+            if leading_only:
+                yield "compressed_data", view[start_tag_end + 1:]
+                return
+            close = view.obj.rfind(b'</compressed_data', start_tag_end)
+            if close < 0:
+                raise ParseFailure("compressed_data element is not closed")
+            yield "compressed_data", view[start_tag_end + 1:close]
+            pos = view.obj.find(b'>', close) + 1
+            if pos == 0:
+                raise ParseFailure("unterminated compressed_data end tag")
         else:
-            raise UnexpectedNodeError(child, "Unexpected node in XAD XML document")
+            raise UnexpectedNodeError(bytes(view[pos:pos + 80]), "Unexpected node in XAD XML document")
 
-def main():
-    parser = argparse.ArgumentParser(description='Convert a chip data file from Bioanalyzer 2100')
-    parser.add_argument('xad', help='the input chip data (XAD) file')
-    args = parser.parse_args()
+def parse_xad_file(xad_file, document, select=None, cache=None, convert=True, source=None):
+    profiler = active_profiler
+    with map_xad_file(xad_file) as view:
+        nodes = split_xad(view) if profiler is None else profiler.iterate("split_xad", split_xad(view), lambda node: len(node[1]))
+        for name, data in nodes:
+            if name == "#comment":
+                if profiler is None:
+                    xad_handle_comment(document, data)
+                else:
+                    profiler.call("comments", xad_handle_comment, document, data, bytes_in=len(data))
+            elif cache is not None and source is None:
+                cache.parse_compressed_data(document, data, select, convert)
+            else:
+                parse_compressed_data(document, data, select, convert, source)
+
+def load_xad(xad_file, on_chip=None, select=None, cache=None, packed_text=True):
+    """Parse the XAD file at path xad_file and return it as an XadDocument.
 
-    parse_xad_file(args.xad)
+    If on_chip is given, it is called with each Chip as soon as it has been
+    parsed and the chips are not kept in the returned document, so that
+    memory is bounded by the largest chip rather than by the file.
+
+    If select is given, only the elements of the data XML on those paths
+    (see compile_selection) are parsed and the other fields are left None,
+    e.g. select=["Chip/ID", "SignalData/RawSignal"].
+
+    If cache (an XadCache) is given, compressed_data is only parsed if it
+    is not in the cache already.
+
+    With packed_text false, the base64 text of packed values is not kept,
+    only where it is in the inflated data, and it is inflated again from
+    xad_file when their values are first used (see PackedSource); the cache
+    is not used then.
+    """
+    document = XadDocument(on_chip=on_chip)
+    parse_xad_file(xad_file, document, select, cache, source=None if packed_text else PackedSource(xad_file))
+    document.on_chip = None
+    return document
+
+# Bump whenever parsing changes what ends up in an XadDocument, so that
+# XadCache entries written by older versions are not used
+CACHE_VERSION = 3
+# File written by XadCache into each version directory it creates
+CACHE_MARKER = '.xadder-cache'
+# Default bound on the total size of the entries of an XadCache
+CACHE_MAX_SIZE = 1 << 30
+# Fields of XadDocument which come from compressed_data and are kept by XadCache
+CACHED_FIELDS = ('data_header', 'data_footer', 'file_type', 'type', 'chipset_class', 'data_type',
+                 'external_links', 'persist_sample_signals', 'method', 'log_book')
+
+def cached_packed_values(var_type, num_values, offset, length, decoded):
+    return PackedValues(var_type=var_type, num_values=num_values, offset=offset, length=length, decoded=decoded)
+
+class CachePickler(pickle.Pickler):
+    """Pickles PackedValues as their decoded bytes rather than their base64 text or PackedSource."""
+
+    def reducer_override(self, obj):
+        if type(obj) is PackedValues:
+            decoded = obj.decoded if obj.decoded is not None else b64decode(obj.text())
+            return cached_packed_values, (obj.var_type, obj.num_values, obj.offset, obj.length, decoded)
+        return NotImplemented
+
+class XadCache:
+    """An on-disk cache of what is parsed from compressed_data, keyed by a digest of it.
+
+    Entries are pickles of the Chipset fields and Chips, stored under a
+    directory per CACHE_VERSION and per UUID of the header comment, so that
+    a file whose header UUID has never been cached is a miss without
+    digesting its compressed_data. Once the entries exceed max_size bytes the
+    least recently used ones are removed, as are the entries of other versions.
+    Only version directories named v<number> which hold CACHE_MARKER are ever
+    removed, so other files in directory are left alone.
+
+    The packed values are cached as their decoded bytes (see CachePickler),
+    which are a quarter smaller than the base64 text and are turned into
+    arrays without decoding it again. Documents parsed without converting
+    text are cached apart, and the fields which precede the chips are filled
+    in before the chips are given to the document again, as they are when
+    parsing.
+    """
+
+    def __init__(self, directory, max_size=CACHE_MAX_SIZE):
+        self.directory = Path(directory)
+        self.max_size = max_size
+
+    def _version_directory(self):
+        return self.directory / ('v%d' % (CACHE_VERSION))
+
+    def _entry_path(self, header_uuid, digest, convert=True):
+        return self._version_directory() / (header_uuid or "none") / (digest + ('.pickle' if convert else '.text.pickle'))
+
+    def parse_compressed_data(self, document, encoded, select=None, convert=True):
+        """Fill in document from compressed_data as parse_compressed_data() does, using the cache if possible.
+
+        Selections are not cached, so with select this is parse_compressed_data().
+        """
+        if select:
+            parse_compressed_data(document, encoded, select, convert)
+            return
+        header_uuid = document.header.uuid if document.header is not None else None
+        digest = None
+        if (self._version_directory() / (header_uuid or "none")).is_dir():
+            digest = hashlib.blake2b(encoded, digest_size=20).hexdigest()
+            entry = self.get(header_uuid, digest, convert)
+            if entry is not None:
+                leading = entry["leading"]
+                for field in leading:
+                    setattr(document, field, entry["fields"][field])
+                for chip in entry["chips"]:
+                    document.add_chip(chip)
+                for field in CACHED_FIELDS:
+                    if field not in leading:
+                        setattr(document, field, entry["fields"][field])
+                return
+        on_chip = document.on_chip
+        chips = []
+        leading = []
+        def add_chip(chip):
+            if not chips:
+                leading.extend(field for field in CACHED_FIELDS if getattr(document, field) is not None)
+            chips.append(chip)
+            if on_chip is not None:
+                on_chip(chip)
+            else:
+                document.chips.append(chip)
+        document.on_chip = add_chip
+        try:
+            parse_compressed_data(document, encoded, convert=convert)
+        finally:
+            document.on_chip = on_chip
+        if not chips:
+            leading = CACHED_FIELDS
+        if digest is None:
+            digest = hashlib.blake2b(encoded, digest_size=20).hexdigest()
+        self.put(header_uuid, digest, {"fields": {field: getattr(document, field) for field in CACHED_FIELDS},
+                                       "leading": tuple(leading), "chips": chips}, convert)
+
+    def get(self, header_uuid, digest, convert=True):
+        """Return the entry for compressed_data with the given digest, or None if it is not cached."""
+        path = self._entry_path(header_uuid, digest, convert)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # truncated or written by an incompatible version of Python
+            self._remove(path)
+            return None
+        if entry.get("version") != CACHE_VERSION or entry.get("header_uuid") != header_uuid:
+            return None
+        try:
+            # mark it as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, header_uuid, digest, entry, convert=True):
+        path = self._entry_path(header_uuid, digest, convert)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        (self._version_directory() / CACHE_MARKER).touch()
+        entry = dict(entry, version=CACHE_VERSION, header_uuid=header_uuid)
+        with atomic_write(path, 'wb') as f:
+            CachePickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(entry)
+        self.evict()
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """Remove the entries of other versions and the least recently used ones beyond max_size."""
+        current = self._version_directory()
+        if self.directory.is_dir():
+            for version in self.directory.iterdir():
+                if (version != current and re.fullmatch(r'v\d+', version.name)
+                        and not version.is_symlink() and (version / CACHE_MARKER).is_file()):
+                    shutil.rmtree(version, ignore_errors=True)
+        entries = []
+        total = 0
+        for path in current.glob('*/*.pickle'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+# Number of base64 characters of compressed_data read to decode its header
+DATA_HEADER_BASE64_SIZE = 256
+
+def peek_compressed_data_header(encoded):
+    """Return the Header of compressed_data, decoded from its first base64 characters only.
+
+    Returns None if compressed_data is too short to contain it.
+    """
+    decoded = b''
+    for chunk in b64decode_chunks(encoded, DATA_HEADER_BASE64_SIZE):
+        decoded += chunk
+        if len(decoded) >= COMPRESSED_DATA_HEADER_SIZE:
+            return handle_header(decoded[:COMPRESSED_DATA_HEADER_SIZE])
+    return None
+
+def scan_xad(xad_file):
+    """Return an XadDocument with only the metadata of the XAD file at path xad_file.
+
+    Only the leading comments (header, comment tag and preview, without
+    decoding the gel image) and the header of compressed_data are read; nothing is inflated, so the data
+    fields, data_footer and chips are left empty.
+    """
+    document = XadDocument()
+    with map_xad_file(xad_file) as view:
+        for name, data in split_xad(view, leading_only=True):
+            if name == "#comment":
+                xad_handle_comment(document, data, gel_image=False)
+                continue
+            document.data_header = peek_compressed_data_header(data)
+    return document
+
+def header_summary(header):
+    if header is None:
+        return None
+    return {"uuid": header.uuid, "ints": list(header.ints), "text": header.text}
+
+def scan_summary(xad_file, document):
+    """Return the metadata of a scanned XadDocument as a dict suitable for JSON."""
+    preview = document.preview
+    return {
+        "file": xad_file,
+        "size": os.path.getsize(xad_file),
+        "header": header_summary(document.header),
+        "tag_uuid": document.tag_uuid,
+        "tag_num": document.tag_num,
+        "preview": None if preview is None else {
+            "uuid": preview.uuid,
+            "title": preview.title,
+            "chip_info": preview.chip_info,
+            "samples_info": preview.samples_info,
+            "chip_info_rows": preview.chip_info_rows,
+            "samples_info_rows": preview.samples_info_rows,
+            "gel_image_size": preview.gel_image_size,
+        },
+        "data_header": header_summary(document.data_header),
+    }
+
+class Verification(Record):
+    """The result of verify_xad.
+
+    Attributes:
+        problems -- descriptions of what is wrong with the file (empty if it is intact)
+        warnings -- descriptions of what could not be checked or may be wrong
+                    but is not known to be (empty if there are none)
+        footer -- the name of the FOOTER_LAYOUTS entry matching the footer of
+                  compressed_data, or None if none does
+        inflated_length -- the length of the inflated data
+        deflated_length -- the length of the deflate stream
+    """
+    __slots__ = ('problems', 'warnings', 'footer', 'inflated_length', 'deflated_length')
+
+def footer_layouts():
+    layouts = {}
+    for checksum in ("crc32", "adler32"):
+        for data in ("inflated", "deflated"):
+            for byteorder in ("little", "big"):
+                layouts["%s of %s data and its length (%s-endian)" % (checksum, data, byteorder)] = (checksum, data, byteorder)
+    return layouts
+
+# What the 9 byte footer of compressed_data may hold: a checksum and a length
+# of the inflated or deflated data, as (checksum, data, byteorder). Which one
+# XAD files use is not documented, so verify_xad reports the one that matches.
+FOOTER_LAYOUTS = footer_layouts()
+
+def verify_compressed_data(encoded, verification):
+    header = []
+    footer = []
+    body = split_compressed_data(b64decode_chunks(encoded), header.append, footer.append)
+    sums = {"inflated_crc32": 0, "inflated_adler32": 1, "inflated_length": 0,
+            "deflated_crc32": 0, "deflated_adler32": 1, "deflated_length": 0}
+    decompress = zlib.decompressobj(-zlib.MAX_WBITS)
+    trailing = 0
+    for chunk in body:
+        sums["deflated_crc32"] = zlib.crc32(chunk, sums["deflated_crc32"])
+        sums["deflated_adler32"] = zlib.adler32(chunk, sums["deflated_adler32"])
+        sums["deflated_length"] += len(chunk)
+        if decompress.eof:
+            trailing += len(chunk)
+            continue
+        while chunk:
+            inflated = decompress.decompress(chunk, INFLATE_CHUNK_SIZE)
+            sums["inflated_crc32"] = zlib.crc32(inflated, sums["inflated_crc32"])
+            sums["inflated_adler32"] = zlib.adler32(inflated, sums["inflated_adler32"])
+            sums["inflated_length"] += len(inflated)
+            chunk = decompress.unconsumed_tail
+        trailing += len(decompress.unused_data)
+    verification.inflated_length = sums["inflated_length"]
+    verification.deflated_length = sums["deflated_length"]
+    if not decompress.eof:
+        verification.problems.append("deflate stream is truncated")
+    elif trailing:
+        verification.problems.append("%d bytes after the end of the deflate stream" % (trailing))
+    # the meaning of the header ints is not documented: those of the files seen
+    # so far hold the lengths, but a file which differs is not known to be corrupt
+    ints = handle_header(header[0]).ints
+    if ints[2] != sums["inflated_length"]:
+        verification.warnings.append("header gives %d bytes of inflated data but there are %d" % (ints[2], sums["inflated_length"]))
+    if ints[3] != sums["deflated_length"]:
+        verification.warnings.append("header gives %d bytes of deflated data but there are %d" % (ints[3], sums["deflated_length"]))
+    # a footer which has the length of a layout but not its checksum is corrupt
+    corrupt = set()
+    for name, (checksum, data, byteorder) in FOOTER_LAYOUTS.items():
+        if footer[0][4:8] != (sums[data + "_length"] & 0xffffffff).to_bytes(4, byteorder):
+            continue
+        if footer[0][0:4] == sums[data + "_" + checksum].to_bytes(4, byteorder):
+            verification.footer = name
+            return
+        corrupt.add(data)
+    if corrupt:
+        verification.problems.append("footer gives the length of the %s data but its checksum does not match" % (
+            " or ".join(sorted(corrupt))))
+    else:
+        verification.warnings.append("footer matches no known layout, so the data could not be checksummed")
+
+def verify_xad(xad_file):
+    """Check the integrity of xad_file without parsing its data XML and return a Verification.
+
+    The comments are parsed and compressed_data is decoded and inflated in a
+    stream while its checksums are computed, to check that the deflate stream
+    ends where the footer starts and which of FOOTER_LAYOUTS the footer
+    matches. A footer with the length of a layout but not its checksum is a
+    problem, and one which matches no layout a warning, as the data could not
+    be checksummed. Lengths in the header which differ from those of the data
+    are warnings too, as what the header holds is not documented.
+    """
+    verification = Verification(problems=[], warnings=[])
+    try:
+        with map_xad_file(xad_file) as view:
+            found = False
+            for name, data in split_xad(view):
+                if name == "#comment":
+                    xad_handle_comment(XadDocument(), data)
+                else:
+                    found = True
+                    verify_compressed_data(data, verification)
+            if not found:
+                verification.problems.append("no compressed_data")
+    except (Error, ValueError, zlib.error) as e:
+        # binascii.Error is a ValueError
+        verification.problems.append(describe_error(e))
+    return verification
+
+gel_image_filename = "gel_image.png"
+
+# Number of characters of the text of a header, which is padded with NULs
+HEADER_TEXT_LENGTH = (COMPRESSED_DATA_HEADER_SIZE - 20) // 2
+# Labels of the text output which differ from the name of the element
+PRINT_LABELS = {"DAMethod": "DAMMethod"}
+# Fields of <Chipset> in the order they are printed, those before <Chips> as soon as the first chip is
+CHIPSET_PRINT_FIELDS = (("FileType", "file_type"), ("Type", "type"), ("Class", "chipset_class"),
+                        ("Method", "method"), ("LogBook", "log_book"), ("DataType", "data_type"),
+                        ("ExternalLinks", "external_links"), ("PersistSampleSignals", "persist_sample_signals"))
+
+def print_header(header):
+    for i, value in enumerate(header.ints):
+        print("have header_int%d %d" % (i + 1, value))
+    print("have header_str1 %s" % (header.text.ljust(HEADER_TEXT_LENGTH, '\0')))
+    if header.extra is not None:
+        print("have extra header: 0x%s" % (header.extra.hex()))
+
+def print_preview(preview, gel_image_file):
+    print('Have preview %s with preamble %s' % (preview.uuid.encode('ascii'), hexlify(preview.preamble)))
+    print("Preview Title: %s" % (preview.title))
+    print("Preview ChipInfo: %s" % (preview.chip_info))
+    print("Preview SamplesInfo: %s" % (preview.samples_info))
+    if preview.gel_image is not None and gel_image_file is not None:
+        print("Writing Gel Image to %s" % gel_image_file)
+        write_gel_image(preview, gel_image_file)
+
+def print_entries(entries):
+    for name, value in entries.items():
+        if isinstance(value, dict):
+            print_entries(value)
+        elif isinstance(value, list):
+            for item in value:
+                print("%s: %s" % (PRINT_LABELS.get(name, name), item))
+        else:
+            print("%s: %s" % (PRINT_LABELS.get(name, name), value))
+
+def print_signal_data(name, signal):
+    for field, value in (
+            ("AlignmentBias", signal.alignment_bias),
+            ("AlignmentScale", signal.alignment_scale),
+            ("ChannelID", signal.channel_id),
+            ("Index", signal.index),
+            ("MaxValue", signal.max_value),
+            ("MinValue", signal.min_value),
+            ("Name", signal.name),
+            ("NumberOfSamples", signal.number_of_samples),
+            ("RawSignal", signal.raw_signal),
+            ("ScriptStep", signal.script_step),
+            ("UnitX", signal.unit_x),
+            ("UnitY", signal.unit_y),
+            ("XMaxVisibleRange", signal.x_max_visible_range),
+            ("XMinVisibleRange", signal.x_min_visible_range),
+            ("XStart", signal.x_start),
+            ("XStartAligned", signal.x_start_aligned),
+            ("XStep", signal.x_step),
+            ("XStepAligned", signal.x_step_aligned),
+            ("YMaxVisibleRange", signal.y_max_visible_range),
+            ("YMinVisibleRange", signal.y_min_visible_range)):
+        if value is None:
+            continue
+        if field in ("RawSignal", "ScriptStep"):
+            value = format_values(value.values)
+        print("%s %s: %s" % (name, field, value))
+
+def print_signal_container(name, trace, signal):
+    # HasData of a Channel, Current or Voltage is labelled with the name of the set alone
+    if signal.has_data is not None:
+        print("%s HasData: %s" % (name, signal.has_data))
+    print_signal_data("%s %s" % (name, trace), signal)
+
+def print_raw_signal_set(raw_signal_set):
+    name = raw_signal_set.name
+    if raw_signal_set.has_data is not None:
+        print("%s HasData: %s" % (name, raw_signal_set.has_data))
+    if raw_signal_set.signal_data is not None:
+        print_signal_data(name, raw_signal_set.signal_data)
+    for channel in raw_signal_set.channels:
+        print_signal_container(name, "Channel", channel)
+    if raw_signal_set.current is not None:
+        print_signal_container(name, "Current", raw_signal_set.current)
+    if raw_signal_set.voltage is not None:
+        print_signal_container(name, "Voltage", raw_signal_set.voltage)
+
+def print_chip(chip):
+    if chip.id is not None:
+        print("Chip ID: %s" % (chip.id))
+    if chip.assay_header is not None:
+        print("Chip AssayHeader: %s" % (chip.assay_header))
+    print_entries(chip.assay_body)
+    if chip.script_allow_edit is not None:
+        print("Chip Script AllowEdit: %s" % (chip.script_allow_edit))
+    if chip.script_text is not None:
+        print("Chip ScriptText: '%s'" % (chip.script_text.replace('\r','\\r').replace('\n','\\n').replace('\'', '\\\'')))
+    for field, value in (
+            ("ChipInformation", chip.chip_information),
+            ("Instrument", chip.instrument),
+            ("ComPortSettings", chip.com_port_settings),
+            ("DataStatus", chip.data_status)):
+        if value is not None:
+            print("%s: %s" % (field, value))
+    for raw_signal_set in chip.raw_signals:
+        print_raw_signal_set(raw_signal_set)
+    for field, value in (
+            ("Files", chip.files),
+            ("Diagnostics", chip.diagnostics),
+            ("Packet", chip.packet),
+            ("Imported", chip.imported),
+            ("HasData", chip.has_data),
+            ("NumberOfAcquiredSamples", chip.number_of_acquired_samples),
+            ("PacketFileName", chip.packet_file_name)):
+        if value is None:
+            continue
+        if field == "Packet":
+            value = format_values(value.values)
+        print("%s: %s" % (field, value))
+
+def print_chipset(document, printed):
+    """Print the fields of document from compressed_data which are set and not in printed, adding them to it."""
+    if document.data_footer is not None and "data_footer" not in printed:
+        print("Have compressed_data decoded footer 0x%s" % (document.data_footer.hex()))
+        printed.add("data_footer")
+    for label, field in CHIPSET_PRINT_FIELDS:
+        value = getattr(document, field)
+        if value is not None and field not in printed:
+            print("Chipset %s: %s" % (label, value))
+            printed.add(field)
+
+def print_document_start(document, gel_image_file):
+    """Print what precedes the chips of document and return the set of fields printed, for print_document_end."""
+    if document.header is not None:
+        print_header(document.header)
+    if document.preview is not None:
+        print_preview(document.preview, gel_image_file)
+    if document.tag_uuid is not None:
+        print('UUID: %s NUM: %s BLOB: %s BLOB(hex): %s' % (document.tag_uuid.encode('ascii'), str(document.tag_num).encode('ascii'),
+                                                          document.tag_blob, hexlify(document.tag_blob)))
+    if document.data_header is not None:
+        print_header(document.data_header)
+    printed = set()
+    print_chipset(document, printed)
+    return printed
+
+def print_document_end(document, printed=()):
+    print_chipset(document, set(printed))
+
+def iter_signals(chip):
+    """Generate (raw signal set, trace, channel number, SignalData) for every SignalData of chip.
+
+    trace is "signal", "channel", "current" or "voltage"; the channel number
+    is the position among the Channel elements of the set (None otherwise).
+    """
+    for raw_signal_set in chip.raw_signals:
+        if raw_signal_set.signal_data is not None:
+            yield raw_signal_set, "signal", None, raw_signal_set.signal_data
+        for channel, signal in enumerate(raw_signal_set.channels):
+            yield raw_signal_set, "channel", channel, signal
+        if raw_signal_set.current is not None:
+            yield raw_signal_set, "current", None, raw_signal_set.current
+        if raw_signal_set.voltage is not None:
+            yield raw_signal_set, "voltage", None, raw_signal_set.voltage
+
+class AlignedSignals(Record):
+    """Signals of a chip resampled onto a common aligned x-axis, as returned by aligned_signal_matrix.
+
+    Attributes:
+        rows -- (raw signal set name, trace, channel number) of each row (see iter_signals)
+        axis -- the common x values, a 1D float64 array
+        values -- a 2D float64 array of a row per signal and a column per x value,
+                  NaN outside the x range of the signal
+        mask -- a 1D bool array, False for the rows of signals without data
+                (or whose set has none)
+    """
+    __slots__ = ('rows', 'axis', 'values', 'mask')
+
+def signal_axis(signal):
+    """Return (start, step) of the x-axis of signal: the aligned one if it has one, or None if it has none."""
+    if signal.x_start_aligned is not None and signal.x_step_aligned:
+        return signal.x_start_aligned, signal.x_step_aligned
+    if signal.x_start is not None and signal.x_step:
+        return signal.x_start, signal.x_step
+    return None
+
+# Distance in samples within which a position of aligned_signal_matrix is taken to be on a sample
+POSITION_TOLERANCE = 1e-9
+
+def aligned_signal_matrix(chip, traces=("signal", "channel"), num_points=None):
+    """Return the signals of chip of the given traces (see iter_signals) as AlignedSignals.
+
+    The RawSignal of each signal is linearly interpolated onto a common axis
+    running from the first to the last aligned x value of any of them, by
+    default in steps of the smallest aligned XStep. The aligned x-axis of a
+    signal is given by its XStartAligned and XStepAligned (the instrument
+    software applies AlignmentBias and AlignmentScale to compute them), or
+    XStart and XStep if there are none. Requires numpy.
+    """
+    if numpy is None:
+        raise Error("numpy is required for aligned signal matrices")
+    rows = []
+    signals = []
+    for raw_signal_set, trace, channel, signal in iter_signals(chip):
+        if trace not in traces:
+            continue
+        rows.append((raw_signal_set.name, trace, channel))
+        axis = signal_axis(signal)
+        # the HasData of the set (as of the Ladder) or of the container (as of a sample Channel)
+        if (raw_signal_set.has_data is False or signal.has_data is False or signal.raw_signal is None
+                or not len(signal.raw_signal) or axis is None):
+            signals.append((numpy.nan, numpy.nan, None))
+        else:
+            signals.append(axis + (signal.raw_signal.values,))
+    mask = numpy.array([values is not None for _, _, values in signals], dtype=bool)
+    if not mask.any():
+        return AlignedSignals(rows=rows, axis=numpy.empty(0), values=numpy.empty((len(rows), 0)), mask=mask)
+    starts = numpy.array([start for start, _, _ in signals], dtype=numpy.float64)
+    steps = numpy.array([step for _, step, _ in signals], dtype=numpy.float64)
+    lengths = numpy.array([0 if values is None else len(values) for _, _, values in signals], dtype=numpy.intp)
+    padded = numpy.zeros((len(rows), lengths.max()), dtype=numpy.float64)
+    for row, (_, _, values) in enumerate(signals):
+        if values is not None:
+            padded[row, :len(values)] = values
+    start = starts[mask].min()
+    end = (starts + (lengths - 1) * steps)[mask].max()
+    if num_points is None:
+        num_points = int(round((end - start) / steps[mask].min())) + 1
+    axis = numpy.linspace(start, end, num_points)
+    # fractional index of each x value in each row, for all rows at once
+    starts[~mask] = 0.0
+    steps[~mask] = 1.0
+    positions = (axis[numpy.newaxis, :] - starts[:, numpy.newaxis]) / steps[:, numpy.newaxis]
+    # snap positions which are off a sample only by rounding, so that the ends are not lost
+    nearest = numpy.rint(positions)
+    snap = numpy.abs(positions - nearest) < POSITION_TOLERANCE
+    positions[snap] = nearest[snap]
+    last = numpy.maximum(lengths - 1, 0)[:, numpy.newaxis]
+    inside = (positions >= 0) & (positions <= last) & mask[:, numpy.newaxis]
+    lower = numpy.minimum(numpy.floor(numpy.clip(positions, 0, None)).astype(numpy.intp), last)
+    upper = numpy.minimum(lower + 1, last)
+    fraction = positions - lower
+    below = numpy.take_along_axis(padded, lower, axis=1)
+    above = numpy.take_along_axis(padded, upper, axis=1)
+    values = below + (above - below) * fraction
+    values[~inside] = numpy.nan
+    return AlignedSignals(rows=rows, axis=axis, values=values, mask=mask)
+
+def get_packed_bytes(packed, var_type):
+    """Return the values of PackedValues packed as little-endian bytes of var_type."""
+    if packed.var_type == var_type:
+        decoded = b64decode(packed.text())
+        unpack_values(decoded, var_type, packed.num_values)
+        return decoded
+    values = array(PACKED_VALUE_TYPES[var_type][1], packed.values.tolist())
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+# Scalar columns of the signal exports: name, type and where the value comes from
+EXPORT_COLUMNS = (
+    ("xad_file", "str", None),
+    ("chip_id", "str", None),
+    ("signal_set", "str", None),
+    ("trace", "str", None),
+    ("channel", "int", None),
+    ("has_data", "bool", "has_data"),
+    ("channel_id", "int", "channel_id"),
+    ("index", "int", "index"),
+    ("name", "str", "name"),
+    ("number_of_samples", "int", "number_of_samples"),
+    ("min_value", "float", "min_value"),
+    ("max_value", "float", "max_value"),
+    ("x_start", "float", "x_start"),
+    ("x_step", "float", "x_step"),
+    ("x_start_aligned", "float", "x_start_aligned"),
+    ("x_step_aligned", "float", "x_step_aligned"),
+    ("alignment_bias", "float", "alignment_bias"),
+    ("alignment_scale", "float", "alignment_scale"),
+    ("unit_x", "str", "unit_x"),
+    ("unit_y", "str", "unit_y"),
+)
+# Array columns of the signal exports and the vartype they are stored as
+EXPORT_ARRAYS = (("raw_signal", "LE_R4"), ("script_step", "LE_I2"))
+
+def signal_rows(xad_file, chip):
+    """Generate (scalar column values, {array column: PackedValues or None}) for each signal of chip."""
+    for raw_signal_set, trace, channel, signal in iter_signals(chip):
+        row = {"xad_file": xad_file, "chip_id": chip.id, "signal_set": raw_signal_set.name,
+               "trace": trace, "channel": channel}
+        for column, _, field in EXPORT_COLUMNS:
+            if field is not None:
+                row[column] = getattr(signal, field)
+        yield row, {column: getattr(signal, column) for column, _ in EXPORT_ARRAYS}
+
+# Size reserved for .npy headers so they can be rewritten once the length is known
+NPY_HEADER_SIZE = 128
+
+def npy_header(dtype, length):
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (dtype, length)
+    header = header.ljust(NPY_HEADER_SIZE - 11) + '\n'
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+def import_pyarrow():
+    """Return the pyarrow module (with pyarrow.parquet loaded), or None if it is not installed."""
+    # imported on demand as it takes longer to load than most conversions
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+# Directory of the BlockStore shared by the exports written into a directory
+EXPORT_BLOCKS_DIRECTORY = "blocks"
+
+def block_digest(block):
+    return hashlib.blake2b(block.encode('utf-8'), digest_size=20).hexdigest()
+
+class BlockStore:
+    """A directory holding each distinct block of XML or text once, in a file named by its block_digest.
+
+    Exports refer to the setpoints, methods and scripts of their chips (see
+    export_blocks) by digest, so that these are written once however many
+    chips and files share them.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        # digests of the blocks known to be in the directory
+        self._stored = set()
+
+    def add(self, block):
+        """Store block unless it is stored already and return its digest."""
+        digest = block_digest(block)
+        if digest not in self._stored:
+            path = self.directory / digest
+            if not path.exists():
+                self.directory.mkdir(parents=True, exist_ok=True)
+                with atomic_write(path, 'wb') as f:
+                    f.write(block.encode('utf-8'))
+            self._stored.add(digest)
+        return digest
+
+def chip_blocks(chip):
+    """Return the blocks of XML or text of chip kept in a BlockStore by export, by name.
+
+    The names are those of the fields of Chip, with the path of the entries
+    of assay_body, e.g. "assay_body/DASampleSetpoints/DAMSizing" or
+    "assay_body/DALadderSequence/DAMethod/0".
+    """
+    blocks = {}
+    for name in ("assay_header", "script_text", "chip_information", "instrument", "com_port_settings"):
+        if getattr(chip, name) is not None:
+            blocks[name] = getattr(chip, name)
+    def add_entries(prefix, entries):
+        for key, value in entries.items():
+            path = prefix + '/' + key
+            if isinstance(value, dict):
+                add_entries(path, value)
+            elif isinstance(value, list):
+                for number, item in enumerate(value):
+                    blocks["%s/%d" % (path, number)] = item
+            elif value is not None:
+                blocks[path] = value
+    add_entries("assay_body", chip.assay_body)
+    return blocks
+
+def export_blocks(blocks, chips, document, directory):
+    """Return what exports record of the blocks of document and its chips, given [{"chip_id": ..., "blocks": {name: digest}}] for the chips."""
+    return {
+        "directory": directory,
+        "method": None if document.method is None else blocks.add(document.method),
+        "chips": chips,
+    }
+
+class NpyExporter:
+    """Writes the signals of an XAD file as a directory of .npy arrays and a JSON manifest.
+
+    Each array column is one flat .npy file holding the arrays of all signals
+    one after the other; manifest.json lists the signals with their scalar
+    columns and the offset and length of each of their arrays.
+    """
+
+    def __init__(self, xad_file, output_dir, name=None):
+        self.xad_file = os.path.basename(xad_file)
+        self.path = Path(output_dir) / (Path(xad_file).stem if name is None else name)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.temporary = self.path.with_name('.%s.%d.tmp' % (self.path.name, os.getpid()))
+        self.temporary.mkdir()
+        self.signals = []
+        self.blocks = BlockStore(Path(output_dir) / EXPORT_BLOCKS_DIRECTORY)
+        self.chip_blocks = []
+        self.arrays = {}
+        for column, var_type in EXPORT_ARRAYS:
+            f = open(self.temporary / (column + '.npy'), 'wb')
+            f.write(npy_header(PACKED_VALUE_TYPES[var_type][0], 0))
+            self.arrays[column] = [f, var_type, 0]
+
+    def add_chip(self, chip):
+        self.chip_blocks.append({"chip_id": chip.id, "blocks": {
+            name: self.blocks.add(block) for name, block in chip_blocks(chip).items()}})
+        for row, arrays in signal_rows(self.xad_file, chip):
+            for column, packed in arrays.items():
+                f, var_type, length = self.arrays[column]
+                if packed is None:
+                    row[column + "_offset"] = row[column + "_length"] = None
+                    continue
+                f.write(get_packed_bytes(packed, var_type))
+                row[column + "_offset"] = length
+                row[column + "_length"] = packed.num_values
+                self.arrays[column][2] = length + packed.num_values
+            self.signals.append(row)
+
+    def close(self, document):
+        manifest = {"format": "xadder-npy", "version": 1, "xad_file": self.xad_file, "arrays": {}, "signals": self.signals,
+                    "blocks": export_blocks(self.blocks, self.chip_blocks, document,
+                                            Path(os.path.relpath(self.blocks.directory, self.path)).as_posix())}
+        for column, (f, var_type, length) in self.arrays.items():
+            dtype = PACKED_VALUE_TYPES[var_type][0]
+            f.seek(0)
+            f.write(npy_header(dtype, length))
+            f.close()
+            manifest["arrays"][column] = {"file": column + '.npy', "dtype": dtype, "length": length}
+        with open(self.temporary / 'manifest.json', 'w') as f:
+            json.dump(manifest, f)
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        os.replace(self.temporary, self.path)
+
+    def abort(self):
+        for f, _, _ in self.arrays.values():
+            f.close()
+        shutil.rmtree(self.temporary, ignore_errors=True)
+
+# Arrow types of the values of each vartype
+PARQUET_VALUE_TYPES = {"LE_R4": "float32", "LE_I2": "int16", "LE_UI1": "uint8"}
+
+class ParquetExporter:
+    """Writes the signals of an XAD file as a Parquet table with one row per signal and one row group per chip."""
+
+    def __init__(self, xad_file, output_dir, name=None):
+        self.pyarrow = pa = import_pyarrow()
+        types = {"str": pa.string(), "int": pa.int64(), "float": pa.float64(), "bool": pa.bool_()}
+        self.schema = pa.schema(
+            [(column, types[kind]) for column, kind, _ in EXPORT_COLUMNS] +
+            [(column, pa.list_(getattr(pa, PARQUET_VALUE_TYPES[var_type])())) for column, var_type in EXPORT_ARRAYS])
+        self.xad_file = os.path.basename(xad_file)
+        self.path = Path(output_dir) / ((Path(xad_file).stem if name is None else name) + '.parquet')
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.temporary = self.path.with_name('.%s.%d.tmp' % (self.path.name, os.getpid()))
+        self.writer = pa.parquet.ParquetWriter(str(self.temporary), self.schema)
+        self.blocks = BlockStore(Path(output_dir) / EXPORT_BLOCKS_DIRECTORY)
+        self.chip_blocks = []
+
+    def add_chip(self, chip):
+        pa = self.pyarrow
+        self.chip_blocks.append({"chip_id": chip.id, "blocks": {
+            name: self.blocks.add(block) for name, block in chip_blocks(chip).items()}})
+        rows = list(signal_rows(self.xad_file, chip))
+        if not rows:
+            return
+        columns = [pa.array([row[column] for row, _ in rows], type=self.schema.field(column).type)
+                   for column, _, _ in EXPORT_COLUMNS]
+        for column, var_type in EXPORT_ARRAYS:
+            offsets = [0]
+            mask = []
+            chunks = []
+            for _, arrays in rows:
+                packed = arrays[column]
+                mask.append(packed is None)
+                if packed is not None:
+                    chunks.append(get_packed_bytes(packed, var_type))
+                    offsets.append(offsets[-1] + packed.num_values)
+                else:
+                    offsets.append(offsets[-1])
+            value_type = self.schema.field(column).type.value_type
+            values = pa.Array.from_buffers(value_type, offsets[-1], [None, pa.py_buffer(b''.join(chunks))])
+            columns.append(pa.ListArray.from_arrays(pa.array(offsets, type=pa.int32()), values, mask=pa.array(mask)))
+        self.writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self, document):
+        self.writer.add_key_value_metadata({"xadder.blocks": json.dumps(
+            export_blocks(self.blocks, self.chip_blocks, document,
+                          Path(os.path.relpath(self.blocks.directory, self.path.parent)).as_posix()))})
+        self.writer.close()
+        os.replace(self.temporary, self.path)
+
+    def abort(self):
+        self.writer.close()
+        try:
+            os.unlink(self.temporary)
+        except FileNotFoundError:
+            pass
+
+EXPORTERS = {"npy": NpyExporter, "parquet": ParquetExporter}
+
+def export_xad_file(xad_file, output_dir, export_format="auto", select=None, cache=None, name=None):
+    """Export the signals of xad_file into output_dir as Parquet or .npy (see EXPORTERS).
+
+    "auto" chooses Parquet when pyarrow is installed and .npy otherwise. The
+    export is named after the stem of xad_file, or name (a path relative to
+    output_dir, without suffix) if given.
+    """
+    if export_format == "auto":
+        export_format = "parquet" if import_pyarrow() is not None else "npy"
+    elif export_format == "parquet" and import_pyarrow() is None:
+        raise Error("pyarrow is required for Parquet export")
+    exporter = EXPORTERS[export_format](xad_file, output_dir, name)
+    add_chip = exporter.add_chip
+    profiler = active_profiler
+    if profiler is not None:
+        add_chip = lambda chip: profiler.call("export_chip", exporter.add_chip, chip)
+    try:
+        document = load_xad(xad_file, on_chip=add_chip, select=select, cache=cache)
+    except BaseException:
+        exporter.abort()
+        raise
+    exporter.close(document)
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+# Size of the deflate window, which a checkpoint has to restore
+DEFLATE_WINDOW_SIZE = 1 << 15
+
+def load_libz():
+    """Return the system zlib loaded with ctypes, or None if it cannot be found."""
+    # imported on demand like pyarrow, as only indexing needs them
+    import ctypes
+    import ctypes.util
+    try:
+        libz = ctypes.CDLL(ctypes.util.find_library('z') or 'libz.so.1')
+    except OSError:
+        return None
+    libz.zlibVersion.restype = ctypes.c_char_p
+    libz.inflateInit2_.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    libz.inflate.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    libz.inflateEnd.argtypes = [ctypes.c_void_p]
+    libz.inflatePrime.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+    libz.inflateSetDictionary.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint]
+    return libz
+
+class RawInflater:
+    """A raw inflate stream of the system zlib, used through ctypes.
+
+    This does what zlib.decompressobj cannot: stop at the end of each deflate
+    block (Z_BLOCK) so that checkpoints can be taken, and resume inflating
+    from a checkpoint (inflatePrime and inflateSetDictionary).
+    """
+
+    def __init__(self, libz):
+        import ctypes
+        class ZStream(ctypes.Structure):
+            _fields_ = [("next_in", ctypes.c_void_p), ("avail_in", ctypes.c_uint), ("total_in", ctypes.c_ulong),
+                        ("next_out", ctypes.c_void_p), ("avail_out", ctypes.c_uint), ("total_out", ctypes.c_ulong),
+                        ("msg", ctypes.c_char_p), ("state", ctypes.c_void_p),
+                        ("zalloc", ctypes.c_void_p), ("zfree", ctypes.c_void_p), ("opaque", ctypes.c_void_p),
+                        ("data_type", ctypes.c_int), ("adler", ctypes.c_ulong), ("reserved", ctypes.c_ulong)]
+        self._ctypes = ctypes
+        self._libz = libz
+        self.stream = ZStream()
+        self._output = ctypes.create_string_buffer(INFLATE_CHUNK_SIZE)
+        self.finished = False
+        self._check(libz.inflateInit2_(ctypes.byref(self.stream), -zlib.MAX_WBITS, libz.zlibVersion(), ctypes.sizeof(ZStream)))
+
+    def _check(self, ret):
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            raise ParseFailure("inflate failed (%d): %s" % (ret, (self.stream.msg or b'').decode('ascii', 'replace')))
+        return ret
+
+    def prime(self, bits, value):
+        self._check(self._libz.inflatePrime(self._ctypes.byref(self.stream), bits, value))
+
+    def set_dictionary(self, window):
+        self._check(self._libz.inflateSetDictionary(self._ctypes.byref(self.stream), window, len(window)))
+
+    def inflate(self, data, flush=Z_NO_FLUSH):
+        """Generate the output of inflating data, a piece at a time (one per deflate block with Z_BLOCK).
+
+        After each piece, stream.data_type, total_in and total_out describe
+        where the inflater stopped.
+        """
+        ctypes = self._ctypes
+        stream = self.stream
+        stream.next_in = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+        stream.avail_in = len(data)
+        output = ctypes.addressof(self._output)
+        while not self.finished:
+            stream.next_out = output
+            stream.avail_out = INFLATE_CHUNK_SIZE
+            ret = self._check(self._libz.inflate(ctypes.byref(stream), flush))
+            self.finished = ret == Z_STREAM_END
+            yield ctypes.string_at(output, INFLATE_CHUNK_SIZE - stream.avail_out)
+            if ret == Z_BUF_ERROR or (stream.avail_in == 0 and stream.avail_out != 0):
+                break
+        # data is only referenced by the stream while inflating it
+        stream.next_in = None
+        stream.avail_in = 0
+
+    def close(self):
+        self._libz.inflateEnd(self._ctypes.byref(self.stream))
+
+class IndexEntry(Record):
+    """Where the base64 text of the packed values of one signal is in the inflated data.
+
+    Attributes:
+        chip -- the position of the chip in the file (as in XadDocument.chips)
+        chip_id -- the ID of the chip, which need not be unique or present
+        signal_set, trace, channel -- which signal of the chip (see iter_signals)
+        field -- "raw_signal" or "script_step"
+        var_type, num_values -- the attributes of the packed values
+        offset, length -- the position of the text in the inflated data stream
+    """
+    __slots__ = ('chip', 'chip_id', 'signal_set', 'trace', 'channel', 'field', 'var_type', 'num_values', 'offset', 'length')
+
+class Checkpoint(Record):
+    """A point at the start of a deflate block from which inflating can resume.
+
+    Attributes:
+        out -- the offset of the point in the inflated data stream
+        compressed -- the offset in the deflate body of the first whole byte after the point
+        bits -- the number of bits of the byte before that which belong after the point
+        base64_offset -- the offset in the compressed_data text of the base64 quartet
+                         holding the first byte needed to resume
+        skip -- the number of bytes decoded from that quartet before that byte
+        window -- the last 32KB of inflated data before the point
+    """
+    __slots__ = ('out', 'compressed', 'bits', 'base64_offset', 'skip', 'window')
+
+class XadIndex(Record):
+    """A sidecar index of an XAD file, as written by write_index.
+
+    Attributes:
+        size -- the size of the indexed XAD file
+        data_header -- the ints of the Header of its compressed_data
+        footer -- the footer of its compressed_data, in hex
+        entries -- the IndexEntry of each signal, keyed by
+                   (chip, signal_set, trace, channel, field)
+        checkpoints -- Checkpoints in order of out (none if libz was not available)
+    """
+    __slots__ = ('size', 'data_header', 'footer', 'entries', 'checkpoints')
+
+INDEX_VERSION = 3
+INDEX_MAGIC = b'xadder-index\n'
+# Default amount of inflated data between checkpoints
+INDEX_SPAN = 1 << 20
+INDEX_ENTRY_FIELDS = ('chip', 'chip_id', 'signal_set', 'trace', 'channel', 'field', 'var_type', 'num_values', 'offset', 'length')
+# Fields of IndexEntry which XadIndex.entries are keyed by
+INDEX_KEY_FIELDS = ('chip', 'signal_set', 'trace', 'channel', 'field')
+INDEX_CHECKPOINT_FIELDS = ('out', 'compressed', 'bits', 'base64_offset', 'skip')
+
+def index_path(xad_file):
+    return str(xad_file) + '.idx'
+
+def index_matches(index, size, encoded):
+    """Return whether index is that of an XAD file of size bytes with compressed_data text encoded.
+
+    Besides the size, the header and footer of compressed_data are compared,
+    which are decoded from its ends only, so that a file rewritten at the
+    same size is not read through checkpoints which are not its own.
+    """
+    if index.size != size:
+        return False
+    header = peek_compressed_data_header(encoded)
+    footer = peek_compressed_data_footer(encoded)
+    return (header is not None and footer is not None and
+            list(header.ints) == index.data_header and footer.hex() == index.footer)
+
+def base64_chunk_starts(encoded, chunk_size=BASE64_CHUNK_SIZE):
+    """Return the number of base64 characters before each chunk of encoded, as b64decode_chunks splits it."""
+    starts = []
+    total = 0
+    for start in range(0, len(encoded), chunk_size):
+        starts.append(total)
+        total += len(bytes(encoded[start:start + chunk_size]).translate(None, BASE64_WHITESPACE))
+    return starts
+
+def base64_offset(encoded, starts, position, chunk_size=BASE64_CHUNK_SIZE):
+    """Return the offset in encoded of its base64 character number position (not counting whitespace)."""
+    i = bisect_right(starts, position) - 1
+    chunk = bytes(encoded[i * chunk_size:(i + 1) * chunk_size])
+    wanted = position - starts[i]
+    offset = wanted
+    while True:
+        found = offset - sum(chunk.count(bytes((c,)), 0, offset) for c in BASE64_WHITESPACE)
+        if found == wanted:
+            break
+        offset += wanted - found
+    while chunk[offset] in BASE64_WHITESPACE:
+        offset += 1
+    return i * chunk_size + offset
+
+def index_entries(chip, position):
+    """Generate an IndexEntry for the packed values of each signal of chip, the one at position in its file."""
+    for raw_signal_set, trace, channel, signal in iter_signals(chip):
+        for field in ("raw_signal", "script_step"):
+            packed = getattr(signal, field)
+            if packed is not None and packed.offset is not None:
+                yield IndexEntry(chip=position, chip_id=chip.id, signal_set=raw_signal_set.name, trace=trace, channel=channel,
+                                 field=field, var_type=packed.var_type, num_values=packed.num_values,
+                                 offset=packed.offset, length=packed.length)
+
+# What DataXmlParser has to parse to find the packed values of signals
+INDEX_SELECTION = ["Chip/ID", "SignalData/RawSignal", "SignalData/ScriptStep"]
+
+def build_index(xad_file, span=INDEX_SPAN):
+    """Return the XadIndex of xad_file, with a Checkpoint about every span bytes of inflated data."""
+    entries = {}
+    chips = itertools.count()
+    def on_chip(chip):
+        # keyed by the position of the chip, as chip IDs may be repeated or missing
+        for entry in index_entries(chip, next(chips)):
+            entries[tuple(getattr(entry, field) for field in INDEX_KEY_FIELDS)] = entry
+    document = XadDocument(on_chip=on_chip)
+    checkpoints = []
+    footer = []
+    libz = load_libz()
+    with map_xad_file(xad_file) as view:
+        for name, data in split_xad(view):
+            if name != "compressed_data":
+                continue
+            def on_header(decoded_header):
+                document.data_header = handle_header(decoded_header)
+            parser = DataXmlParser(document, select=INDEX_SELECTION)
+            body = split_compressed_data(b64decode_chunks(data), on_header, footer.append)
+            if libz is None:
+                for inflated in inflate_chunks(body):
+                    parser.feed(inflated)
+            else:
+                inflater = RawInflater(libz)
+                try:
+                    stream = inflater.stream
+                    window = b''
+                    last = 0
+                    for chunk in body:
+                        for inflated in inflater.inflate(chunk, Z_BLOCK):
+                            if inflated:
+                                parser.feed(inflated)
+                                window = (window + inflated)[-DEFLATE_WINDOW_SIZE:]
+                            # at the end of a block which is not the last one
+                            if stream.data_type & 128 and not stream.data_type & 64 and stream.total_out - last >= span:
+                                checkpoints.append(Checkpoint(out=stream.total_out, compressed=stream.total_in,
+                                                              bits=stream.data_type & 7, window=window))
+                                last = stream.total_out
+                        if inflater.finished:
+                            break
+                finally:
+                    inflater.close()
+            parser.close()
+            starts = base64_chunk_starts(data)
+            for checkpoint in checkpoints:
+                start = checkpoint.compressed - (1 if checkpoint.bits else 0) + COMPRESSED_DATA_HEADER_SIZE
+                checkpoint.base64_offset = base64_offset(data, starts, start // 3 * 4)
+                checkpoint.skip = start % 3
+            break
+    if document.data_header is None:
+        raise ParseFailure("%s has no compressed_data" % (xad_file))
+    return XadIndex(size=os.path.getsize(xad_file), data_header=list(document.data_header.ints),
+                    footer=footer[0].hex() if footer else None, entries=entries, checkpoints=checkpoints)
+
+def write_index(index, path):
+    """Write index to path: INDEX_MAGIC, the length of a JSON description and the JSON, then the compressed windows."""
+    windows = []
+    offset = 0
+    checkpoints = []
+    for checkpoint in index.checkpoints:
+        window = zlib.compress(checkpoint.window)
+        checkpoints.append([getattr(checkpoint, field) for field in INDEX_CHECKPOINT_FIELDS] + [offset, len(window)])
+        windows.append(window)
+        offset += len(window)
+    description = json.dumps({
+        "version": INDEX_VERSION,
+        "size": index.size,
+        "data_header": index.data_header,
+        "footer": index.footer,
+        "entries": [[getattr(entry, field) for field in INDEX_ENTRY_FIELDS] for entry in index.entries.values()],
+        "checkpoints": checkpoints,
+    }).encode('utf-8')
+    with atomic_write(path, 'wb') as f:
+        f.write(INDEX_MAGIC)
+        f.write(len(description).to_bytes(8, 'little'))
+        f.write(description)
+        for window in windows:
+            f.write(window)
+
+def read_index(path):
+    """Return the XadIndex written to path by write_index."""
+    with open(path, 'rb') as f:
+        if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ParseFailure("%s is not an xadder index" % (path))
+        description = json.loads(f.read(int.from_bytes(f.read(8), 'little')))
+        if description.get("version") != INDEX_VERSION:
+            raise ParseFailure("%s is an index of unsupported version %r" % (path, description.get("version")))
+        windows = f.read()
+    entries = {}
+    for values in description["entries"]:
+        entry = IndexEntry(**dict(zip(INDEX_ENTRY_FIELDS, values)))
+        entries[tuple(getattr(entry, field) for field in INDEX_KEY_FIELDS)] = entry
+    checkpoints = []
+    for values in description["checkpoints"]:
+        checkpoint = Checkpoint(**dict(zip(INDEX_CHECKPOINT_FIELDS, values)))
+        offset, length = values[len(INDEX_CHECKPOINT_FIELDS):]
+        checkpoint.window = zlib.decompress(windows[offset:offset + length])
+        checkpoints.append(checkpoint)
+    return XadIndex(size=description["size"], data_header=description["data_header"], footer=description["footer"],
+                    entries=entries, checkpoints=checkpoints)
+
+def inflate_range(encoded, index, offset, length, libz=None):
+    """Return length bytes at offset in the inflated data of compressed_data text encoded.
+
+    Inflating starts from the last checkpoint of index before offset (or from
+    the start if there is none or libz is not available) and stops as soon as
+    the bytes have been inflated.
+    """
+    libz = load_libz() if libz is None else libz
+    checkpoint = None
+    if libz is not None:
+        for candidate in index.checkpoints:
+            if candidate.out > offset:
+                break
+            checkpoint = candidate
+    if checkpoint is None:
+        position = 0
+        body = split_compressed_data(b64decode_chunks(encoded), lambda header: None, lambda footer: None)
+        pieces = inflate_chunks(body)
+    else:
+        position = checkpoint.out
+        pieces = inflate_from_checkpoint(encoded, checkpoint, libz)
+    wanted = []
+    end = offset + length
+    try:
+        for inflated in pieces:
+            if position + len(inflated) > offset:
+                wanted.append(inflated[max(offset - position, 0):end - position])
+            position += len(inflated)
+            if position >= end:
+                break
+    finally:
+        pieces.close()
+    data = b''.join(wanted)
+    if len(data) != length:
+        raise ParseFailure("inflated data ends before offset %d" % (end))
+    return data
+
+def inflate_from_checkpoint(encoded, checkpoint, libz):
+    """Generate the inflated data from checkpoint onwards."""
+    inflater = RawInflater(libz)
+    try:
+        chunks = b64decode_chunks(encoded[checkpoint.base64_offset:])
+        first = next(chunks)[checkpoint.skip:]
+        if checkpoint.bits:
+            inflater.prime(checkpoint.bits, first[0] >> (8 - checkpoint.bits))
+            first = first[1:]
+        inflater.set_dictionary(checkpoint.window)
+        for chunk in itertools.chain((first,), chunks):
+            yield from inflater.inflate(chunk)
+            if inflater.finished:
+                return
+    finally:
+        inflater.close()
+
+def read_indexed_values(xad_file, index, chip, signal_set, trace="signal", channel=None, field="raw_signal"):
+    """Return the PackedValues of one signal of xad_file, inflating only what is needed using its XadIndex.
+
+    chip is the position of the chip in the file (0 for the first one), and
+    the signal of the chip is identified as by iter_signals, e.g.
+    trace="channel" and channel=0 for the first Channel of a sample.
+    """
+    entry = index.entries.get((chip, signal_set, trace, channel, field))
+    if entry is None:
+        raise Error("no %s for chip %s %s %s %s in index" % (field, chip, signal_set, trace, channel))
+    size = os.path.getsize(xad_file)
+    with map_xad_file(xad_file) as view:
+        for name, data in split_xad(view):
+            if name == "compressed_data":
+                if not index_matches(index, size, data):
+                    raise Error("index of %s is out of date" % (xad_file))
+                encoded = inflate_range(data, index, entry.offset, entry.length).decode('utf-16-le')
+                return PackedValues(var_type=entry.var_type, num_values=entry.num_values,
+                                    offset=entry.offset, length=entry.length, encoded=encoded)
+    raise ParseFailure("%s has no compressed_data" % (xad_file))
+
+class PackedSource:
+    """The XAD file which the text of PackedValues parsed without it is read back from.
+
+    The text is inflated again from the last checkpoint before it in the
+    sidecar index of the file (see build_index) if it has one which is up to
+    date, or else from the start of compressed_data.
+    """
+
+    def __init__(self, xad_file):
+        self.xad_file = xad_file
+        self.signature = file_signature(xad_file)
+        self._index = None
+
+    def _load_index(self, encoded):
+        try:
+            index = read_index(index_path(self.xad_file))
+        except (OSError, ValueError, zlib.error, Error):
+            index = None
+        if index is None or not index_matches(index, self.signature[0], encoded):
+            index = XadIndex(size=self.signature[0], entries={}, checkpoints=[])
+        return index
+
+    def read(self, offset, length):
+        """Return the text of length bytes at offset in the inflated data."""
+        if file_signature(self.xad_file) != self.signature:
+            raise Error("%s has changed since it was parsed" % (self.xad_file))
+        with map_xad_file(self.xad_file) as view:
+            for name, data in split_xad(view):
+                if name == "compressed_data":
+                    if self._index is None:
+                        self._index = self._load_index(data)
+                    return inflate_range(data, self._index, offset, length).decode('utf-16-le')
+        raise ParseFailure("%s has no compressed_data" % (self.xad_file))
+
+# Size of the buffer of an OutputWriter, written out whenever it fills up
+OUTPUT_BUFFER_SIZE = 1 << 20
+# Number of values of an array formatted at a time
+OUTPUT_ARRAY_CHUNK_SIZE = 1 << 16
+# printf format of the values of each vartype; 9 significant digits are exact for float32
+OUTPUT_VALUE_FORMATS = {"LE_R4": "%.9g", "LE_I2": "%d", "LE_UI1": "%d"}
+
+def format_value_chunks(packed, non_finite=None, chunk_size=OUTPUT_ARRAY_CHUNK_SIZE):
+    """Generate the values of PackedValues packed as comma-separated text, chunk_size values at a time.
+
+    Each chunk is formatted by a single % operation; with non_finite, NaN and
+    infinite values are written as it instead.
+    """
+    values = packed.values
+    value_format = OUTPUT_VALUE_FORMATS[packed.var_type]
+    check = non_finite is not None and value_format != "%d"
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start + chunk_size]
+        separator = ',' if start else ''
+        if check and not (numpy.isfinite(chunk).all() if numpy is not None else all(map(math.isfinite, chunk))):
+            yield separator + ','.join(value_format % value if math.isfinite(value) else non_finite
+                                       for value in chunk.tolist())
+            continue
+        chunk = chunk.tolist()
+        yield separator + (','.join((value_format,) * len(chunk)) % tuple(chunk))
+
+def packed_base64(packed):
+    # the base64 text of the data XML is that of the little-endian values already
+    return ''.join(packed.text().split())
+
+# Fields of SignalData written by the structured writers, besides its arrays
+SIGNAL_FIELDS = tuple(name for name in SignalData.__slots__ if name not in dict(EXPORT_ARRAYS))
+
+class OutputWriter:
+    """Base class of the writers of OUTPUT_FORMATS, given the parts of a document as they are parsed.
+
+    The output is collected in a buffer which is written to out (a binary
+    file) once it holds OUTPUT_BUFFER_SIZE bytes. Arrays are written as text
+    a chunk at a time (see format_value_chunks), or as the base64 of their
+    little-endian values if arrays is "base64".
+    """
+    extension = None
+    # prefix of the names of the stages profiled by write_xad_file
+    stage = "write"
+
+    def __init__(self, out, arrays="text"):
+        self.out = out
+        self.arrays = arrays
+        self._parts = []
+        self._size = 0
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= OUTPUT_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self.out.write(''.join(self._parts).encode('utf-8'))
+            self._parts = []
+            self._size = 0
+
+    def start_document(self, document):
+        pass
+
+    def add_chip(self, chip):
+        pass
+
+    def end_document(self, document):
+        pass
+
+def finite_json(value):
+    """Return value with the NaN and infinite floats in it (and its dicts, lists and tuples) replaced by None."""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: finite_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [finite_json(item) for item in value]
+    return value
+
+class JsonLinesWriter(OutputWriter):
+    """Writes a JSON object per line, each with its "record" type.
+
+    A "document" record has the comments and the header of compressed_data,
+    each chip a "chip" record followed by a "signal" record per signal (see
+    iter_signals) and the fields of <Chipset> come last in a "chipset"
+    record. NaN and infinite values are written as null.
+    """
+    extension = '.jsonl'
+
+    def _record(self, fields, arrays=()):
+        line = json.dumps(finite_json(fields))
+        if not arrays:
+            self.write(line + '\n')
+            return
+        self.write(line[:-1])
+        for name, packed in arrays:
+            self.write(', "%s": ' % (name))
+            if packed is None:
+                self.write('null')
+            elif self.arrays == "base64":
+                self.write('{"var_type": %s, "num_values": %d, "base64": "%s"}' % (
+                    json.dumps(packed.var_type), packed.num_values, packed_base64(packed)))
+            else:
+                self.write('[')
+                for chunk in format_value_chunks(packed, "null"):
+                    self.write(chunk)
+                self.write(']')
+        self.write('}\n')
+
+    def start_document(self, document):
+        preview = document.preview
+        self._record({
+            "record": "document",
+            "header": header_summary(document.header),
+            "tag_uuid": document.tag_uuid,
+            "tag_num": document.tag_num,
+            "tag_blob": None if document.tag_blob is None else document.tag_blob.hex(),
+            "preview": None if preview is None else {
+                "uuid": preview.uuid,
+                "title": preview.title,
+                "chip_info": preview.chip_info_rows,
+                "samples_info": preview.samples_info_rows,
+                "gel_image_size": None if preview.gel_image is None else len(preview.gel_image),
+            },
+            "data_header": header_summary(document.data_header),
+        })
+
+    def add_chip(self, chip):
+        fields = {"record": "chip"}
+        for name in Chip.__slots__:
+            if name not in ("raw_signals", "packet"):
+                fields[name] = getattr(chip, name)
+        self._record(fields, (("packet", chip.packet),))
+        for raw_signal_set, trace, channel, signal in iter_signals(chip):
+            fields = {"record": "signal", "chip_id": chip.id, "signal_set": raw_signal_set.name,
+                      "trace": trace, "channel": channel}
+            for name in SIGNAL_FIELDS:
+                fields[name] = getattr(signal, name)
+            self._record(fields, [(name, getattr(signal, name)) for name, _ in EXPORT_ARRAYS])
+
+    def end_document(self, document):
+        self._record({
+            "record": "chipset",
+            "file_type": document.file_type,
+            "type": document.type,
+            "class": document.chipset_class,
+            "data_type": document.data_type,
+            "external_links": document.external_links,
+            "persist_sample_signals": document.persist_sample_signals,
+            "method": document.method,
+            "log_book": document.log_book,
+            "data_footer": None if document.data_footer is None else document.data_footer.hex(),
+        })
+
+# Escapes of the characters which cannot be written as they are in TSV fields
+TSV_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def tsv_field(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, str):
+        return value.translate(TSV_ESCAPES)
+    return str(value)
+
+class TsvWriter(OutputWriter):
+    """Writes a table of the signals of each chip (see iter_signals), with a header line.
+
+    The arrays are comma-separated values (or base64) with their vartype in
+    a column of their own. Only the signals are written.
+    """
+    extension = '.tsv'
+
+    def start_document(self, document):
+        columns = ["chip_id", "signal_set", "trace", "channel"] + list(SIGNAL_FIELDS)
+        for name, _ in EXPORT_ARRAYS:
+            columns += [name + "_var_type", name]
+        self.write('\t'.join(columns) + '\n')
+
+    def add_chip(self, chip):
+        for raw_signal_set, trace, channel, signal in iter_signals(chip):
+            self.write('\t'.join(tsv_field(value) for value in (
+                [chip.id, raw_signal_set.name, trace, channel] + [getattr(signal, name) for name in SIGNAL_FIELDS])))
+            for name, _ in EXPORT_ARRAYS:
+                packed = getattr(signal, name)
+                if packed is None:
+                    self.write('\t\t')
+                    continue
+                self.write('\t%s\t' % (packed.var_type))
+                if self.arrays == "base64":
+                    self.write(packed_base64(packed))
+                else:
+                    for chunk in format_value_chunks(packed):
+                        self.write(chunk)
+            self.write('\n')
+
+# Structured output formats besides "text" (print_xad_file)
+OUTPUT_FORMATS = {"jsonl": JsonLinesWriter, "tsv": TsvWriter}
+
+def print_xad_file(xad_file, gel_image_file=gel_image_filename, select=None, cache=None):
+    """Parse xad_file, printing each chip as soon as it has been parsed.
+
+    Text elements are printed as they are written in the file.
+    """
+    write_xad_file(xad_file, TextPrinter(gel_image_file), None, select, cache, convert=False)
+
+class TextPrinter(OutputWriter):
+    """The OutputWriter of print_xad_file, which prints the text output; the gel image is written as the preview is printed."""
+    stage = "print"
+
+    def __init__(self, gel_image_file=gel_image_filename):
+        super().__init__(None)
+        self.gel_image_file = gel_image_file
+        self._printed = ()
+
+    def start_document(self, document):
+        self._printed = print_document_start(document, self.gel_image_file)
+
+    def add_chip(self, chip):
+        print_chip(chip)
+
+    def end_document(self, document):
+        print_document_end(document, self._printed)
+
+# While converting to a file, the gel images to write once it has been written (see deferred_gel_images)
+pending_gel_images = None
+
+def write_gel_image(preview, gel_image_file):
+    if pending_gel_images is not None:
+        pending_gel_images[gel_image_file] = preview.gel_image
+        return
+    with atomic_write(gel_image_file, 'wb') as png:
+        png.write(preview.gel_image)
+
+@contextmanager
+def deferred_gel_images():
+    """Hold back the gel images written within the context and write them only if it succeeds.
+
+    Used together with the atomic_write of an output, so that a conversion
+    which fails leaves no gel image without the output it goes with.
+    """
+    global pending_gel_images
+    previous = pending_gel_images
+    pending_gel_images = {}
+    try:
+        yield
+        images = pending_gel_images
+    finally:
+        pending_gel_images = previous
+    for gel_image_file, gel_image in images.items():
+        with atomic_write(gel_image_file, 'wb') as png:
+            png.write(gel_image)
+
+def write_xad_file(xad_file, writer, gel_image_file=gel_image_filename, select=None, cache=None, convert=True):
+    """Parse xad_file, giving each chip to writer (an OutputWriter) as soon as it has been parsed.
+
+    Without convert, text elements are given as they are written in the file.
+    The calls to writer are profiled as the stages "<writer.stage>_document"
+    and "<writer.stage>_chip".
+    """
+    document = XadDocument()
+    started = []
+    profiler = active_profiler
+    def call(name, function, *args):
+        return function(*args) if profiler is None else profiler.call(name, function, *args)
+    def start():
+        if document.preview is not None and document.preview.gel_image is not None and gel_image_file is not None:
+            write_gel_image(document.preview, gel_image_file)
+        call(writer.stage + "_document", writer.start_document, document)
+        started.append(True)
+    def on_chip(chip):
+        if not started:
+            start()
+        call(writer.stage + "_chip", writer.add_chip, chip)
+    document.on_chip = on_chip
+    parse_xad_file(xad_file, document, select, cache, convert=convert)
+    if not started:
+        start()
+    call(writer.stage + "_document", writer.end_document, document)
+    writer.flush()
+
+def output_xad_file(xad_file, output=None, output_format="text", arrays="text", gel_image_file=gel_image_filename, select=None, cache=None):
+    """Convert xad_file to output_format (see OUTPUT_FORMATS) and write it to the file output, or to stdout if it is None."""
+    if output_format == "text":
+        if output is None:
+            print_xad_file(xad_file, gel_image_file, select, cache)
+            return
+        with deferred_gel_images(), atomic_write(output) as out, redirect_stdout(out):
+            print_xad_file(xad_file, gel_image_file, select, cache)
+        return
+    if output is None:
+        sys.stdout.flush()
+        write_xad_file(xad_file, OUTPUT_FORMATS[output_format](sys.stdout.buffer, arrays), gel_image_file, select, cache)
+        sys.stdout.buffer.flush()
+        return
+    with deferred_gel_images(), atomic_write(output, 'wb') as out:
+        write_xad_file(xad_file, OUTPUT_FORMATS[output_format](out, arrays), gel_image_file, select, cache)
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """Open a temporary file which replaces path only once it has been written successfully."""
+    path = Path(path)
+    temporary = path.with_name('.%s.%d.tmp' % (path.name, os.getpid()))
+    try:
+        with open(temporary, mode) as f:
+            yield f
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.unlink(temporary)
+        except FileNotFoundError:
+            pass
+        raise
+
+def expand_xad_paths(patterns):
+    """Return the XAD files named by patterns (files, directories or glob patterns), without duplicates."""
+    paths = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(str(path) for path in Path(pattern).rglob('*') if path.suffix.lower() == '.xad' and path.is_file())
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern, recursive=True))
+        else:
+            matches = [pattern]
+        for match in matches:
+            paths.setdefault(os.path.normpath(match), None)
+    return list(paths)
+
+def describe_error(error):
+    return "%s: %s" % (type(error).__name__, getattr(error, 'message', None) or error)
+
+def output_name(xad_file, root):
+    """Return the path of xad_file relative to the directory root, without suffix, to name its output."""
+    directory = os.path.relpath(os.path.dirname(os.path.abspath(xad_file)), os.path.abspath(root))
+    return os.path.normpath(os.path.join(directory, Path(xad_file).stem))
+
+def output_names(xad_files):
+    """Return the output_name of each of xad_files relative to the deepest directory holding them all, by path.
+
+    Files of the same name in different directories thus have their outputs
+    in different subdirectories of the output directory.
+    """
+    if not xad_files:
+        return {}
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(xad_file)) for xad_file in xad_files])
+    return {xad_file: output_name(xad_file, root) for xad_file in xad_files}
+
+def convert_xad_file(xad_file, output_dir=None, export_format=None, select=None, profile=False, trace_memory=False, cache=None, output_format="text", arrays="text", name=None):
+    """Write the conversion of xad_file to output_format (and its gel image) into output_dir.
+
+    The outputs are named after the stem of xad_file, or name (a path
+    relative to output_dir, without suffix) if given. With export_format,
+    export its signals with export_xad_file instead.
+    With profile, the conversion is measured by a Profiler (tracing memory
+    with trace_memory).
+
+    Runs in batch worker processes, so any failure is returned as a message
+    rather than raised. Returns (xad_file, size in bytes, error or None,
+    Profiler report or None).
+    """
+    profiler = Profiler(trace_memory=trace_memory) if profile else None
+    size = 0
+    error = None
+    try:
+        size = os.path.getsize(xad_file)
+        if name is None:
+            name = Path(xad_file).stem
+        directory = Path(output_dir) if output_dir is not None else Path(xad_file).parent
+        with profiling(profiler) if profiler is not None else nullcontext():
+            if export_format is not None:
+                export_xad_file(xad_file, directory, export_format, select, cache, name)
+            else:
+                extension = '.txt' if output_format == "text" else OUTPUT_FORMATS[output_format].extension
+                output = directory / (name + extension)
+                output.parent.mkdir(parents=True, exist_ok=True)
+                output_xad_file(xad_file, output, output_format, arrays, directory / (name + '.png'), select, cache)
+    except Exception as e:
+        error = describe_error(e)
+    return xad_file, size, error, profiler.report() if profiler is not None else None
+
+def merge_profile_reports(reports):
+    """Return the sum of Profiler reports (the maximum for memory peaks)."""
+    merged = {"wall": 0.0, "cpu": 0.0, "stages": {}}
+    for report in reports:
+        merged["wall"] += report["wall"]
+        merged["cpu"] += report["cpu"]
+        if "max_rss_bytes" in report:
+            merged["max_rss_bytes"] = max(merged.get("max_rss_bytes", 0), report["max_rss_bytes"])
+        for name, stage in report["stages"].items():
+            total = merged["stages"].get(name)
+            if total is None:
+                merged["stages"][name] = dict(stage)
+                continue
+            for field, value in stage.items():
+                if field == "peak_traced":
+                    if value is not None:
+                        total[field] = max(total[field] or 0, value)
+                else:
+                    total[field] += value
+    return merged
+
+def write_profile_report(path, reports):
+    """Write the Profiler reports of each file (a dict) and their total as JSON to path ("-" for stderr)."""
+    report = {"total": merge_profile_reports(reports.values()), "files": reports}
+    if path == '-':
+        json.dump(report, sys.stderr, indent=2)
+        sys.stderr.write('\n')
+        return
+    with atomic_write(path) as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+
+def replace_broken_pool(executor, broken, jobs):
+    """Return the pool to use instead of executor once broken (a pool which raised BrokenProcessPool) has.
+
+    A worker process of broken died (e.g. killed for running out of
+    memory), so the files it was converting fail. If broken is still
+    executor, it is shut down and a new pool of jobs processes is returned
+    for the rest; otherwise it has been replaced already.
+    """
+    if broken is not executor:
+        return executor
+    executor.shutdown(wait=False, cancel_futures=True)
+    return ProcessPoolExecutor(max_workers=jobs)
+
+def convert_xad_files(xad_files, output_dir=None, jobs=None, export_format=None, select=None, profile_file=None, trace_memory=False, cache=None, output_format="text", arrays="text"):
+    """Convert xad_files in a pool of jobs processes, largest first, and report a summary on stderr.
+
+    With output_dir, the outputs mirror the paths of xad_files (see
+    output_names). A file whose outputs would overwrite those of a file
+    before it in xad_files fails without being converted.
+
+    With profile_file, each conversion is profiled and the reports are
+    written there by write_profile_report.
+
+    Returns the number of files which failed to convert.
+    """
+    names = output_names(xad_files) if output_dir is not None else {}
+    # path of the outputs without suffix: the file they are those of
+    outputs = {}
+    duplicates = {}
+    for xad_file in xad_files:
+        if output_dir is not None:
+            output = os.path.join(output_dir, names[xad_file])
+        else:
+            output = os.path.join(os.path.dirname(xad_file), Path(xad_file).stem)
+        duplicates[xad_file] = outputs.setdefault(output, xad_file)
+    xad_files = sorted(xad_files, key=lambda path: os.path.getsize(path) if os.path.exists(path) else 0, reverse=True)
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    start = time.monotonic()
+    total_size = 0
+    failures = 0
+    reports = {}
+    for xad_file in xad_files:
+        if duplicates[xad_file] != xad_file:
+            failures += 1
+            print("%s: failed: its output would overwrite that of %s" % (xad_file, duplicates[xad_file]), file=sys.stderr)
+    # only as many files as there are workers are submitted at a time, so
+    # that if a worker process dies only the files being converted fail
+    workers = jobs or os.cpu_count() or 1
+    pending = iter([xad_file for xad_file in xad_files if duplicates[xad_file] == xad_file])
+    running = {}
+    executor = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        while True:
+            for xad_file in itertools.islice(pending, max(workers - len(running), 0)):
+                future = executor.submit(convert_xad_file, xad_file, output_dir, export_format, select,
+                                         profile_file is not None, trace_memory, cache, output_format, arrays,
+                                         names.get(xad_file))
+                running[future] = (xad_file, executor)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                xad_file, pool = running.pop(future)
+                try:
+                    xad_file, size, error, report = future.result()
+                except BrokenProcessPool:
+                    size, error, report = 0, "a worker process died while converting it", None
+                    executor = replace_broken_pool(executor, pool, jobs)
+                if report is not None:
+                    reports[xad_file] = report
+                total_size += size
+                if error is not None:
+                    failures += 1
+                    print("%s: failed: %s" % (xad_file, error), file=sys.stderr)
+    finally:
+        executor.shutdown()
+    elapsed = max(time.monotonic() - start, 1e-9)
+    print("converted %d of %d files (%.1f MB) in %.1fs: %.1f files/s, %.1f MB/s, %d failed" % (
+        len(xad_files) - failures, len(xad_files), total_size / 1e6, elapsed,
+        len(xad_files) / elapsed, total_size / 1e6 / elapsed, failures), file=sys.stderr)
+    if profile_file is not None:
+        write_profile_report(profile_file, {xad_file: reports[xad_file] for xad_file in xad_files if xad_file in reports})
+    return failures
+
+def verify_xad_file(xad_file):
+    """Return (xad_file, size in bytes, Verification) for a worker process."""
+    try:
+        size = os.path.getsize(xad_file)
+    except OSError as e:
+        return xad_file, 0, Verification(problems=[describe_error(e)], warnings=[])
+    return xad_file, size, verify_xad(xad_file)
+
+def verify_xad_files(xad_files, jobs=None, out=None):
+    """Verify xad_files in a pool of jobs processes, writing a line per file to out (default: stdout).
+
+    Files with warnings only are reported as such but not counted as failed.
+    Returns the number of files which failed verification.
+    """
+    out = sys.stdout if out is None else out
+    xad_files = sorted(xad_files, key=lambda path: os.path.getsize(path) if os.path.exists(path) else 0, reverse=True)
+    start = time.monotonic()
+    total_size = 0
+    failures = 0
+    warnings = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(verify_xad_file, xad_file) for xad_file in xad_files]
+        for future in as_completed(futures):
+            xad_file, size, verification = future.result()
+            total_size += size
+            if verification.problems:
+                failures += 1
+                out.write("%s: failed: %s\n" % (xad_file, "; ".join(verification.problems)))
+            elif verification.warnings:
+                warnings += 1
+                out.write("%s: warning: %s\n" % (xad_file, "; ".join(verification.warnings)))
+            else:
+                out.write("%s: ok (footer: %s)\n" % (xad_file, verification.footer))
+    elapsed = max(time.monotonic() - start, 1e-9)
+    print("verified %d of %d files (%.1f MB) in %.1fs: %.1f MB/s, %d failed, %d with warnings" % (
+        len(xad_files) - failures, len(xad_files), total_size / 1e6, elapsed,
+        total_size / 1e6 / elapsed, failures, warnings), file=sys.stderr)
+    return failures
+
+def scan_xad_file(xad_file):
+    """Return the scan_summary of xad_file, or {"file": ..., "error": ...} if it cannot be scanned."""
+    try:
+        return scan_summary(xad_file, scan_xad(xad_file))
+    except Exception as e:
+        return {"file": xad_file, "error": describe_error(e)}
+
+# Number of files given to each worker process at a time when scanning
+SCAN_BATCH_SIZE = 64
+
+def scan_xad_files(xad_files, jobs=None, out=None):
+    """Write the scan_summary of each of xad_files to out (default: stdout) as a JSON line.
+
+    Returns the number of files which could not be scanned.
+    """
+    return write_json_results(scan_xad_file, (xad_files,), jobs, out)
+
+def write_json_results(function, arguments, jobs=None, out=None):
+    """Write function applied to arguments (iterables, as for map) to out (default: stdout) as JSON lines, in order.
+
+    Calls are made in a pool of jobs processes, SCAN_BATCH_SIZE at a time,
+    unless jobs is 1 or there is at most one. function returns a dict,
+    with an "error" if it failed. Returns the number of those which did.
+    """
+    out = sys.stdout if out is None else out
+    arguments = [list(iterable) for iterable in arguments]
+    failures = 0
+    if jobs == 1 or len(arguments[0]) <= 1:
+        results = map(function, *arguments)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(function, *arguments, chunksize=SCAN_BATCH_SIZE)
+    try:
+        for result in results:
+            if "error" in result:
+                failures += 1
+            out.write(json.dumps(result) + '\n')
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return failures
+
+def preview_xad_file(xad_file, output_dir=None, image=True, name=None):
+    """Write the gel image of xad_file as a .png into output_dir (default: next to it) and return its preview as a dict suitable for JSON.
+
+    The image is named after the stem of xad_file, or name (a path relative
+    to output_dir, without suffix) if given. Returns {"file": ...,
+    "error": ...} if it cannot be read.
+    """
+    try:
+        directory = Path(output_dir) if output_dir is not None else Path(xad_file).parent
+        gel_image_file = directory / ((Path(xad_file).stem if name is None else name) + '.png') if image else None
+        if gel_image_file is not None:
+            gel_image_file.parent.mkdir(parents=True, exist_ok=True)
+        preview = extract_preview(xad_file, gel_image_file)
+        if preview is None:
+            return {"file": xad_file, "error": "no preview"}
+        return {
+            "file": xad_file,
+            "title": preview.title,
+            "chip_info": preview.chip_info_rows,
+            "samples_info": preview.samples_info_rows,
+            "gel_image": str(gel_image_file) if image and preview.gel_image else None,
+        }
+    except Exception as e:
+        return {"file": xad_file, "error": describe_error(e)}
+
+def preview_main(argv):
+    parser = argparse.ArgumentParser(prog='xadder.py preview', description='Extract the gel image and the tables of the preview of XAD files, without reading their data, writing a JSON line per file')
+    parser.add_argument('xad', nargs='+', help='the input chip data (XAD) files, directories or glob patterns')
+    parser.add_argument('-o', '--output-dir', help='write the gel images (FILE.png) into this directory, in subdirectories mirroring those of the inputs (default: next to each input)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--no-image', action='store_true', help='only extract the title and tables')
+    args = parser.parse_args(argv)
+
+    xad_files = expand_xad_paths(args.xad)
+    if not xad_files:
+        parser.error("no XAD files found")
+    names = {}
+    failures = 0
+    if args.output_dir is not None and not args.no_image:
+        os.makedirs(args.output_dir, exist_ok=True)
+        names = output_names(xad_files)
+        # files whose gel image would overwrite that of an earlier file fail without being read
+        owners = {}
+        for xad_file in list(xad_files):
+            owner = owners.setdefault(names[xad_file], xad_file)
+            if owner != xad_file:
+                xad_files.remove(xad_file)
+                failures += 1
+                print(json.dumps({"file": xad_file, "error": "its gel image would overwrite that of %s" % (owner)}))
+    failures += write_json_results(preview_xad_file, (xad_files, [args.output_dir] * len(xad_files),
+                                                      [not args.no_image] * len(xad_files),
+                                                      [names.get(xad_file) for xad_file in xad_files]), args.jobs)
+    if failures:
+        sys.exit(1)
+
+def index_xad_file(xad_file, span=INDEX_SPAN):
+    """Write the sidecar index of xad_file (see index_path); returns (xad_file, size in bytes, error or None)."""
+    size = 0
+    try:
+        size = os.path.getsize(xad_file)
+        write_index(build_index(xad_file, span), index_path(xad_file))
+    except Exception as e:
+        return xad_file, size, describe_error(e)
+    return xad_file, size, None
+
+def print_index(xad_file):
+    index = read_index(index_path(xad_file))
+    for entry in index.entries.values():
+        print('\t'.join(str(getattr(entry, field)) for field in INDEX_ENTRY_FIELDS))
+
+def index_main(argv):
+    parser = argparse.ArgumentParser(prog='xadder.py index', description='Write a sidecar index (FILE.idx) of where each signal is in the inflated data of XAD files, with checkpoints to inflate from')
+    parser.add_argument('xad', nargs='+', help='the input chip data (XAD) files, directories or glob patterns')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--span', type=int, default=INDEX_SPAN >> 10, metavar='KB', help='amount of inflated data between checkpoints (default: %(default)s)')
+    parser.add_argument('--list', action='store_true', help='print the entries of the existing indexes as TSV instead of writing them')
+    args = parser.parse_args(argv)
+
+    xad_files = expand_xad_paths(args.xad)
+    if not xad_files:
+        parser.error("no XAD files found")
+    if args.list:
+        for xad_file in xad_files:
+            print_index(xad_file)
+        return
+    failures = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(index_xad_file, xad_file, args.span << 10) for xad_file in xad_files]
+        for future in as_completed(futures):
+            xad_file, size, error = future.result()
+            if error is not None:
+                failures += 1
+                print("%s: failed: %s" % (xad_file, error), file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+# Bump whenever the tables of the catalog change; older catalogs are rebuilt
+CATALOG_VERSION = 2
+# PRAGMA application_id of catalog databases ("XADC")
+CATALOG_APPLICATION_ID = 0x58414443
+# The tables of CATALOG_SCHEMA, dropped in reverse order when it changes
+CATALOG_TABLES = ("files", "chips", "samples", "signals")
+CATALOG_SCHEMA = """
+CREATE TABLE files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    header_uuid TEXT,
+    header_ints TEXT,
+    header_text TEXT,
+    tag_uuid TEXT,
+    tag_num INTEGER,
+    preview_title TEXT,
+    data_header_ints TEXT,
+    data_header_text TEXT,
+    file_type TEXT,
+    type TEXT,
+    chipset_class TEXT,
+    data_type TEXT
+);
+CREATE TABLE chips (
+    file INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    chip INTEGER NOT NULL,
+    chip_id TEXT,
+    assay TEXT,
+    instrument_name TEXT,
+    instrument_serial TEXT,
+    instrument TEXT,
+    chip_information TEXT,
+    has_data INTEGER,
+    number_of_acquired_samples INTEGER,
+    PRIMARY KEY (file, chip)
+);
+CREATE TABLE samples (
+    file INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    chip INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT,
+    PRIMARY KEY (file, chip, position)
+);
+CREATE TABLE signals (
+    file INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    chip INTEGER NOT NULL,
+    signal_set TEXT NOT NULL,
+    trace TEXT NOT NULL,
+    channel INTEGER,
+    name TEXT,
+    number_of_samples INTEGER,
+    min_value REAL,
+    max_value REAL
+);
+CREATE INDEX files_mtime ON files (mtime);
+CREATE INDEX files_header_uuid ON files (header_uuid);
+CREATE INDEX chips_chip_id ON chips (chip_id);
+CREATE INDEX chips_instrument ON chips (instrument_serial, assay);
+CREATE INDEX chips_instrument_name ON chips (instrument_name, assay);
+CREATE INDEX chips_assay ON chips (assay);
+CREATE INDEX samples_name ON samples (name);
+CREATE INDEX signals_chip ON signals (file, chip);
+CREATE INDEX signals_name ON signals (name);
+"""
+
+# Only these elements of the data XML are parsed for the catalog
+CATALOG_SELECTION = [
+    "Chipset/FileType", "Chipset/Type", "Chipset/Class", "Chipset/DataType",
+    "Chip/ID", "Chip/AssayHeader", "Chip/Instrument", "Chip/ChipInformation", "Chip/HasData",
+    "Chip/NumberOfAcquiredSamples", "AssayBody/DASampleSequence",
+    "SignalData/Name", "SignalData/NumberOfSamples", "SignalData/MinValue", "SignalData/MaxValue",
+]
+# Elements of <Instrument> taken as its name and serial number, in order of preference
+INSTRUMENT_NAME_ELEMENTS = ("Name", "InstrumentName")
+INSTRUMENT_SERIAL_ELEMENTS = ("Serial", "SerialNumber", "InstrumentSerial", "SerialNo")
+# Number of files whose rows are inserted in each transaction
+CATALOG_BATCH_SIZE = 64
+
+def opaque_leaves(data):
+    """Return the text of each leaf element of an opaque subtree of a Chip (the first one of each name), as a dict."""
+    leaves = {}
+    if not data:
+        return leaves
+    def visit(node):
+        children = [child for child in node.childNodes if child.nodeType == child.ELEMENT_NODE]
+        if not children:
+            leaves.setdefault(node.nodeName, ''.join(
+                child.data for child in node.childNodes if child.nodeType == child.TEXT_NODE).strip())
+        for child in children:
+            visit(child)
+    root = parseString(data).documentElement
+    for child in root.childNodes:
+        if child.nodeType == child.ELEMENT_NODE:
+            visit(child)
+    return leaves
+
+def first_leaf(leaves, names):
+    for name in names:
+        if leaves.get(name):
+            return leaves[name]
+    return None
+
+def sample_names(data):
+    """Return the names of the samples of a DASampleSequence, in order."""
+    if not data:
+        return []
+    names = []
+    for sample in parseString(data).documentElement.childNodes:
+        if sample.nodeType == sample.ELEMENT_NODE:
+            names.append(opaque_leaves(sample.toxml()).get("Name"))
+    return names
+
+def catalog_rows(xad_file, document):
+    """Return the rows of the catalog for a document loaded with CATALOG_SELECTION.
+
+    The result is a dict mapping "file" to the values of the columns of the
+    files table from header_uuid on, and "chips", "samples" and "signals" to
+    lists of rows of those tables without their file column.
+    """
+    def header_columns(header):
+        if header is None:
+            return None, None
+        return json.dumps(list(header.ints)), header.text
+    rows = {"chips": [], "samples": [], "signals": []}
+    rows["file"] = ((document.header.uuid if document.header is not None else None,) +
+                    header_columns(document.header) +
+                    (document.tag_uuid, document.tag_num,
+                     document.preview.title if document.preview is not None else None) +
+                    header_columns(document.data_header) +
+                    (document.file_type, document.type, document.chipset_class, document.data_type))
+    for number, chip in enumerate(document.chips):
+        instrument = opaque_leaves(chip.instrument)
+        rows["chips"].append((
+            number, chip.id, opaque_leaves(chip.assay_header).get("Title"),
+            first_leaf(instrument, INSTRUMENT_NAME_ELEMENTS), first_leaf(instrument, INSTRUMENT_SERIAL_ELEMENTS),
+            json.dumps(instrument) if chip.instrument is not None else None,
+            json.dumps(opaque_leaves(chip.chip_information)) if chip.chip_information is not None else None,
+            chip.has_data, chip.number_of_acquired_samples))
+        for position, name in enumerate(sample_names(chip.assay_body.get("DASampleSequence"))):
+            rows["samples"].append((number, position, name))
+        for raw_signal_set, trace, channel, signal in iter_signals(chip):
+            rows["signals"].append((number, raw_signal_set.name, trace, channel, signal.name,
+                                    signal.number_of_samples, signal.min_value, signal.max_value))
+    return rows
+
+def file_digest(xad_file):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(xad_file, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, 1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def catalog_xad_file(xad_file, known_digest=None):
+    """Return (xad_file, os.stat_result, digest, catalog_rows or None, error or None) for a worker process.
+
+    The file is only parsed if its digest differs from known_digest.
+    """
+    stat = digest = None
+    try:
+        stat = os.stat(xad_file)
+        digest = file_digest(xad_file)
+        if digest == known_digest:
+            return xad_file, stat, digest, None, None
+        return xad_file, stat, digest, catalog_rows(xad_file, load_xad(xad_file, select=CATALOG_SELECTION)), None
+    except Exception as e:
+        return xad_file, stat, digest, None, describe_error(e)
+
+def open_catalog(path):
+    """Open the catalog database at path, creating it if it has no tables yet.
+
+    A catalog of another CATALOG_VERSION has its tables dropped and created
+    again; any other database with tables raises Error and is left as is.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        application_id = connection.execute("PRAGMA application_id").fetchone()[0]
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        tables = set(name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        # catalogs written before the application_id was set are told apart by their tables
+        if tables and application_id != CATALOG_APPLICATION_ID and not (
+                application_id == 0 and "files" in tables and tables <= set(CATALOG_TABLES)):
+            raise Error("%s is not a catalog database (it has tables %s)" % (path, ", ".join(sorted(tables))))
+        if version != CATALOG_VERSION or not tables:
+            with connection:
+                for table in reversed(CATALOG_TABLES):
+                    connection.execute("DROP TABLE IF EXISTS %s" % (table))
+            connection.executescript(CATALOG_SCHEMA)
+            connection.execute("PRAGMA user_version = %d" % (CATALOG_VERSION))
+        if application_id != CATALOG_APPLICATION_ID:
+            connection.execute("PRAGMA application_id = %d" % (CATALOG_APPLICATION_ID))
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA foreign_keys = ON")
+    except sqlite3.DatabaseError as e:
+        connection.close()
+        raise Error("cannot open %s as a catalog: %s" % (path, e))
+    except Error:
+        connection.close()
+        raise
+    return connection
+
+def store_catalog_rows(connection, xad_file, stat, digest, rows):
+    """Replace the rows of xad_file in the catalog, in the current transaction."""
+    connection.execute("DELETE FROM files WHERE path = ?", (xad_file,))
+    file_id = connection.execute(
+        "INSERT INTO files VALUES (NULL, ?, ?, ?, ?, ?, %s)" % (', '.join('?' * len(rows["file"]))),
+        (xad_file, stat.st_size, stat.st_mtime, stat.st_mtime_ns, digest) + rows["file"]).lastrowid
+    for table, columns in (("chips", 10), ("samples", 4), ("signals", 9)):
+        connection.executemany("INSERT INTO %s VALUES (%s)" % (table, ', '.join('?' * columns)),
+                               ((file_id,) + row for row in rows[table]))
+
+def update_catalog(connection, xad_files, jobs=None):
+    """Bring the catalog up to date with xad_files and return the number of files which could not be parsed.
+
+    Files whose size and modification time are those in the catalog are
+    skipped without being read; the others are only parsed (in a pool of
+    jobs processes) if their digest has changed.
+    """
+    known = {path: (size, mtime_ns, digest) for path, size, mtime_ns, digest in
+             connection.execute("SELECT path, size, mtime_ns, digest FROM files")}
+    pending = []
+    for xad_file in xad_files:
+        xad_file = os.path.abspath(xad_file)
+        entry = known.get(xad_file)
+        try:
+            stat = os.stat(xad_file)
+        except OSError:
+            stat = None
+        if entry is not None and stat is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            continue
+        pending.append((xad_file, entry[2] if entry is not None else None))
+    failures = 0
+    if not pending:
+        return failures
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(catalog_xad_file, xad_file, digest) for xad_file, digest in pending]
+        for batch_start in range(0, len(futures), CATALOG_BATCH_SIZE):
+            with connection:
+                for future in futures[batch_start:batch_start + CATALOG_BATCH_SIZE]:
+                    xad_file, stat, digest, rows, error = future.result()
+                    if error is not None:
+                        failures += 1
+                        print("%s: failed: %s" % (xad_file, error), file=sys.stderr)
+                    elif rows is None:
+                        connection.execute("UPDATE files SET size = ?, mtime = ?, mtime_ns = ? WHERE path = ?",
+                                           (stat.st_size, stat.st_mtime, stat.st_mtime_ns, xad_file))
+                    else:
+                        store_catalog_rows(connection, xad_file, stat, digest, rows)
+    return failures
+
+def prune_catalog(connection):
+    """Remove the files which no longer exist from the catalog and return how many there were."""
+    missing = [(path,) for (path,) in connection.execute("SELECT path FROM files") if not os.path.exists(path)]
+    with connection:
+        connection.executemany("DELETE FROM files WHERE path = ?", missing)
+    return len(missing)
+
+def catalog_main(argv):
+    parser = argparse.ArgumentParser(prog='xadder.py catalog', description='Keep a SQLite catalog of the files, chips, samples and signals of XAD files, updated incrementally', epilog='e.g. xadder.py catalog runs.db --query "SELECT path, chip_id FROM chips JOIN files ON files.id = chips.file WHERE instrument_serial = \'DE12345\' AND assay = \'DNA 1000\' AND mtime > strftime(\'%s\', \'now\', \'-1 month\')"')
+    parser.add_argument('database', help='the SQLite database (created if need be)')
+    parser.add_argument('xad', nargs='*', help='chip data (XAD) files, directories or glob patterns to add or update')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--prune', action='store_true', help='remove the files which no longer exist from the catalog')
+    parser.add_argument('--query', metavar='SQL', help='run this query on the catalog and print the results as TSV with a header line')
+    args = parser.parse_args(argv)
+
+    try:
+        connection = open_catalog(args.database)
+    except Error as e:
+        parser.error(str(e))
+    failures = 0
+    try:
+        if args.xad:
+            xad_files = expand_xad_paths(args.xad)
+            if not xad_files:
+                parser.error("no XAD files found")
+            failures = update_catalog(connection, xad_files, args.jobs)
+        if args.prune:
+            prune_catalog(connection)
+        if args.query:
+            try:
+                cursor = connection.execute(args.query)
+            except sqlite3.Error as e:
+                parser.error("invalid query: %s" % (e))
+            if cursor.description is not None:
+                print('\t'.join(column[0] for column in cursor.description))
+            for row in cursor:
+                print('\t'.join('' if value is None else str(value) for value in row))
+    finally:
+        connection.close()
+    if failures:
+        sys.exit(1)
+
+# inotify(7) event masks and flags
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# Seconds a file has to stay the same size and age before it is converted
+WATCH_SETTLE = 1.0
+# Seconds between scans of the directory when inotify is not used
+WATCH_POLL_INTERVAL = 1.0
+# Seconds between the scans which catch what inotify missed (e.g. writes by
+# other clients of a network file system)
+WATCH_RESCAN_INTERVAL = 60.0
+
+class Inotify:
+    """Calls on_change with the path of each file written or moved into a directory tree, using inotify through ctypes.
+
+    on_overflow is called if the kernel drops events, after which the tree
+    has to be scanned. Raises OSError if inotify is not available.
+    """
+
+    def __init__(self, directory, on_change, on_overflow):
+        # imported on demand like pyarrow, as only watching needs them
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._libc = libc
+        self._get_errno = ctypes.get_errno
+        self._on_change = on_change
+        self._on_overflow = on_overflow
+        self._directories = {}
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = self._get_errno()
+            raise OSError(errno, os.strerror(errno))
+        try:
+            self._add_tree(directory)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _add_tree(self, directory):
+        for root, _, _ in os.walk(directory):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(root), INOTIFY_WATCH_MASK)
+            if wd < 0:
+                errno = self._get_errno()
+                raise OSError(errno, "%s: %s" % (root, os.strerror(errno)))
+            self._directories[wd] = root
+
+    def read(self):
+        """Handle the pending events; called when fd is readable."""
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self._on_overflow()
+            elif mask & IN_IGNORED:
+                self._directories.pop(wd, None)
+            elif wd in self._directories:
+                path = os.path.join(self._directories[wd], name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        # files may have landed before the watch was added
+                        try:
+                            self._add_tree(path)
+                        except OSError:
+                            pass
+                        self._on_overflow()
+                else:
+                    self._on_change(path)
+
+    def close(self):
+        os.close(self.fd)
+
+def is_xad_path(path):
+    return path.lower().endswith('.xad')
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def scan_directory(directory):
+    """Return the file_signature of each XAD file in the directory tree, by path."""
+    signatures = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if is_xad_path(name):
+                path = os.path.join(root, name)
+                try:
+                    signatures[path] = file_signature(path)
+                except OSError:
+                    pass
+    return signatures
+
+def watch_xad_file(xad_file, known_digest, output_dir=None, export_format=None, select=None, cache=None, name=None):
+    """Convert xad_file with convert_xad_file (naming its outputs name) unless its digest is known_digest, for a worker process.
+
+    Returns (xad_file, size in bytes, digest, "converted", "failed" or "unchanged", error or None).
+    """
+    try:
+        digest = file_digest(xad_file)
+    except OSError as e:
+        return xad_file, 0, None, "failed", describe_error(e)
+    if digest == known_digest:
+        return xad_file, os.path.getsize(xad_file), digest, "unchanged", None
+    _, size, error, _ = convert_xad_file(xad_file, output_dir, export_format, select, cache=cache, name=name)
+    return xad_file, size, digest, "failed" if error is not None else "converted", error
+
+class XadWatch:
+    """Converts the XAD files written to a directory tree as they arrive.
+
+    Changes are noticed with inotify (or by polling every poll_interval
+    seconds, if poll_interval is given or inotify is unavailable). A changed
+    file is queued once it has kept the same size and modification time for
+    settle seconds, and converted by convert_xad_file in a pool of jobs
+    processes unless its digest is that of its last conversion. The outputs
+    in output_dir mirror the paths of the files in the directory tree; a
+    file whose outputs would overwrite those of another file fails. At most
+    queue_size files wait for a worker; once the queue is full, settled files
+    are held back until there is room.
+
+    on_event is called with a dict for every file that has been handled, with
+    its "event" ("converted", "failed" or "unchanged"), "file", "digest",
+    "size", "error" and "latency" (seconds since the change was noticed).
+    """
+
+    def __init__(self, directory, on_event, output_dir=None, jobs=None, export_format=None, select=None,
+                 cache=None, settle=WATCH_SETTLE, poll_interval=None, queue_size=None, skip_existing=False):
+        self.directory = directory
+        self.on_event = on_event
+        self.output_dir = output_dir
+        self.jobs = jobs or os.cpu_count() or 1
+        self.export_format = export_format
+        self.select = select
+        self.cache = cache
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size or 2 * self.jobs
+        self.skip_existing = skip_existing
+        # file_signature of the XAD files as last scanned
+        self._signatures = {}
+        # path: [file_signature or None, time it last changed, time the change was noticed]
+        self._pending = {}
+        # paths queued or being converted
+        self._busy = set()
+        # path: digest when last converted
+        self._digests = {}
+        # output_name: the path it is the output of
+        self._outputs = {}
+        # the pool of worker processes, replaced if one of them dies
+        self._executor = None
+        self._stopped = None
+
+    def _changed(self, path):
+        if not is_xad_path(path):
+            return
+        now = time.monotonic()
+        entry = self._pending.get(path)
+        if entry is None:
+            self._pending[path] = [None, now, now]
+        else:
+            entry[1] = now
+
+    def _rescan(self):
+        signatures = scan_directory(self.directory)
+        for path, signature in signatures.items():
+            if self._signatures.get(path) != signature:
+                self._changed(path)
+        self._signatures = signatures
+
+    async def _poll(self, interval):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            signatures = await loop.run_in_executor(None, scan_directory, self.directory)
+            for path, signature in signatures.items():
+                if self._signatures.get(path) != signature:
+                    self._changed(path)
+            self._signatures = signatures
+
+    async def _settle(self, queue):
+        interval = min(self.settle, 0.25)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for path, entry in list(self._pending.items()):
+                if path in self._busy:
+                    # changed while being converted; handled once that is done
+                    continue
+                try:
+                    signature = file_signature(path)
+                except OSError:
+                    del self._pending[path]
+                    continue
+                if signature != entry[0]:
+                    entry[0] = signature
+                    entry[1] = now
+                elif now - entry[1] >= self.settle:
+                    del self._pending[path]
+                    self._busy.add(path)
+                    await queue.put((path, entry[2]))
+
+    def _emit(self, event):
+        try:
+            self.on_event(event)
+        except Exception as e:
+            print("%s: cannot report that it %s: %s" % (event["file"], event["event"], describe_error(e)), file=sys.stderr)
+
+    async def _convert(self, path, name):
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            return await loop.run_in_executor(
+                executor, watch_xad_file, path, self._digests.get(path), self.output_dir,
+                self.export_format, self.select, self.cache, name if self.output_dir is not None else None)
+        except BrokenProcessPool:
+            self._executor = replace_broken_pool(self._executor, executor, self.jobs)
+            raise
+
+    async def _work(self, queue):
+        while True:
+            path, noticed = await queue.get()
+            try:
+                name = output_name(path, self.directory)
+                owner = self._outputs.setdefault(name, path)
+                if owner != path:
+                    xad_file, size, digest, event, error = (path, 0, None, "failed",
+                                                            "its output would overwrite that of %s" % (owner))
+                else:
+                    try:
+                        xad_file, size, digest, event, error = await self._convert(path, name)
+                    except Exception as e:
+                        xad_file, size, digest, event, error = path, 0, None, "failed", describe_error(e)
+                if digest is not None and event != "failed":
+                    self._digests[path] = digest
+                self._emit({"event": event, "file": xad_file, "digest": digest, "size": size,
+                            "error": error, "latency": round(time.monotonic() - noticed, 3)})
+            finally:
+                self._busy.discard(path)
+                queue.task_done()
+
+    def stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def run(self):
+        """Watch until stop() is called."""
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        if self.output_dir is not None:
+            os.makedirs(self.output_dir, exist_ok=True)
+        inotify = None
+        if self.poll_interval is None:
+            try:
+                inotify = Inotify(self.directory, self._changed, self._rescan)
+            except OSError:
+                pass
+        if self.skip_existing:
+            self._signatures = scan_directory(self.directory)
+        else:
+            self._rescan()
+        queue = asyncio.Queue(self.queue_size)
+        self._executor = ProcessPoolExecutor(max_workers=self.jobs)
+        tasks = [asyncio.create_task(self._settle(queue))]
+        tasks += [asyncio.create_task(self._work(queue)) for _ in range(self.jobs)]
+        if inotify is not None:
+            loop.add_reader(inotify.fd, inotify.read)
+            tasks.append(asyncio.create_task(self._poll(WATCH_RESCAN_INTERVAL)))
+        else:
+            tasks.append(asyncio.create_task(self._poll(self.poll_interval or WATCH_POLL_INTERVAL)))
+        try:
+            await self._stopped.wait()
+        finally:
+            if inotify is not None:
+                loop.remove_reader(inotify.fd)
+                inotify.close()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._executor.shutdown(cancel_futures=True)
+
+def watch_main(argv):
+    parser = argparse.ArgumentParser(prog='xadder.py watch', description='Convert the XAD files written to a directory as they arrive, writing a JSON line per file handled')
+    parser.add_argument('directory', help='the directory to watch (with its subdirectories)')
+    parser.add_argument('-o', '--output-dir', help='write the conversions into this directory, in subdirectories mirroring those of the watched directory (default: next to each input)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of files converted at once (default: number of CPUs)')
+    parser.add_argument('--export', choices=['auto', 'parquet', 'npy'], help='export signals instead of converting to text (see xadder.py --help)')
+    parser.add_argument('--select', action='append', metavar='PATH', help='only parse the data XML elements on this path (may be repeated)')
+    parser.add_argument('--cache', metavar='DIR', help='cache what is parsed from each file in DIR')
+    parser.add_argument('--settle', type=float, default=WATCH_SETTLE, metavar='SECONDS', help='how long a file has to be left unchanged before it is converted (default: %(default)s)')
+    parser.add_argument('--poll', type=float, metavar='SECONDS', help='scan the directory this often instead of using inotify (e.g. for network file systems written by other hosts)')
+    parser.add_argument('--queue-size', type=int, metavar='N', help='number of settled files which may wait for a worker before more are held back (default: twice --jobs)')
+    parser.add_argument('--skip-existing', action='store_true', help='only convert files which change after watching starts')
+    parser.add_argument('--events', metavar='FILE', help='append the events to FILE instead of writing them to stdout')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.directory):
+        parser.error("%s is not a directory" % (args.directory))
+    if args.select:
+        try:
+            compile_selection(args.select)
+        except InvalidSelection as e:
+            parser.error(e.message)
+    events = open(args.events, 'a') if args.events is not None else sys.stdout
+    def on_event(event):
+        events.write(json.dumps(event) + '\n')
+        events.flush()
+    cache = XadCache(args.cache) if args.cache is not None else None
+    watch = XadWatch(args.directory, on_event, args.output_dir, args.jobs, args.export, args.select, cache,
+                     args.settle, args.poll, args.queue_size, args.skip_existing)
+    async def run():
+        loop = asyncio.get_running_loop()
+        for signum in (SIGINT, SIGTERM):
+            loop.add_signal_handler(signum, watch.stop)
+        await watch.run()
+    try:
+        asyncio.run(run())
+    finally:
+        if events is not sys.stdout:
+            events.close()
+
+class RequestError(Error):
+    """Exception raised when a request to the server (see serve_main) cannot be answered.
+
+    Attributes:
+        status -- the HTTP status code of the response
+        message -- explanation of the error
+    """
+
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+
+def object_memory(obj):
+    """Return an estimate of the memory used by a parsed Record and what it refers to."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, Record):
+        for name in obj.__slots__:
+            value = getattr(obj, name)
+            if value is not None and not callable(value):
+                size += object_memory(value)
+    elif isinstance(obj, (list, tuple)):
+        size += sum(object_memory(item) for item in obj)
+    elif isinstance(obj, dict):
+        size += sum(object_memory(key) + object_memory(value) for key, value in obj.items())
+    return size
+
+# Default bound on the memory of the documents kept by a DocumentCache
+DOCUMENT_CACHE_MEMORY = 1 << 30
+
+class DocumentCache:
+    """An LRU of documents loaded by load_xad, bounded by their estimated memory (see object_memory).
+
+    A document is reloaded once the size or modification time of its file
+    changes. Concurrent gets of a file which is not cached all wait for the
+    same load of it. Decoded packed values are not counted, as they are
+    cached by decode_packed_values.
+    """
+
+    def __init__(self, max_memory=DOCUMENT_CACHE_MEMORY, cache=None):
+        self.max_memory = max_memory
+        self.cache = cache
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        # path: (file_signature, document, memory), least recently used first
+        self._entries = collections.OrderedDict()
+        # path: (file_signature, Future of the document being loaded)
+        self._loading = {}
+
+    def get(self, xad_file):
+        """Return the XadDocument of xad_file, loading it unless it is cached."""
+        signature = file_signature(xad_file)
+        with self._lock:
+            entry = self._entries.get(xad_file)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(xad_file)
+                self.hits += 1
+                return entry[1]
+            loading = self._loading.get(xad_file)
+            if loading is not None and loading[0] == signature:
+                self.coalesced += 1
+                future = loading[1]
+            else:
+                self.misses += 1
+                future = Future()
+                self._loading[xad_file] = (signature, future)
+                loading = None
+        if loading is not None:
+            return future.result()
+        try:
+            document = load_xad(xad_file, cache=self.cache)
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(xad_file, None)
+            future.set_exception(e)
+            raise
+        memory = object_memory(document)
+        with self._lock:
+            if self._loading.get(xad_file, (None, None))[1] is future:
+                del self._loading[xad_file]
+            old = self._entries.pop(xad_file, None)
+            if old is not None:
+                self.memory -= old[2]
+            self._entries[xad_file] = (signature, document, memory)
+            self.memory += memory
+            while self.memory > self.max_memory and len(self._entries) > 1:
+                _, (_, _, size) = self._entries.popitem(last=False)
+                self.memory -= size
+        future.set_result(document)
+        return document
+
+    def stats(self):
+        with self._lock:
+            return {"documents": len(self._entries), "memory": self.memory, "max_memory": self.max_memory,
+                    "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                    "loading": len(self._loading)}
+
+def decimate(values, points):
+    """Return the (minimums, maximums, bucket size) of values in at most points equal buckets."""
+    bucket = max(1, -(-len(values) // points))
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        starts = numpy.arange(0, len(values), bucket)
+        return numpy.minimum.reduceat(values, starts).tolist(), numpy.maximum.reduceat(values, starts).tolist(), bucket
+    minimums = []
+    maximums = []
+    for start in range(0, len(values), bucket):
+        chunk = values[start:start + bucket]
+        minimums.append(min(chunk))
+        maximums.append(max(chunk))
+    return minimums, maximums, bucket
+
+def signal_summary(raw_signal_set, trace, channel, signal):
+    summary = {"signal_set": raw_signal_set.name, "trace": trace, "channel": channel}
+    for column, _, field in EXPORT_COLUMNS:
+        if field is not None:
+            summary[column] = getattr(signal, field)
+    for field, _ in EXPORT_ARRAYS:
+        packed = getattr(signal, field)
+        summary[field] = None if packed is None else {"var_type": packed.var_type, "num_values": packed.num_values}
+    return summary
+
+class XadServer(ThreadingHTTPServer):
+    """The HTTP server of serve_main, serving the files under root from a DocumentCache."""
+
+    def __init__(self, address, root, documents):
+        super().__init__(address, XadRequestHandler)
+        self.root = os.path.realpath(root)
+        self.documents = documents
+
+    def resolve(self, name):
+        """Return the path of the file name (relative to root) after checking that it is under root."""
+        if not name:
+            raise RequestError(400, "no file given")
+        path = os.path.realpath(os.path.join(self.root, name))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise RequestError(403, "%s is not under the served directory" % (name))
+        if not os.path.isfile(path):
+            raise RequestError(404, "no file %s" % (name))
+        return path
+
+class XadRequestHandler(BaseHTTPRequestHandler):
+    """Answers the GET requests listed in ROUTES with JSON, or binary data where noted."""
+    protocol_version = "HTTP/1.1"
+    # the headers and body are written separately, which Nagle's algorithm would delay
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        route = self.ROUTES.get(url.path)
+        try:
+            if route is None:
+                raise RequestError(404, "no such endpoint %s (see /)" % (url.path))
+            content_type, body, headers = route(self, query)
+        except RequestError as e:
+            content_type, body, headers = "application/json", json.dumps({"error": e.message}).encode(), {}
+            self.send_response(e.status)
+        except Exception as e:
+            # including failures to parse the file, as for batch conversion
+            content_type, body, headers = "application/json", json.dumps({"error": describe_error(e)}).encode(), {}
+            self.send_response(500)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, value):
+        # NaN and infinite values are null, as in the JSON Lines output, which strict parsers accept
+        return "application/json", json.dumps(finite_json(value), allow_nan=False).encode(), {}
+
+    def _document(self, query):
+        return self.server.documents.get(self.server.resolve(query.get("file")))
+
+    def _chip(self, query):
+        chip_id = query.get("chip")
+        for chip in self._document(query).chips:
+            if chip.id == chip_id:
+                return chip
+        raise RequestError(404, "no chip %r" % (chip_id))
+
+    def _signal(self, query):
+        chip = self._chip(query)
+        trace = query.get("trace", "signal")
+        try:
+            channel = int(query["channel"]) if "channel" in query else None
+        except ValueError:
+            raise RequestError(400, "invalid channel %r" % (query["channel"]))
+        for raw_signal_set, signal_trace, signal_channel, signal in iter_signals(chip):
+            if raw_signal_set.name == query.get("set") and signal_trace == trace and signal_channel == channel:
+                field = query.get("field", "raw_signal")
+                if field not in dict(EXPORT_ARRAYS):
+                    raise RequestError(400, "invalid field %r" % (field))
+                packed = getattr(signal, field)
+                if packed is None:
+                    raise RequestError(404, "no %s in that signal" % (field))
+                return signal, packed
+        raise RequestError(404, "no %s signal %r in set %r of chip %r" % (trace, channel, query.get("set"), chip.id))
+
+    def get_index(self, query):
+        """these endpoints"""
+        return self._json({path: function.__doc__ for path, function in self.ROUTES.items()})
+
+    def get_document(self, query):
+        """?file=F: the metadata of the file and the IDs of its chips"""
+        document = self._document(query)
+        preview = document.preview
+        return self._json({
+            "header": header_summary(document.header),
+            "tag_uuid": document.tag_uuid,
+            "tag_num": document.tag_num,
+            "preview_title": None if preview is None else preview.title,
+            "gel_image_size": None if preview is None or preview.gel_image is None else len(preview.gel_image),
+            "data_header": header_summary(document.data_header),
+            "file_type": document.file_type,
+            "type": document.type,
+            "class": document.chipset_class,
+            "data_type": document.data_type,
+            "persist_sample_signals": document.persist_sample_signals,
+            "chips": [chip.id for chip in document.chips],
+        })
+
+    def get_chip(self, query):
+        """?file=F&chip=ID: the fields of a chip and a summary of each of its signals"""
+        chip = self._chip(query)
+        summary = {name: getattr(chip, name) for name in Chip.__slots__
+                   if name not in ("raw_signals", "packet", "script_text")}
+        summary["signals"] = [signal_summary(*signal) for signal in iter_signals(chip)]
+        return self._json(summary)
+
+    def get_signal(self, query):
+        """?file=F&chip=ID&set=NAME[&trace=signal|channel|current|voltage][&channel=N][&field=raw_signal|script_step][&format=json|binary]: the values of a signal, binary being little-endian of the X-Var-Type header"""
+        signal, packed = self._signal(query)
+        if query.get("format", "json") == "binary":
+            if numpy is not None or sys.byteorder == 'little':
+                # the values decoded before (and cached) are little-endian already
+                data = packed.values.tobytes()
+            else:
+                data = get_packed_bytes(packed, packed.var_type)
+            return "application/octet-stream", data, {
+                "X-Var-Type": packed.var_type, "X-Num-Values": str(packed.num_values)}
+        axis = signal_axis(signal)
+        return self._json({"var_type": packed.var_type, "x_start": axis and axis[0], "x_step": axis and axis[1],
+                           "values": packed.values.tolist()})
+
+    def get_trace(self, query):
+        """?file=F&chip=ID&set=NAME&points=N[&trace=...][&channel=N]: the minimum and maximum of a signal in each of at most N buckets, for plotting"""
+        signal, packed = self._signal(query)
+        try:
+            points = int(query.get("points", 1000))
+        except ValueError:
+            points = 0
+        if points < 1:
+            raise RequestError(400, "invalid points %r" % (query.get("points")))
+        minimums, maximums, bucket = decimate(packed.values, points)
+        axis = signal_axis(signal)
+        return self._json({"x_start": axis and axis[0], "x_step": axis and axis[1] * bucket,
+                           "bucket": bucket, "min": minimums, "max": maximums})
+
+    def get_gel_image(self, query):
+        """?file=F: the gel image of the preview (PNG)"""
+        preview = self._document(query).preview
+        if preview is None or preview.gel_image is None:
+            raise RequestError(404, "no gel image")
+        return "image/png", preview.gel_image, {}
+
+    def get_stats(self, query):
+        """the state of the cache of parsed documents"""
+        return self._json(self.server.documents.stats())
+
+    ROUTES = {
+        "/": get_index,
+        "/document": get_document,
+        "/chip": get_chip,
+        "/signal": get_signal,
+        "/trace": get_trace,
+        "/gel_image": get_gel_image,
+        "/stats": get_stats,
+    }
+
+def serve_main(argv):
+    parser = argparse.ArgumentParser(prog='xadder.py serve', description='Serve the parsed contents of the XAD files under a directory over HTTP, keeping the most recently used in memory (GET / lists the endpoints)')
+    parser.add_argument('root', nargs='?', default='.', help='the directory whose files may be requested, by path relative to it (default: the current directory)')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on, 0 for any (default: %(default)s)')
+    parser.add_argument('--memory', type=int, default=DOCUMENT_CACHE_MEMORY >> 20, metavar='MB', help='bound on the memory of the documents kept in memory (default: %(default)s)')
+    parser.add_argument('--cache', metavar='DIR', help='also cache what is parsed from each file in DIR, across restarts')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.root):
+        parser.error("%s is not a directory" % (args.root))
+    cache = XadCache(args.cache) if args.cache is not None else None
+    server = XadServer((args.host, args.port), args.root, DocumentCache(args.memory << 20, cache))
+    print("serving %s on http://%s:%d/" % (args.root, args.host, server.server_address[1]), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# Commands given as the first argument, instead of an XAD file
+SUBCOMMANDS = {
+    "catalog": catalog_main,
+    "index": index_main,
+    "preview": preview_main,
+    "serve": serve_main,
+    "watch": watch_main,
+}
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser(description='Convert a chip data file from Bioanalyzer 2100', epilog='other commands: %s (see COMMAND --help)' % (', '.join(SUBCOMMANDS)))
+    parser.add_argument('xad', nargs='+', help='the input chip data (XAD) files, directories or glob patterns')
+    parser.add_argument('-o', '--output-dir', help='write a conversion (.txt, .jsonl or .tsv) and .png gel image per input file into this directory, in subdirectories mirroring those of the inputs (default: next to each input when converting several files)')
+    parser.add_argument('--format', choices=['text'] + sorted(OUTPUT_FORMATS), default='text', help='write each file as text, JSON Lines (a record per document, chip and signal) or TSV (a row per signal) (default: %(default)s)')
+    parser.add_argument('--arrays', choices=['text', 'base64'], default='text', help='write the arrays of --format jsonl or tsv as comma-separated values or as base64 of their little-endian values (default: %(default)s)')
+    parser.add_argument('--output', metavar='FILE', help='write the conversion of a single file to FILE instead of stdout')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes for batch conversion (default: number of CPUs)')
+    parser.add_argument('--export', choices=['auto', 'parquet', 'npy'], help='export signals and their SignalData fields as Parquet (needs pyarrow) or .npy arrays with a JSON manifest instead of converting to text')
+    parser.add_argument('--gel-image', default=gel_image_filename, help='where to write the gel image when converting a single file to stdout (default: %(default)s)')
+    parser.add_argument('--scan', action='store_true', help='only read the header, comment tag and preview of each file (and the header of its compressed data) and write them as one JSON line per file')
+    parser.add_argument('--verify', action='store_true', help='check the integrity of each file (lengths, deflate stream and footer of its compressed data) without parsing its data and report ok, warning or failed per file')
+    parser.add_argument('--select', action='append', metavar='PATH', help='only parse the data XML elements on this path, e.g. SignalData/RawSignal (the signals of the ladder and of every sample) or Chipset/Method (may be repeated)')
+    parser.add_argument('--profile', metavar='FILE', help='write the time, CPU time and bytes in and out of each stage of the conversion of each file to FILE as JSON ("-" for stderr)')
+    parser.add_argument('--cache', metavar='DIR', help='cache what is parsed from each file in DIR and reuse it when the same data is converted again')
+    parser.add_argument('--cache-size', type=int, default=CACHE_MAX_SIZE >> 20, metavar='MB', help='bound on the size of --cache in megabytes (default: %(default)s)')
+    parser.add_argument('--profile-memory', action='store_true', help='also record the peak memory of each stage with tracemalloc in --profile (slow)')
+    args = parser.parse_args()
+    if args.select:
+        try:
+            compile_selection(args.select)
+        except InvalidSelection as e:
+            parser.error(e.message)
+
+    if args.export is not None and args.format != 'text':
+        parser.error("--export and --format are mutually exclusive")
+    cache = XadCache(args.cache, args.cache_size << 20) if args.cache is not None else None
+
+    xad_files = expand_xad_paths(args.xad)
+    if args.scan:
+        if not xad_files:
+            parser.error("no XAD files found")
+        if scan_xad_files(xad_files, args.jobs):
+            sys.exit(1)
+        return
+    if args.verify:
+        if not xad_files:
+            parser.error("no XAD files found")
+        if verify_xad_files(xad_files, args.jobs):
+            sys.exit(1)
+        return
+    if len(xad_files) == 1 and args.output_dir is None and args.export is None and not os.path.isdir(args.xad[0]):
+        if args.profile is None:
+            output_xad_file(xad_files[0], args.output, args.format, args.arrays, args.gel_image, args.select, cache)
+            return
+        with profiling(Profiler(trace_memory=args.profile_memory)) as profiler:
+            output_xad_file(xad_files[0], args.output, args.format, args.arrays, args.gel_image, args.select, cache)
+        write_profile_report(args.profile, {xad_files[0]: profiler.report()})
+        return
+    if not xad_files:
+        parser.error("no XAD files found")
+    if args.output is not None:
+        parser.error("--output is only for converting a single file (see --output-dir)")
+    if convert_xad_files(xad_files, args.output_dir, args.jobs, args.export, args.select, args.profile,
+                         args.profile_memory, cache, args.format, args.arrays):
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main()
+    # run the main of the xadder module rather than of __main__, so that what
+    # is pickled (by XadCache and for worker processes) refers to xadder's
+    # classes and functions, as it does when xadder is imported
+    import xadder
+    xadder.main()